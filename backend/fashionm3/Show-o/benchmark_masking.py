@@ -0,0 +1,86 @@
+import argparse
+import math
+import random
+import time
+
+import torch
+from training.utils import random_token_mask, rectangle_token_mask, block_token_mask
+
+
+def argsort_mask(num_token_masked, seq_len, generator=None):
+    # previous default path of mask_or_random_replace_tokens
+    batch_randperm = torch.rand(num_token_masked.shape[0], seq_len, device=num_token_masked.device,
+                                generator=generator).argsort(dim=-1)
+    return batch_randperm < num_token_masked.unsqueeze(-1)
+
+
+def loop_rectangle_mask(num_token_masked, seq_len, generator=None):
+    # previous per-sample loop of mask_or_random_replace_tokens
+    batch_size = num_token_masked.shape[0]
+    resolution = int(seq_len ** 0.5)
+    mask = torch.zeros((batch_size, resolution, resolution), device=num_token_masked.device)
+    for batch_idx, num_token_masked_ in enumerate(num_token_masked):
+        num_token_masked_ = int(num_token_masked_.item())
+        num_token_masked_height = random.randint(
+            math.ceil(num_token_masked_ / resolution), min(resolution, num_token_masked_)
+        )
+        num_token_masked_height = min(num_token_masked_height, resolution)
+        num_token_masked_width = math.ceil(num_token_masked_ / num_token_masked_height)
+        num_token_masked_width = min(num_token_masked_width, resolution)
+        start_idx_height = random.randint(0, resolution - num_token_masked_height)
+        start_idx_width = random.randint(0, resolution - num_token_masked_width)
+        mask[
+        batch_idx,
+        start_idx_height: start_idx_height + num_token_masked_height,
+        start_idx_width: start_idx_width + num_token_masked_width,
+        ] = 1
+    return mask.reshape(batch_size, seq_len).to(torch.bool)
+
+
+def benchmark(fn, num_token_masked, seq_len, generator, num_iters):
+    device = num_token_masked.device
+    fn(num_token_masked, seq_len, generator=generator)  # warm-up
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        mask = fn(num_token_masked, seq_len, generator=generator)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters * 1000, mask
+
+
+if __name__ == '__main__':
+    # python benchmark_masking.py --device cuda --batch_size 32 --seq_len 1024
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--block_size", type=int, default=2)
+    parser.add_argument("--num_iters", type=int, default=100)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    generator = torch.Generator(device=device).manual_seed(0)
+    mask_prob = torch.rand(args.batch_size, device=device, generator=generator)
+    num_token_masked = (args.seq_len * mask_prob).round().clamp(min=1)
+
+    modes = {
+        "random (argsort)": argsort_mask,
+        "random (sort cut-off)": random_token_mask,
+        "rectangle (loop)": loop_rectangle_mask,
+        "rectangle (batched)": rectangle_token_mask,
+        f"block {args.block_size}x{args.block_size}":
+            lambda n, seq_len, generator=None: block_token_mask(n, seq_len, args.block_size, generator=generator),
+    }
+
+    print(f"{'mode':>24} {'ms / call':>10} {'masked / target':>16}")
+    for name, fn in modes.items():
+        ms, mask = benchmark(fn, num_token_masked, args.seq_len, generator, args.num_iters)
+        ratio = (mask.sum(-1).float() / num_token_masked).mean().item()
+        print(f"{name:>24} {ms:>10.3f} {ratio:>16.3f}")
+
+    # same seed, same masks
+    masks = [random_token_mask(num_token_masked, args.seq_len,
+                               generator=torch.Generator(device=device).manual_seed(1)) for _ in range(2)]
+    assert torch.equal(masks[0], masks[1])
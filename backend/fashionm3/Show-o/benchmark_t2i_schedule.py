@@ -0,0 +1,145 @@
+# coding=utf-8
+# Copyright 2024 NUS Show Lab.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
+import io
+import itertools
+import json
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from PIL import Image
+from tqdm import tqdm
+from models import get_mask_chedule
+from t2i_service import build_service
+from training.utils import get_config
+from transformers import CLIPModel, CLIPProcessor
+
+
+class CLIPScorer:
+    """Cheap quality proxy: CLIP image-text cosine similarity (x100), averaged over prompts."""
+
+    def __init__(self, model_name, device):
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.model = CLIPModel.from_pretrained(model_name).to(device).eval()
+        self.device = device
+
+    @torch.no_grad()
+    def __call__(self, images, prompts):
+        inputs = self.processor(text=prompts, images=images, return_tensors="pt", padding=True, truncation=True)
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        image_embeds = self.model.get_image_features(pixel_values=inputs["pixel_values"])
+        text_embeds = self.model.get_text_features(input_ids=inputs["input_ids"],
+                                                   attention_mask=inputs["attention_mask"])
+        image_embeds = image_embeds / image_embeds.norm(dim=-1, keepdim=True)
+        text_embeds = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
+        return (100.0 * (image_embeds * text_embeds).sum(dim=-1)).clamp(min=0).tolist()
+
+
+def pareto_frontier(results):
+    """Points not dominated by any other point with lower (or equal) latency and higher (or equal) quality."""
+    frontier = []
+    best_quality = -float("inf")
+    for result in sorted(results, key=lambda r: (r["latency"], -r["quality"])):
+        if result["quality"] > best_quality:
+            frontier.append(result)
+            best_quality = result["quality"]
+    return frontier
+
+
+def recommend(frontier, tolerance):
+    """Fastest frontier point whose quality is within `tolerance` (relative) of the best quality."""
+    best_quality = max(r["quality"] for r in frontier)
+    for result in frontier:
+        if result["quality"] >= (1.0 - tolerance) * best_quality:
+            return result
+
+
+if __name__ == '__main__':
+    # python benchmark_t2i_schedule.py config=configs/showo_demo_512x512.yaml \
+    #     schedules=[cosine,linear,pow2,sigmoid] timesteps=[4,8,12,18,24] guidance_scales=[1.75,5] \
+    #     output_dir=schedule_benchmark
+    config = get_config()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    schedules = list(config.get("schedules", ["cosine", "linear", "pow2", "sigmoid"]))
+    timesteps_grid = list(config.get("timesteps", [4, 8, 12, 18, 24, 32]))
+    guidance_scales = list(config.get("guidance_scales", [0, 1.75, 5]))
+    batch_size = config.get("batch_size", 8)
+    num_repeats = config.get("num_repeats", 1)
+    seed = config.get("seed", 0)
+    output_dir = config.get("output_dir", "schedule_benchmark")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(config.get("validation_prompts_file", "validation_prompts/fashion_prompts.txt"), "r") as f:
+        prompts = [p for p in f.read().splitlines() if len(p) != 0]
+
+    service = build_service(config, device)
+    scorer = CLIPScorer(config.get("quality_model", "openai/clip-vit-base-patch32"), device)
+
+    # warm-up so that the first sweep point does not pay for lazy initialization
+    service.generate_batch(prompts[:batch_size])
+
+    results = []
+    for schedule, timesteps, guidance_scale in tqdm(list(itertools.product(schedules, timesteps_grid, guidance_scales))):
+        service.mask_schedule = get_mask_chedule(schedule)
+        service.timesteps = timesteps
+        service.guidance_scale = guidance_scale
+
+        latencies, scores = [], []
+        for repeat in range(num_repeats):
+            torch.manual_seed(seed + repeat)
+            for i in range(0, len(prompts), batch_size):
+                batch_prompts = prompts[i:i + batch_size]
+                outputs = service.generate_batch(batch_prompts)
+                timings = outputs[0]["timings"]
+                latencies.append(timings["prompt"] + timings["generate"] + timings["decode"])
+                images = [Image.open(io.BytesIO(output["png"])).convert("RGB") for output in outputs]
+                scores.extend(scorer(images, batch_prompts))
+
+        results.append({
+            "schedule": schedule,
+            "timesteps": timesteps,
+            "guidance_scale": guidance_scale,
+            # seconds per batch of `batch_size` prompts
+            "latency": float(np.mean(latencies)),
+            "quality": float(np.mean(scores)),
+        })
+        print(results[-1])
+
+    frontier = pareto_frontier(results)
+    best = recommend(frontier, config.get("quality_tolerance", 0.01))
+
+    with open(os.path.join(output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    with open(os.path.join(output_dir, "pareto.json"), "w") as f:
+        json.dump(frontier, f, indent=2)
+
+    # top-level keys read by t2i_service.py, merge them into the serving config
+    serving_config = OmegaConf.create({
+        "mask_schedule": {"schedule": best["schedule"]},
+        "generation_timesteps": best["timesteps"],
+        "guidance_scale": best["guidance_scale"],
+    })
+    OmegaConf.save(serving_config, os.path.join(output_dir, "recommended.yaml"))
+
+    print("Pareto frontier (latency s/batch, CLIP score):")
+    for r in frontier:
+        print(f"  {r['schedule']:>8} steps={r['timesteps']:<3} cfg={r['guidance_scale']:<5} "
+              f"{r['latency']:.3f}s {r['quality']:.2f}")
+    print(f"Recommended: {OmegaConf.to_yaml(serving_config)}")
@@ -0,0 +1,98 @@
+# coding=utf-8
+# Copyright 2024 NUS Show Lab.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+from models import MAGVITv2
+
+
+def run_decode(kwargs, args, queue):
+    # every mode runs in a fresh process so that ru_maxrss only reflects that mode
+    torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+    if args.vq_model_name:
+        vq_model = MAGVITv2.from_pretrained(args.vq_model_name)
+    else:
+        vq_model = MAGVITv2()
+    vq_model = vq_model.to(device).eval()
+
+    num_tokens = (args.resolution // 16) ** 2
+    codes = torch.randint(0, vq_model.quantize.codebook_size, (args.batch_size, num_tokens), device=device,
+                          generator=torch.Generator(device=device).manual_seed(0))
+
+    with torch.no_grad():
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        images = vq_model.decode_code(codes, **kwargs)  # warm-up
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(args.num_iters):
+            images = vq_model.decode_code(codes, **kwargs)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+    queue.put({
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "model_rss_mb": baseline_rss / 1024,
+        "peak_cuda_mb": torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == "cuda" else 0.0,
+        "images_per_sec": args.batch_size * args.num_iters / elapsed,
+        "images": images.float().cpu(),
+    })
+
+
+if __name__ == '__main__':
+    # python benchmark_vq_decode.py --resolution 512 --batch_size 8 --tile_size 16 --tile_overlap 4 --batch_slice_size 2
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vq_model_name", type=str, default="", help="e.g. showlab/magvitv2; random init if empty")
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--tile_size", type=int, default=16)
+    parser.add_argument("--tile_overlap", type=int, default=4)
+    parser.add_argument("--batch_slice_size", type=int, default=2)
+    parser.add_argument("--num_iters", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    modes = {
+        "monolithic": {},
+        "batch_sliced": {"batch_slice_size": args.batch_slice_size},
+        "tiled": {"tile_size": args.tile_size, "tile_overlap": args.tile_overlap},
+        "tiled+batch_sliced": {"tile_size": args.tile_size, "tile_overlap": args.tile_overlap,
+                               "batch_slice_size": args.batch_slice_size},
+    }
+
+    ctx = mp.get_context("spawn")
+    results = {}
+    for name, kwargs in modes.items():
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_decode, args=(kwargs, args, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+
+    reference = results["monolithic"]["images"]
+    print(f"{'mode':>20} {'peak RSS (MB)':>14} {'decode RSS (MB)':>16} {'peak CUDA (MB)':>15} "
+          f"{'img/s':>8} {'max |diff|':>11}")
+    for name, result in results.items():
+        max_diff = (result["images"] - reference).abs().max().item()
+        print(f"{name:>20} {result['peak_rss_mb']:>14.1f} {result['peak_rss_mb'] - result['model_rss_mb']:>16.1f} "
+              f"{result['peak_cuda_mb']:>15.1f} {result['images_per_sec']:>8.2f} {max_diff:>11.4f}")
@@ -0,0 +1,247 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Sampler, default_collate
+
+from llava.llava_data_vq_unified import preprocess_v0, IGNORE_INDEX
+
+# FashionRec speakers -> the llava roles preprocess_v0 expects
+ROLES = {"human": "human", "user": "human", "gpt": "gpt", "assistant": "gpt"}
+
+
+def tokenize_conversation(conversation, tokenizer):
+    """Tokenize one FashionRec conversation with the phi1.5 template; labels only cover the assistant turns."""
+    source = [{"from": ROLES[turn["from"].lower()], "value": turn["value"]} for turn in conversation]
+    data_dict = preprocess_v0([source], tokenizer)
+    return data_dict["input_ids"][0], data_dict["labels"][0]
+
+
+class ConversationTokenCache:
+    """
+    Read side of the tokenized FashionRec conversation cache written by `build_conversation_cache`.
+
+    `<cache_dir>/<split>` holds flat int32 `input_ids.npy` / `labels.npy` arrays, an int64 `offsets.npy`
+    (conversation i spans `offsets[i]:offsets[i + 1]`) and `keys.json` (the "<tar rel path>/<json name>"
+    of every row). The arrays are memory-mapped on first use, so every DataLoader worker maps its own copy.
+    """
+    def __init__(self, cache_dir, data_root, split):
+        self.path = os.path.join(cache_dir, split)
+        self.data_root = data_root
+        self._arrays = None
+
+    def key(self, tar_path, json_name):
+        return f"{os.path.relpath(tar_path, self.data_root)}/{json_name}"
+
+    def _open(self):
+        if self._arrays is None:
+            input_ids, labels, offsets = (np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+                                          for name in ("input_ids", "labels", "offsets"))
+            with open(os.path.join(self.path, "keys.json"), 'r') as f:
+                rows = {key: i for i, key in enumerate(json.load(f))}
+            self._arrays = (input_ids, labels, offsets, rows)
+        return self._arrays
+
+    def get(self, tar_path, json_name):
+        """(input_ids, labels) of one conversation as LongTensors."""
+        input_ids, labels, offsets, rows = self._open()
+        i = rows[self.key(tar_path, json_name)]
+        start, end = int(offsets[i]), int(offsets[i + 1])
+        return (torch.from_numpy(input_ids[start:end].astype(np.int64)),
+                torch.from_numpy(labels[start:end].astype(np.int64)))
+
+    def lengths(self, keys):
+        """Token count of the conversation of every key, read without mapping the token arrays."""
+        offsets = np.load(os.path.join(self.path, "offsets.npy"))
+        with open(os.path.join(self.path, "keys.json"), 'r') as f:
+            rows = {key: i for i, key in enumerate(json.load(f))}
+        sizes = np.diff(offsets)
+        return [int(sizes[rows[key]]) for key in keys]
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "keys.json"))
+
+
+def build_conversation_cache(dataset, tokenizer, cache):
+    """Tokenize every conversation of a FashionRecDataset once and write `cache`'s arrays."""
+    os.makedirs(cache.path, exist_ok=True)
+    keys, input_ids, labels, offsets = [], [], [], [0]
+    for _, tar_path, json_name in dataset.samples:
+        data = json.loads(dataset.tar_reader.read(tar_path, *dataset.tar_members[tar_path][json_name]))
+        ids, targets = tokenize_conversation(data["conversation"], tokenizer)
+        keys.append(cache.key(tar_path, json_name))
+        input_ids.append(ids.numpy().astype(np.int32))
+        labels.append(targets.numpy().astype(np.int32))
+        offsets.append(offsets[-1] + len(ids))
+
+    arrays = {
+        "input_ids": np.concatenate(input_ids) if input_ids else np.zeros(0, dtype=np.int32),
+        "labels": np.concatenate(labels) if labels else np.zeros(0, dtype=np.int32),
+        "offsets": np.asarray(offsets, dtype=np.int64),
+    }
+    # keys.json is written last and marks the cache as complete
+    for name, array in arrays.items():
+        with open(os.path.join(cache.path, f"{name}.npy.tmp"), 'wb') as f:
+            np.save(f, array)
+        os.replace(os.path.join(cache.path, f"{name}.npy.tmp"), os.path.join(cache.path, f"{name}.npy"))
+    with open(os.path.join(cache.path, "keys.json.tmp"), 'w') as f:
+        json.dump(keys, f)
+    os.replace(os.path.join(cache.path, "keys.json.tmp"), os.path.join(cache.path, "keys.json"))
+
+
+def collate_conversations(instances, pad_id, max_length):
+    """
+    Pad (or truncate) the cached input_ids / labels to exactly `max_length`, the text length that
+    `UniversalPrompting.mmu_prompt` produces, so MMU rows line up with the t2i rows of the batch.
+    """
+    input_ids = torch.full((len(instances), max_length), pad_id, dtype=torch.long)
+    labels = torch.full((len(instances), max_length), IGNORE_INDEX, dtype=torch.long)
+    for i, instance in enumerate(instances):
+        length = min(len(instance["input_ids"]), max_length)
+        input_ids[i, :length] = instance["input_ids"][:length]
+        labels[i, :length] = instance["labels"][:length]
+    return {
+        "images": default_collate([instance["images"] for instance in instances]),
+        "input_ids": input_ids,
+        "labels": labels,
+    }
+
+
+def pack_rows(lengths, num_rows, row_length, decreasing=True):
+    """
+    First-fit (decreasing, unless `decreasing=False`) of segments of `lengths` tokens into rows of `row_length`.
+    Opens rows beyond `num_rows` only when the segments do not fit into `num_rows`; returns the segment indices
+    of every row.
+    """
+    rows, free = [[] for _ in range(num_rows)], [row_length] * num_rows
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i]) if decreasing else range(len(lengths))
+    for i in order:
+        row = next((row for row in range(len(rows)) if lengths[i] <= free[row]), None)
+        if row is None:
+            rows.append([])
+            free.append(row_length)
+            row = len(rows) - 1
+        rows[row].append(i)
+        free[row] -= lengths[i]
+    return rows
+
+
+class PackedBatchSampler(Sampler):
+    """
+    Groups the indices of `sampler` into batches of as many conversations as first-fit places into `num_rows`
+    MMU rows, from the cached conversation `lengths` of every dataset index. Only the free space of every row is
+    kept, so each index costs one scan over the rows. A conversation that does not fit starts the next batch,
+    so no sample is dropped and the number of rows stays `num_rows`; the closed batch is packed once, by
+    `collate_packed_conversations`.
+    """
+    def __init__(self, sampler, lengths, num_rows, max_length, num_image_tokens):
+        self.sampler = sampler
+        self.num_rows = num_rows
+        self.row_length = num_image_tokens + 3 + max_length
+        self.lengths = [num_image_tokens + 3 + min(length, max_length) for length in lengths]
+
+    def __iter__(self):
+        batch, free = [], [self.row_length] * self.num_rows
+        for idx in self.sampler:
+            length = self.lengths[idx]
+            row = next((row for row in range(self.num_rows) if length <= free[row]), None)
+            if row is None:
+                yield batch
+                batch, free, row = [], [self.row_length] * self.num_rows, 0
+            batch.append(idx)
+            free[row] -= length
+        if batch:
+            yield batch
+
+
+def collate_packed_conversations(instances, pad_id, max_length, num_image_tokens, num_rows, mmu_id, soi_id, eoi_id):
+    """
+    Bin-pack cached conversations into `num_rows` rows of the unpacked MMU row length
+    (`[mmu][soi][image tokens][eoi][max_length text tokens]`) with first-fit decreasing.
+
+    Every conversation keeps its own `[mmu][soi][image][eoi][text]` segment. The returned boolean
+    `attention_mask` (rows, 1, L, L) is block-diagonal over segments and matches
+    `create_attention_mask_for_mmu` inside each of them, and `position_ids` restart at 0 per segment.
+    Image tokens are left as padding; `image_positions` holds the (row, start) each row of "images" has
+    to be written to once encoded. When first-fit decreasing needs more than `num_rows` rows, first-fit in
+    the given order is used, which is how `PackedBatchSampler` closes its batches, so these always fit;
+    conversations that still do not fit get extra rows rather than being dropped.
+    """
+    prefix_length = num_image_tokens + 3
+    row_length = prefix_length + max_length
+    lengths = [prefix_length + min(len(instance["input_ids"]), max_length) for instance in instances]
+    rows = pack_rows(lengths, num_rows, row_length)
+    if len(rows) > num_rows:
+        rows = min(rows, pack_rows(lengths, num_rows, row_length, decreasing=False), key=len)
+    num_rows = len(rows)
+
+    input_ids = torch.full((num_rows, row_length), pad_id, dtype=torch.long)
+    labels = torch.full((num_rows, row_length), IGNORE_INDEX, dtype=torch.long)
+    position_ids = torch.zeros((num_rows, row_length), dtype=torch.long)
+    segment_ids = torch.zeros((num_rows, row_length), dtype=torch.long)
+    prefix_end = torch.zeros((num_rows, row_length), dtype=torch.long)
+    packed, image_positions = [], []
+    for row, members in enumerate(rows):
+        start = 0
+        for segment, i in enumerate(members, start=1):
+            text_length = lengths[i] - prefix_length
+            end = start + lengths[i]
+            input_ids[row, start] = mmu_id
+            input_ids[row, start + 1] = soi_id
+            input_ids[row, start + prefix_length - 1] = eoi_id
+            input_ids[row, start + prefix_length:end] = instances[i]["input_ids"][:text_length]
+            labels[row, start + prefix_length:end] = instances[i]["labels"][:text_length]
+            position_ids[row, start:end] = torch.arange(lengths[i])
+            segment_ids[row, start:end] = segment
+            prefix_end[row, start:end] = start + prefix_length - 1
+            packed.append(i)
+            image_positions.append((row, start + 2))
+            start = end
+
+    # (row, query, key): same segment, and either causal or inside the segment's [mmu][soi][image][eoi] prefix
+    positions = torch.arange(row_length)
+    attention_mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] > 0)
+    attention_mask &= (positions[None, None, :] <= positions[None, :, None]) | \
+                      (positions[None, None, :] <= prefix_end[:, :, None])
+    # padding only attends to itself so that no row of the mask is empty
+    attention_mask |= torch.eye(row_length, dtype=torch.bool)[None]
+
+    num_tokens = sum(lengths[i] for i in packed)
+    return {
+        "images": default_collate([instances[i]["images"] for i in packed]),
+        "input_ids": input_ids,
+        "labels": labels,
+        "attention_mask": attention_mask.unsqueeze(1),
+        "position_ids": position_ids,
+        "image_positions": torch.tensor(image_positions, dtype=torch.long).view(-1, 2),
+        "num_samples": len(instances),
+        # non-padding share of the packed rows, and of the rows the same conversations would fill unpacked
+        "padding_efficiency": num_tokens / (num_rows * row_length),
+        "unpacked_padding_efficiency": num_tokens / (len(packed) * row_length),
+    }
+
+
+if __name__ == '__main__':
+    # python conversation_token_cache.py config=configs/fashionm3_training.yaml
+    # writes <dataset.params.conversation_cache_dir>/{train,valid,test}
+    from transformers import AutoTokenizer
+    from training.utils import get_config
+    from training.prompting_utils import UniversalPrompting
+    from fashionrec_dataset import FashionRecDataset
+
+    config = get_config()
+    dataset_config = config.dataset.params
+
+    # same tokenizer state (pad + special tokens) as the training script
+    tokenizer = AutoTokenizer.from_pretrained(config.model.showo.llm_model_path, padding_side="left")
+    UniversalPrompting(tokenizer, max_text_len=config.dataset.preprocessing.max_seq_length,
+                       special_tokens=("<|soi|>", "<|eoi|>", "<|sov|>", "<|eov|>", "<|t2i|>",
+                                       "<|mmu|>", "<|t2v|>", "<|v2v|>", "<|lvg|>"),
+                       ignore_id=IGNORE_INDEX)
+
+    for split in ["train", "valid", "test"]:
+        dataset = FashionRecDataset(data_root=dataset_config.fashionrec_data_root, split=split)
+        cache = ConversationTokenCache(dataset_config.conversation_cache_dir, dataset_config.fashionrec_data_root,
+                                       split)
+        build_conversation_cache(dataset, tokenizer, cache)
+        print(f"{split}: {len(dataset)} conversations -> {cache.path}")
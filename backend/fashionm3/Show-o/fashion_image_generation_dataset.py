@@ -1,9 +1,73 @@
 import os
-import tarfile
 import io
+import json
+import tarfile
+import tempfile
+import numpy as np
 from PIL import Image
 import torch
 from torch.utils.data import Dataset
+from image_token_cache import ImageTokenCache
+from tar_index import load_tar_index, TarReader
+
+
+def _list_tars(split_path):
+    tar_names = sorted(f for f in os.listdir(split_path) if f.endswith('.tar'))
+    stats = [os.stat(os.path.join(split_path, name)) for name in tar_names]
+    return [[name, st.st_size, st.st_mtime] for name, st in zip(tar_names, stats)]
+
+
+def build_manifest(split_path):
+    """
+    Write the sample manifest of a split directory of tars.
+
+    - manifest.npy: int64 array of shape (num_samples, 5) with rows
+      (tar_id, image offset, image size, text offset, text size), offsets and sizes in bytes
+    - manifest.json: the tars the table was built from, as [name, size, mtime] rows indexed by tar_id
+    - manifest.names.json: image member name of every row, only read when the token cache is used
+    """
+    tars = _list_tars(split_path)
+    rows, names = [], []
+    for tar_id, (tar_name, _, _) in enumerate(tars):
+        members = load_tar_index(os.path.join(split_path, tar_name))
+        for txt_name, (txt_offset, txt_size) in members.items():
+            if not txt_name.endswith('.txt'):
+                continue
+            img_name = txt_name.replace('.txt', '.jpg')
+            if img_name not in members:
+                print(f"Missing image for {txt_name} in {tar_name}")
+                continue
+            img_offset, img_size = members[img_name]
+            rows.append((tar_id, img_offset, img_size, txt_offset, txt_size))
+            names.append(img_name)
+
+    table = np.asarray(rows, dtype=np.int64).reshape(-1, 5)
+    for filename, write in [
+        ("manifest.npy", lambda f: np.save(f, table)),
+        ("manifest.names.json", lambda f: f.write(json.dumps(names).encode('utf-8'))),
+        # written last: a manifest.json matching the tars marks the manifest as complete
+        ("manifest.json", lambda f: f.write(json.dumps({"tars": tars}).encode('utf-8'))),
+    ]:
+        # a temporary file of its own per writer, so concurrent builders never rename a half-written file
+        path = os.path.join(split_path, filename)
+        with tempfile.NamedTemporaryFile('wb', dir=split_path, prefix=filename, suffix=".tmp", delete=False) as f:
+            write(f)
+        os.replace(f.name, path)
+    return table
+
+
+def load_manifest(split_path):
+    """Memory-map the manifest of `split_path`, (re)building it if missing or if the tars changed."""
+    manifest_path = os.path.join(split_path, "manifest.json")
+    tars = _list_tars(split_path)
+    valid = False
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            valid = json.load(f)["tars"] == tars
+    if not valid:
+        build_manifest(split_path)
+    table = np.load(os.path.join(split_path, "manifest.npy"), mmap_mode='r')
+    return table, [name for name, _, _ in tars]
 
 
 class FashionImageGenerationDataset(Dataset):
@@ -19,20 +83,33 @@ class FashionImageGenerationDataset(Dataset):
     - Text files contain detailed product descriptions
     """
     
-    def __init__(self, data_root, split="train"):
+    def __init__(self, data_root, split="train", image_token_cache_dir=None, use_manifest=False):
         """
         Args:
             data_root (str): Path to fashion_image_generation directory
             split (str): Currently only supports "train" 
+            image_token_cache_dir (str): If set, "images" holds precomputed MAGVIT-v2 codes read
+                from this cache (see image_token_cache.py) instead of a decoded JPEG
+            use_manifest (bool): Memory-map the (tar_id, offset, size) manifest of the split
+                (built once by `build_manifest`) instead of indexing the tars at startup
         """
         self.data_root = data_root
         self.split = split
+        self.token_cache = ImageTokenCache(image_token_cache_dir, data_root) if image_token_cache_dir else None
         self.samples = []
+        self.manifest = None
+        self.tar_reader = TarReader()
+
+        if use_manifest:
+            split_path = os.path.join(self.data_root, self.split)
+            self.manifest, tar_names = load_manifest(split_path)
+            self.tar_paths = [os.path.join(split_path, name) for name in tar_names]
+            self._image_names = None
+        else:
+            # Load all samples from tar files
+            self._load_samples()
         
-        # Load all samples from tar files
-        self._load_samples()
-        
-        print(f"FashionImageGenerationDataset loaded {len(self.samples)} samples")
+        print(f"FashionImageGenerationDataset loaded {len(self)} samples")
     
     def _load_samples(self):
         """Load all image-text pairs from tar files"""
@@ -42,10 +119,11 @@ class FashionImageGenerationDataset(Dataset):
         split_path = os.path.join(self.data_root, self.split)
         for filename in os.listdir(split_path):
             if filename.endswith('.tar'):
-                tar_path = os.path.join(self.data_root, filename)
+                tar_path = os.path.join(split_path, filename)
                 tar_files.append(tar_path)
         
         tar_files.sort()  # Ensure consistent ordering
+        self.tar_paths = tar_files
         print(f"Found {len(tar_files)} tar files in {self.data_root}")
         
         # Extract all samples from each tar file
@@ -53,14 +131,16 @@ class FashionImageGenerationDataset(Dataset):
             try:
                 with tarfile.open(tar_path, 'r') as tar:
                     # Get all txt files (they define our samples)
-                    txt_files = [name for name in tar.getnames() if name.endswith('.txt')]
+                    names = tar.getnames()
+                    name_set = set(names)
+                    txt_files = [name for name in names if name.endswith('.txt')]
                     
                     for txt_name in txt_files:
                         # Corresponding image file
                         img_name = txt_name.replace('.txt', '.jpg')
                         
                         # Verify both files exist in tar
-                        if img_name in tar.getnames():
+                        if img_name in name_set:
                             self.samples.append((tar_path, img_name, txt_name))
                         else:
                             print(f"Missing image for {txt_name} in {tar_path}")
@@ -71,6 +151,8 @@ class FashionImageGenerationDataset(Dataset):
         print(f"Total samples loaded: {len(self.samples)}")
     
     def __len__(self):
+        if self.manifest is not None:
+            return len(self.manifest)
         return len(self.samples)
     
     def __getitem__(self, idx):
@@ -83,6 +165,9 @@ class FashionImageGenerationDataset(Dataset):
                 "input_ids": str description of the product
             }
         """
+        if self.manifest is not None:
+            return self._get_from_manifest(idx)
+
         tar_path, img_name, txt_name = self.samples[idx]
         
         # Load from tar file
@@ -100,6 +185,11 @@ class FashionImageGenerationDataset(Dataset):
                 description = "A fashion item."
             
             # Load image
+            if self.token_cache is not None:
+                return {
+                    "images": self.token_cache.get(tar_path, img_name),  # MAGVIT-v2 image tokens
+                    "input_ids": description
+                }
             try:
                 img_file = tar.extractfile(img_name)
                 if img_file:
@@ -122,6 +212,27 @@ class FashionImageGenerationDataset(Dataset):
         }
 
 
+    def _get_from_manifest(self, idx):
+        tar_id, img_offset, img_size, txt_offset, txt_size = self.manifest[idx].tolist()
+        tar_path = self.tar_paths[tar_id]
+        description = self.tar_reader.read(tar_path, txt_offset, txt_size).decode('utf-8').strip()
+
+        if self.token_cache is not None:
+            if self._image_names is None:
+                with open(os.path.join(self.data_root, self.split, "manifest.names.json"), 'r') as f:
+                    self._image_names = json.load(f)
+            image = self.token_cache.get(tar_path, self._image_names[idx])
+        else:
+            image = Image.open(io.BytesIO(self.tar_reader.read(tar_path, img_offset, img_size)))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+
+        return {
+            "images": image,
+            "input_ids": description
+        }
+
+
 def test_fashion_image_generation_dataset():
     """Test function to verify the dataset works correctly"""
     
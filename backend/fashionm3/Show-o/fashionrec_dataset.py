@@ -1,24 +1,36 @@
 import os 
 import json
-import tarfile
-from torch.utils.data import Dataset
+import math
+import torch
+from torch.utils.data import Dataset, Sampler
 from PIL import Image
 import io
 from typing import Dict, List, Tuple, Optional
+from image_token_cache import ImageTokenCache
+from conversation_token_cache import ConversationTokenCache
+from tar_index import load_tar_index, TarReader
 
 class FashionRecDataset(Dataset):
     """
     Dataset class for FashionRec recommendation tasks
     Handles Basic, Personalized, and Alternative recommendation data
     """
-    def __init__(self, data_root, split= "train", task_weights=None):
+    def __init__(self, data_root, split= "train", task_weights=None, image_token_cache_dir=None,
+                 conversation_cache_dir=None):
         """
           Args:
               data_root: Path to backend/data
               split: "train", "valid", or "test"
               task_weights: Dict with task sampling weights
+              image_token_cache_dir: If set, "images" holds precomputed MAGVIT-v2 codes read from
+                  this cache (see image_token_cache.py) instead of a decoded JPEG
+              conversation_cache_dir: If set, "input_ids" / "labels" are the pre-tokenized conversation
+                  read from this cache (see conversation_token_cache.py) instead of raw text
         """
         self.data_root = data_root
+        self.token_cache = ImageTokenCache(image_token_cache_dir, data_root) if image_token_cache_dir else None
+        self.conversation_cache = ConversationTokenCache(conversation_cache_dir, data_root, split) \
+            if conversation_cache_dir else None
         self.split = split
         self.task_weights = task_weights or {
           "basic_recommendation": 0.26,
@@ -26,36 +38,46 @@ class FashionRecDataset(Dataset):
           "alternative_recommendation": 0.11
         }
         self.samples = []
+        # tar_path -> {member name: (offset, size)}, see tar_index.py
+        self.tar_members = {}
+        self.tar_reader = TarReader()
         self._build_index()
     def __len__(self):
         return len(self.samples)
     def __getitem__(self, idx):
         task, tar_path, json_name = self.samples[idx]
-        with tarfile.open(tar_path, 'r') as tar:
-            json_file = tar.extractfile(json_name)
-            data = json.load(json_file)
-            image_name = json_name.replace('.json', '.jpg')
-            # Load the single corresponding image
-            try:
-                image_file = tar.extractfile(image_name)
-                if image_file:
-                    image = Image.open(io.BytesIO(image_file.read()))
-                else:
-                    print(f"Image file {image_name} not found in tar")
-                    image = None
-            except KeyError:
-                print(f"Missing corresponding image: {image_name}")
-                image = None
-            conversation_text = ""
-            conversation = data["conversation"]
-            for turn in conversation:
-                speaker = turn["from"]
-                message = turn["value"]
-                conversation_text += f"{speaker}: {message}\n"
+        members = self.tar_members[tar_path]
+        image_name = json_name.replace('.json', '.jpg')
+        # Load the single corresponding image
+        if self.token_cache is not None:
+            image = self.token_cache.get(tar_path, image_name)
+        elif image_name in members:
+            image = Image.open(io.BytesIO(self.tar_reader.read(tar_path, *members[image_name])))
+        else:
+            print(f"Missing corresponding image: {image_name}")
+            image = None
+        if self.conversation_cache is not None:
+            input_ids, labels = self.conversation_cache.get(tar_path, json_name)
+            return {
+                "images": image,
+                "input_ids": input_ids,  # phi1.5 template, tokenized once
+                "labels": labels         # IGNORE_INDEX outside the assistant turns
+            }
+        data = json.loads(self.tar_reader.read(tar_path, *members[json_name]))
+        conversation_text = ""
+        conversation = data["conversation"]
+        for turn in conversation:
+            speaker = turn["from"]
+            message = turn["value"]
+            conversation_text += f"{speaker}: {message}\n"
         return {
-            "images": image,                        # Single PIL Image
+            "images": image,                        # Single PIL Image, or image tokens when cached
             "input_ids": conversation_text.strip()  # Raw conversation text
         }
+    def conversation_lengths(self):
+        """Cached token count of every sample's conversation, without loading the samples."""
+        return self.conversation_cache.lengths([self.conversation_cache.key(tar_path, json_name)
+                                                for _, tar_path, json_name in self.samples])
     def _build_index(self):
         task_dirs = ["basic_recommendation", "personalized_recommendation", "alternative_recommendation"] 
         for task in task_dirs:
@@ -64,7 +86,71 @@ class FashionRecDataset(Dataset):
                 tar_files = [f for f in os.listdir(task_path) if f.endswith('.tar')]
                 for tar_filename in tar_files:
                     tar_path = os.path.join(task_path, tar_filename)
-                    with tarfile.open(tar_path, 'r') as tar:
-                        json_files = [name for name in tar.getnames() if name.endswith('.json')]
-                        for json_name in json_files:
-                            self.samples.append((task, tar_path, json_name))
\ No newline at end of file
+                    self.tar_members[tar_path] = load_tar_index(tar_path)
+                    json_files = [name for name in self.tar_members[tar_path] if name.endswith('.json')]
+                    for json_name in json_files:
+                        self.samples.append((task, tar_path, json_name))
+
+
+class TaskWeightedSampler(Sampler):
+    """
+    Samples FashionRecDataset indices by drawing a task according to `task_weights` first and then a
+    sample uniformly within that task (with replacement), so the task mix does not depend on file counts.
+
+    Every rank draws `ceil(num_samples / num_replicas)` indices per epoch from a generator seeded with
+    (seed, epoch, rank). Each pass over the sampler draws the next epoch, so a loader that is re-iterated
+    (e.g. by CombinedLoader in max_size_cycle mode, or ahead of training by a prefetcher) keeps getting
+    fresh draws. The first pass starts `num_consumed` indices into `epoch`, both set by `load_state_dict()`;
+    `state_dict(num_trained)` gives the position after `num_trained` more samples of this rank were trained
+    on, counted by the training loop rather than as indices are yielded (DataLoader workers fetch ahead).
+    """
+    def __init__(self, dataset, num_samples=None, num_replicas=1, rank=0, seed=0, task_weights=None):
+        task_weights = task_weights or dataset.task_weights
+        task_indices = {task: [] for task in task_weights}
+        for idx, (task, _, _) in enumerate(dataset.samples):
+            if task in task_indices:
+                task_indices[task].append(idx)
+        self.tasks = [task for task in task_weights if len(task_indices[task]) > 0]
+        if len(self.tasks) == 0:
+            raise ValueError("None of the weighted tasks has any samples")
+
+        # per-task index arrays, concatenated: task i owns indices[starts[i]:starts[i] + sizes[i]]
+        self.indices = torch.tensor(sum((task_indices[task] for task in self.tasks), []), dtype=torch.long)
+        self.sizes = torch.tensor([len(task_indices[task]) for task in self.tasks], dtype=torch.long)
+        self.starts = torch.cumsum(self.sizes, dim=0) - self.sizes
+        self.weights = torch.tensor([float(task_weights[task]) for task in self.tasks], dtype=torch.double)
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.num_samples = math.ceil((num_samples or len(dataset)) / num_replicas)
+        self.epoch = 0
+        self.num_consumed = 0
+        self._num_passes = 0
+
+    def _draw(self, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch * self.num_replicas + self.rank)
+        tasks = torch.multinomial(self.weights, self.num_samples, replacement=True, generator=generator)
+        offsets = (torch.rand(self.num_samples, generator=generator, dtype=torch.double)
+                   * self.sizes[tasks]).long()
+        return self.indices[self.starts[tasks] + offsets]
+
+    def __iter__(self):
+        start = self.num_consumed if self._num_passes == 0 else 0
+        indices = self._draw(self.epoch + self._num_passes)[start:].tolist()
+        self._num_passes += 1
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
+
+    def state_dict(self, num_trained=0):
+        """Position after `num_trained` samples of this rank were trained on since the loaded state."""
+        epochs, num_consumed = divmod(self.num_consumed + num_trained, self.num_samples)
+        return {"epoch": self.epoch + epochs, "num_consumed": num_consumed}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict["epoch"]
+        self._num_passes = 0
+        self.num_consumed = state_dict["num_consumed"]
\ No newline at end of file
@@ -0,0 +1,125 @@
+import os
+import io
+import json
+import tarfile
+import numpy as np
+import torch
+from PIL import Image
+
+
+class ImageTokenCache:
+    """
+    Read side of the precomputed MAGVIT-v2 token cache.
+
+    Every source tar `<data_root>/<rel>.tar` has two files under `cache_dir`:
+    - `<rel>.codes.npy`: uint16 array of shape (num_images, num_vq_tokens), memory-mapped on first use
+    - `<rel>.index.json`: list of the image member names, in row order
+    Shards are opened lazily, so every DataLoader worker maps its own copy.
+    """
+    def __init__(self, cache_dir, data_root):
+        self.cache_dir = cache_dir
+        self.data_root = data_root
+        self._shards = {}
+
+    def shard_paths(self, tar_path):
+        rel = os.path.splitext(os.path.relpath(tar_path, self.data_root))[0]
+        base = os.path.join(self.cache_dir, rel)
+        return base + ".codes.npy", base + ".index.json"
+
+    def _open(self, tar_path):
+        if tar_path not in self._shards:
+            codes_path, index_path = self.shard_paths(tar_path)
+            codes = np.load(codes_path, mmap_mode='r')
+            with open(index_path, 'r') as f:
+                rows = {name: i for i, name in enumerate(json.load(f))}
+            self._shards[tar_path] = (codes, rows)
+        return self._shards[tar_path]
+
+    def get(self, tar_path, image_name):
+        """Image tokens (without the text vocab offset) as a LongTensor of shape (num_vq_tokens,)."""
+        codes, rows = self._open(tar_path)
+        return torch.from_numpy(codes[rows[image_name]].astype(np.int64))
+
+    def __contains__(self, tar_path):
+        return all(os.path.exists(path) for path in self.shard_paths(tar_path))
+
+
+@torch.no_grad()
+def tokenize_tar(vq_model, tar_path, cache, resolution, batch_size=32, device="cpu", overwrite=False):
+    """Run `vq_model.get_code` over every .jpg in `tar_path` (read sequentially) and write its cache shard."""
+    from training.utils import image_transform
+
+    if tar_path in cache and not overwrite:
+        return
+    codes_path, index_path = cache.shard_paths(tar_path)
+    os.makedirs(os.path.dirname(codes_path), exist_ok=True)
+
+    names, codes, pixel_values = [], [], []
+
+    def flush():
+        batch = torch.stack(pixel_values).to(device)
+        codes.append(vq_model.get_code(batch).cpu().numpy().astype(np.uint16))
+        pixel_values.clear()
+
+    with tarfile.open(tar_path, 'r') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.jpg'):
+                continue
+            image = Image.open(io.BytesIO(tar.extractfile(member).read())).convert('RGB')
+            pixel_values.append(image_transform(image, resolution=resolution))
+            names.append(member.name)
+            if len(pixel_values) == batch_size:
+                flush()
+    if len(pixel_values) > 0:
+        flush()
+    if len(names) == 0:
+        return
+
+    # write to temporary files first so that an interrupted run never leaves a truncated shard behind
+    with open(codes_path + ".tmp", 'wb') as f:
+        np.save(f, np.concatenate(codes, axis=0))
+    with open(index_path + ".tmp", 'w') as f:
+        json.dump(names, f)
+    os.replace(codes_path + ".tmp", codes_path)
+    os.replace(index_path + ".tmp", index_path)
+
+
+if __name__ == '__main__':
+    # python image_token_cache.py config=configs/fashionm3_training.yaml
+    # writes <dataset.params.image_token_cache_dir>/{fashionrec,fashion_image_generation}/...
+    from tqdm import tqdm
+    from models import MAGVITv2
+    from training.utils import get_config
+    from fashionrec_dataset import FashionRecDataset
+    from fashion_image_generation_dataset import FashionImageGenerationDataset
+
+    config = get_config()
+    dataset_config = config.dataset.params
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    vq_model = MAGVITv2.from_pretrained(config.model.vq_model.vq_model_name).to(device)
+    vq_model.requires_grad_(False)
+    vq_model.eval()
+
+    cache_dir = dataset_config.image_token_cache_dir
+    resolution = config.dataset.preprocessing.resolution
+    batch_size = config.get("batch_size", 32)
+
+    tar_sets = []
+    for split in ["train", "valid", "test"]:
+        dataset = FashionRecDataset(data_root=dataset_config.fashionrec_data_root, split=split)
+        tar_sets.append((os.path.join(cache_dir, "fashionrec"), dataset_config.fashionrec_data_root,
+                         sorted(dataset.tar_members)))
+    for split in ["train", "test"]:
+        if not os.path.isdir(os.path.join(dataset_config.train_t2i_shards_path_or_url, split)):
+            continue
+        dataset = FashionImageGenerationDataset(data_root=dataset_config.train_t2i_shards_path_or_url, split=split,
+                                                use_manifest=True)
+        tar_sets.append((os.path.join(cache_dir, "fashion_image_generation"),
+                         dataset_config.train_t2i_shards_path_or_url, dataset.tar_paths))
+
+    for sub_cache_dir, data_root, tar_paths in tar_sets:
+        cache = ImageTokenCache(sub_cache_dir, data_root)
+        for tar_path in tqdm(tar_paths, desc=sub_cache_dir):
+            tokenize_tar(vq_model, tar_path, cache, resolution, batch_size=batch_size, device=device,
+                         overwrite=config.get("overwrite", False))
@@ -77,6 +77,9 @@ if __name__ == '__main__':
     config.training.generation_timesteps = config.generation_timesteps
     # load from users passed arguments
 
+    # mask_aware_sampler=True only runs the LM head over still-masked image tokens at each step
+    t2i_generate = model.t2i_generate_masked if config.get("mask_aware_sampler", False) else model.t2i_generate
+
     if config.mode == 'inpainting':
 
         prompt = [config.prompt] * config.batch_size
@@ -137,7 +140,7 @@ if __name__ == '__main__':
             mask_schedule = get_mask_chedule(config.training.get("mask_schedule", "cosine"))
 
         with torch.no_grad():
-            gen_token_ids = model.t2i_generate(
+            gen_token_ids = t2i_generate(
                 input_ids=input_ids,
                 uncond_input_ids=uncond_input_ids,
                 attention_mask=attention_mask,
@@ -244,7 +247,7 @@ if __name__ == '__main__':
                 mask_schedule = get_mask_chedule(config.training.get("mask_schedule", "cosine"))
 
             with torch.no_grad():
-                gen_token_ids = model.t2i_generate(
+                gen_token_ids = t2i_generate(
                     input_ids=input_ids,
                     uncond_input_ids=uncond_input_ids,
                     attention_mask=attention_mask,
@@ -318,7 +321,7 @@ if __name__ == '__main__':
                 mask_schedule = get_mask_chedule(config.training.get("mask_schedule", "cosine"))
 
             with torch.no_grad():
-                gen_token_ids = model.t2i_generate(
+                gen_token_ids = t2i_generate(
                     input_ids=input_ids,
                     uncond_input_ids=uncond_input_ids,
                     attention_mask=attention_mask,
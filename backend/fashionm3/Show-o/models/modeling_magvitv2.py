@@ -426,12 +426,75 @@ class MAGVITv2(ModelMixin, ConfigMixin):
 
         return codebook_indices
 
-    def decode_code(self, codebook_indices, shape=None):
+    def decode_code(self, codebook_indices, shape=None, tile_size=None, tile_overlap=4, batch_slice_size=None):
+        """
+        Decode codebook indices into pixels. By default the whole latent grid of the whole batch is decoded
+        at once. `batch_slice_size` decodes that many samples at a time, and `tile_size` (in latent tokens)
+        decodes overlapping `tile_size x tile_size` latent tiles whose outputs are blended with linear
+        feathering over the `tile_overlap` seam, so that peak activation memory is bounded by the tile size
+        instead of the image size. The decoder's mid attention and GroupNorms then only see one tile, so
+        tiled outputs are close to, but not bit-identical with, the monolithic decode.
+        """
         z_q = self.quantize.get_codebook_entry(codebook_indices, shape=shape)
-
-        reconstructed_pixel_values = self.decoder(z_q)["output"]
+        if tile_size is None and batch_slice_size is None:
+            reconstructed_pixel_values = self.decoder(z_q)["output"]
+            return reconstructed_pixel_values
+
+        batch_slice_size = batch_slice_size or z_q.shape[0]
+        reconstructed_pixel_values = None
+        for i in range(0, z_q.shape[0], batch_slice_size):
+            if tile_size is None:
+                decoded = self.decoder(z_q[i:i + batch_slice_size])["output"]
+            else:
+                decoded = self._tiled_decode(z_q[i:i + batch_slice_size], tile_size, tile_overlap)
+            if reconstructed_pixel_values is None:
+                reconstructed_pixel_values = decoded.new_empty((z_q.shape[0],) + decoded.shape[1:])
+            reconstructed_pixel_values[i:i + batch_slice_size] = decoded
         return reconstructed_pixel_values
 
+    def _tiled_decode(self, z_q, tile_size, tile_overlap):
+        _, _, h, w = z_q.shape
+        if h <= tile_size and w <= tile_size:
+            return self.decoder(z_q)["output"]
+
+        scale = 2 ** (self.decoder.num_resolutions - 1)
+        stride = max(tile_size - tile_overlap, 1)
+
+        def tile_starts(size):
+            if size <= tile_size:
+                return [0]
+            starts = list(range(0, size - tile_size + 1, stride))
+            if starts[-1] != size - tile_size:
+                starts.append(size - tile_size)
+            return starts
+
+        def feather(start, length, size, device):
+            # linear ramp over the overlap on sides that touch another tile, flat on image borders
+            ramp = torch.ones(length * scale, device=device)
+            overlap = min(tile_overlap, length) * scale
+            if overlap > 0:
+                edge = torch.arange(1, overlap + 1, device=device, dtype=ramp.dtype) / (overlap + 1)
+                if start > 0:
+                    ramp[:overlap] = edge
+                if start + length < size:
+                    ramp[-overlap:] = torch.minimum(ramp[-overlap:], edge.flip(0))
+            return ramp
+
+        output, weight = None, None
+        for y in tile_starts(h):
+            th = min(tile_size, h)
+            ramp_y = feather(y, th, h, z_q.device)
+            for x in tile_starts(w):
+                tw = min(tile_size, w)
+                tile = self.decoder(z_q[:, :, y:y + th, x:x + tw])["output"]
+                if output is None:
+                    output = tile.new_zeros(tile.shape[:2] + (h * scale, w * scale))
+                    weight = tile.new_zeros((1, 1, h * scale, w * scale))
+                mask = (ramp_y[:, None] * feather(x, tw, w, z_q.device)[None, :]).to(tile.dtype)
+                output[:, :, y * scale:(y + th) * scale, x * scale:(x + tw) * scale] += tile * mask
+                weight[:, :, y * scale:(y + th) * scale, x * scale:(x + tw) * scale] += mask
+        return output / weight
+
 
 if __name__ == '__main__':
     encoder = VQGANEncoder()
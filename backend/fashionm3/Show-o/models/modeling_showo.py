@@ -15,9 +15,10 @@
 
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers import AutoConfig
 from .modeling_utils import ConfigMixin, ModelMixin, register_to_config
-from .sampling import cosine_schedule, mask_by_random_topk
+from .sampling import cosine_schedule, mask_by_random_topk, mask_by_topk_cutoff, gumbel_noise, log
 from .phi import PhiForCausalLM
 
 class Showo(ModelMixin, ConfigMixin):
@@ -56,11 +57,33 @@ class Showo(ModelMixin, ConfigMixin):
     def _set_gradient_checkpointing(self, module, value=False):
         self.gradient_checkpointing = True
 
+    def _lm_head_loss_sum(self, hidden_states, labels):
+        return F.cross_entropy(self.showo.lm_head(hidden_states).float(), labels, reduction='sum')
+
+    def chunked_cross_entropy(self, hidden_states, labels, chunk_size=1024):
+        """
+        Mean cross-entropy of `lm_head(hidden_states)` against `labels` (ignore_index=-100), computed only at
+        the labelled positions, `chunk_size` of them at a time. Every chunk is checkpointed, so at most one
+        chunk of logits exists at a time in the forward and in the backward pass.
+        """
+        hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+        labels = labels.reshape(-1)
+        positions = labels.ne(-100).nonzero(as_tuple=True)[0]
+        hidden_states, labels = hidden_states[positions], labels[positions]
+
+        loss = hidden_states.new_zeros((), dtype=torch.float32)
+        for start in range(0, labels.shape[0], chunk_size):
+            loss = loss + checkpoint(self._lm_head_loss_sum, hidden_states[start:start + chunk_size],
+                                     labels[start:start + chunk_size], use_reentrant=False)
+        # same as F.cross_entropy's mean reduction, including nan when nothing is labelled
+        return loss / labels.shape[0]
+
     def forward(
             self,
             input_ids,
             input_embeddings=None,
             attention_mask=None,
+            position_ids=None,
             labels=None,
             label_smoothing=0.0,
             batch_size_t2i=0,
@@ -69,13 +92,45 @@ class Showo(ModelMixin, ConfigMixin):
             max_seq_length=128,
             labels_mask_text=None,
             labels_mask_image=None,
+            fused_loss=False,
+            loss_chunk_size=1024,
+            return_logits=True,
             **kwargs,
     ):
+        """
+        With `fused_loss`, the three losses are computed from the final hidden states by
+        `chunked_cross_entropy` and the (B, L, vocab_size) logits are never materialized for the loss.
+        The logits are then only computed (without gradient) when `return_logits` is set, e.g. for
+        visualization, and None is returned in their place otherwise.
+        """
+        if labels is not None and fused_loss:
+            if input_embeddings is None:
+                hidden_states = self.showo.model(input_ids=input_ids, attention_mask=attention_mask,
+                                                 position_ids=position_ids)[0]
+            else:
+                hidden_states = self.showo.model(inputs_embeds=input_embeddings, attention_mask=attention_mask,
+                                                 position_ids=position_ids)[0]
+
+            loss_t2i = self.chunked_cross_entropy(hidden_states[:batch_size_t2i, max_seq_length + 1:],
+                                                  labels[:batch_size_t2i, max_seq_length + 1:], loss_chunk_size)
+            loss_lm = self.chunked_cross_entropy(hidden_states[batch_size_t2i:batch_size_t2i + batch_size_lm, :-1],
+                                                 labels[batch_size_t2i:batch_size_t2i + batch_size_lm, 1:],
+                                                 loss_chunk_size)
+            loss_mmu = self.chunked_cross_entropy(hidden_states[-batch_size_mmu:, :-1],
+                                                  labels[-batch_size_mmu:, 1:], loss_chunk_size)
+
+            logits = None
+            if return_logits:
+                with torch.no_grad():
+                    logits = self.showo.lm_head(hidden_states)
+            return logits, loss_t2i, loss_lm, loss_mmu
 
         if input_embeddings is None:
-            logits = self.showo(input_ids=input_ids, attention_mask=attention_mask)['logits']
+            logits = self.showo(input_ids=input_ids, attention_mask=attention_mask,
+                                position_ids=position_ids)['logits']
         else:
-            logits = self.showo(inputs_embeds=input_embeddings, attention_mask=attention_mask)['logits']
+            logits = self.showo(inputs_embeds=input_embeddings, attention_mask=attention_mask,
+                                position_ids=position_ids)['logits']
 
         if labels is not None:
             # 1. Mask token prediction (discrete diffusion) for image generation
@@ -180,6 +235,88 @@ class Showo(ModelMixin, ConfigMixin):
 
         return sampled_ids
 
+    @torch.no_grad()
+    def t2i_generate_masked(
+            self,
+            input_ids: torch.LongTensor = None,
+            uncond_input_ids: torch.LongTensor = None,
+            attention_mask=None,
+            temperature=1.0,
+            timesteps=18,
+            guidance_scale=0,
+            noise_schedule=cosine_schedule,
+            generator: torch.Generator = None,
+            config=None,
+            **kwargs,
+    ):
+        """
+        Mask-aware variant of `t2i_generate`. Only the image positions that are still masked go through
+        the LM head (restricted to the image codebook), softmax and multinomial sampling, and the
+        re-masking cut-off uses `topk`/`kthvalue` instead of a full sort. Per-step buffers are allocated
+        once, so late steps with few masked tokens are much cheaper. Same arguments and return value as
+        `t2i_generate`.
+        """
+        mask_token_id = self.config.mask_token_id
+        num_vq_tokens = config.model.showo.num_vq_tokens
+        vq_offset = config.model.showo.llm_vocab_size + config.model.showo.num_new_special_tokens
+        max_seq_length = config.dataset.preprocessing.max_seq_length
+        batch_size, device = input_ids.shape[0], input_ids.device
+
+        # LM head restricted to the image codebook (the last row is the mask token)
+        vq_weight = self.showo.lm_head.weight[vq_offset:-1]
+        vq_bias = self.showo.lm_head.bias[vq_offset:-1] if self.showo.lm_head.bias is not None else None
+
+        use_cfg = uncond_input_ids is not None and guidance_scale > 0
+        if use_cfg:
+            uncond_prefix = uncond_input_ids[:, :max_seq_length + 1]
+
+        image_ids = input_ids[:, -(num_vq_tokens + 1):-1]
+        unknown_map = image_ids == mask_token_id
+        # buffers reused across steps; known positions of sampled_ids keep their given codes
+        sampled_ids = torch.where(unknown_map, 0, image_ids - vq_offset)
+        confidence = torch.empty((batch_size, num_vq_tokens), dtype=torch.float32, device=device)
+        min_mask_len = torch.tensor([1], device=device)
+
+        for step in range(timesteps):
+            if use_cfg:
+                uncond_input_ids = torch.cat([uncond_prefix, input_ids[:, max_seq_length + 1:]], dim=1)
+                model_input = torch.cat([input_ids, uncond_input_ids])
+            else:
+                model_input = input_ids
+            hidden_states = self.showo.model(input_ids=model_input, attention_mask=attention_mask)[0]
+            hidden_states = hidden_states[:, -(num_vq_tokens + 1):-1]
+
+            masked_positions = unknown_map.nonzero(as_tuple=True)
+            if use_cfg:
+                cond_hidden, uncond_hidden = hidden_states.chunk(2)
+                masked_hidden = torch.cat([cond_hidden[masked_positions], uncond_hidden[masked_positions]])
+                cond_logits, uncond_logits = F.linear(masked_hidden, vq_weight, vq_bias).float().chunk(2)
+                logits = (1 + guidance_scale) * cond_logits - guidance_scale * uncond_logits
+            else:
+                logits = F.linear(hidden_states[masked_positions], vq_weight, vq_bias).float()
+
+            probs = logits.softmax(dim=-1)
+            masked_sampled_ids = torch.multinomial(probs, 1, generator=generator)[:, 0]
+            sampled_ids[masked_positions] = masked_sampled_ids
+            selected_probs = torch.gather(probs, -1, masked_sampled_ids[:, None])[:, 0]
+
+            ratio = 1.0 * (step + 1) / timesteps
+            mask_ratio = noise_schedule(torch.tensor(ratio))
+            mask_len = (num_vq_tokens * mask_ratio).floor().unsqueeze(0).to(device)
+            mask_len = torch.max(min_mask_len, torch.min(unknown_map.sum(dim=-1, keepdim=True) - 1, mask_len))
+
+            # Known tokens keep the maximum confidence so they are never masked again.
+            temperature = temperature * (1.0 - ratio)
+            confidence.fill_(torch.finfo(confidence.dtype).max)
+            confidence[masked_positions] = log(selected_probs) + temperature * gumbel_noise(selected_probs,
+                                                                                            generator=generator)
+            masking = mask_by_topk_cutoff(mask_len, confidence)
+
+            input_ids[:, -(num_vq_tokens + 1):-1] = torch.where(masking, mask_token_id, sampled_ids + vq_offset)
+            unknown_map = masking
+
+        return sampled_ids
+
     @torch.no_grad()
     def mmu_generate(self, idx=None, input_embeddings=None, attention_mask=None, max_new_tokens=100, temperature=1.0, top_k=None, eot_token=None):
         """
@@ -36,6 +36,21 @@ def mask_by_random_topk(mask_len, probs, temperature=1.0, generator=None):
     return masking
 
 
+def mask_by_topk_cutoff(mask_len, confidence):
+    """
+    Same cut-off as `mask_by_random_topk` for an already noised `confidence`, but only the
+    `mask_len + 1` lowest entries of each row are selected with `topk` instead of sorting the row.
+    """
+    mask_len = mask_len.long()
+    if mask_len.numel() == 1:
+        cut_off = torch.kthvalue(confidence, int(mask_len) + 1, dim=-1, keepdim=True).values
+    else:
+        lowest = torch.topk(confidence, int(mask_len.max()) + 1, dim=-1, largest=False, sorted=True).values
+        cut_off = torch.gather(lowest, 1, mask_len)
+    masking = confidence < cut_off
+    return masking
+
+
 def cosine_schedule(t):
     return torch.cos(t * math.pi * 0.5)
 
@@ -0,0 +1,114 @@
+import os
+import json
+import math
+import random
+
+import webdataset as wds
+from tqdm import tqdm
+
+from fashionrec_dataset import FashionRecDataset
+from fashion_image_generation_dataset import FashionImageGenerationDataset
+
+
+def balanced_boundaries(num_samples, samples_per_shard, shard_multiple=1):
+    """Split `num_samples` into shards whose sizes differ by at most one sample.
+
+    The shard count is rounded up to a multiple of `shard_multiple` (e.g. world size x workers) so that
+    the shards split evenly across ranks and DataLoader workers.
+    """
+    num_shards = max(1, math.ceil(num_samples / samples_per_shard))
+    num_shards = math.ceil(num_shards / shard_multiple) * shard_multiple
+    num_shards = min(num_shards, max(num_samples, 1))
+    return [round(i * num_samples / num_shards) for i in range(num_shards + 1)]
+
+
+def write_shards(samples, read_sample, output_dir, prefix, samples_per_shard, shard_multiple=1, seed=0):
+    """
+    Write `samples` in a seeded random order as sequential WebDataset shards
+    `<output_dir>/<prefix>-NNNNNN.tar`. Returns the brace pattern and the shard sizes.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    order = list(range(len(samples)))
+    random.Random(seed).shuffle(order)
+    boundaries = balanced_boundaries(len(samples), samples_per_shard, shard_multiple)
+
+    for shard_id in tqdm(range(len(boundaries) - 1), desc=f"{output_dir}/{prefix}"):
+        with wds.TarWriter(os.path.join(output_dir, f"{prefix}-{shard_id:06d}.tar")) as sink:
+            for i in order[boundaries[shard_id]:boundaries[shard_id + 1]]:
+                sink.write(read_sample(samples[i]))
+
+    num_shards = len(boundaries) - 1
+    pattern = os.path.join(output_dir, f"{prefix}-{{000000..{num_shards - 1:06d}}}.tar")
+    shard_sizes = [boundaries[i + 1] - boundaries[i] for i in range(num_shards)]
+    return pattern, shard_sizes
+
+
+def reshard_fashionrec(data_root, output_dir, split, samples_per_shard, shard_multiple=1, seed=0):
+    dataset = FashionRecDataset(data_root=data_root, split=split)
+
+    def read_sample(sample):
+        task, tar_path, json_name = sample
+        members = dataset.tar_members[tar_path]
+        image_name = json_name.replace('.json', '.jpg')
+        data = dataset.tar_reader.read(tar_path, *members[json_name])
+        return {
+            "__key__": f"{os.path.splitext(os.path.basename(tar_path))[0]}_{os.path.splitext(json_name)[0]}",
+            "jpg": dataset.tar_reader.read(tar_path, *members[image_name]),
+            "json": data,
+            # same text FashionRecDataset returns as "input_ids"
+            "txt": "\n".join(f"{turn['from']}: {turn['value']}" for turn in json.loads(data)["conversation"]).strip(),
+        }
+
+    index = {}
+    for task in dataset.task_weights:
+        samples = [sample for sample in dataset.samples
+                   if sample[0] == task and sample[2].replace('.json', '.jpg') in dataset.tar_members[sample[1]]]
+        if len(samples) == 0:
+            continue
+        pattern, shard_sizes = write_shards(samples, read_sample, os.path.join(output_dir, "fashionrec", task),
+                                            split, samples_per_shard, shard_multiple, seed)
+        index[task] = {"pattern": pattern, "num_samples": len(samples), "shard_sizes": shard_sizes}
+    return index
+
+
+def reshard_fashion_image_generation(data_root, output_dir, split, samples_per_shard, shard_multiple=1, seed=0):
+    dataset = FashionImageGenerationDataset(data_root=data_root, split=split, use_manifest=True)
+
+    def read_sample(i):
+        tar_id, img_offset, img_size, txt_offset, txt_size = dataset.manifest[i].tolist()
+        tar_path = dataset.tar_paths[tar_id]
+        return {
+            "__key__": f"{tar_id:06d}_{i:09d}",
+            "jpg": dataset.tar_reader.read(tar_path, img_offset, img_size),
+            "txt": dataset.tar_reader.read(tar_path, txt_offset, txt_size),
+        }
+
+    pattern, shard_sizes = write_shards(list(range(len(dataset))), read_sample,
+                                        os.path.join(output_dir, "fashion_image_generation"), split,
+                                        samples_per_shard, shard_multiple, seed)
+    return {"pattern": pattern, "num_samples": len(dataset), "shard_sizes": shard_sizes}
+
+
+if __name__ == '__main__':
+    # python reshard_fashion_data.py config=configs/fashionm3_training.yaml samples_per_shard=2000 shard_multiple=32
+    # writes <dataset.params.fashion_wds_root>/shards.json next to the shards, read by train_fashionm3.py
+    from training.utils import get_config
+
+    config = get_config()
+    dataset_config = config.dataset.params
+    output_dir = dataset_config.fashion_wds_root
+    samples_per_shard = config.get("samples_per_shard", 2000)
+    shard_multiple = config.get("shard_multiple", 1)
+    seed = config.get("seed", 0)
+
+    shards = {"fashionrec": {}, "fashion_image_generation": {}}
+    for split in ["train", "test"]:
+        shards["fashionrec"][split] = reshard_fashionrec(dataset_config.fashionrec_data_root, output_dir, split,
+                                                         samples_per_shard, shard_multiple, seed)
+        if os.path.isdir(os.path.join(dataset_config.train_t2i_shards_path_or_url, split)):
+            shards["fashion_image_generation"][split] = reshard_fashion_image_generation(
+                dataset_config.train_t2i_shards_path_or_url, output_dir, split, samples_per_shard, shard_multiple,
+                seed)
+
+    with open(os.path.join(output_dir, "shards.json"), 'w') as f:
+        json.dump(shards, f, indent=2)
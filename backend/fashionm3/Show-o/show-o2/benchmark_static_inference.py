@@ -0,0 +1,89 @@
+import time
+
+import torch
+from models import Showo2Qwen2_5, StaticShowo2T2I
+from models.misc import get_text_tokenizer, prepare_gen_input
+from utils import get_config, get_hyper_params, path_to_llm_name
+
+
+def step_latency(t2i_generate, z, t, guidance_scale, num_iters):
+    # one ODE step = one call of the velocity function
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        v = t2i_generate(image_latents=z, t=t, guidance_scale=guidance_scale)
+    return (time.perf_counter() - start) / num_iters, v
+
+
+if __name__ == '__main__':
+    # python benchmark_static_inference.py config=configs/showo2_1.5b_demo_432x432.yaml batch_size=1 \
+    #     num_warmup=3 num_iters=10 num_threads=16
+    config = get_config()
+    device = torch.device("cpu")
+    weight_type = torch.bfloat16 if config.model.weight_type == "bfloat16" else torch.float32
+    batch_size = config.get("batch_size", 1)
+    num_warmup = config.get("num_warmup", 3)
+    num_iters = config.get("num_iters", 10)
+    guidance_scale = config.get("guidance_scale", config.transport.guidance_scale)
+    if config.get("num_threads", None) is not None:
+        torch.set_num_threads(config.num_threads)
+
+    text_tokenizer, showo_token_ids = get_text_tokenizer(config.model.showo.llm_model_path,
+                                                         add_showo_tokens=True,
+                                                         return_showo_token_ids=True,
+                                                         llm_name=path_to_llm_name[config.model.showo.llm_model_path])
+    config.model.showo.llm_vocab_size = len(text_tokenizer)
+    model = Showo2Qwen2_5.from_pretrained(config.model.showo.pretrained_model_path, use_safetensors=False).to(device)
+    model.to(weight_type)
+    model.eval()
+
+    if config.model.showo.add_time_embeds:
+        config.dataset.preprocessing.num_t2i_image_tokens += 1
+        config.dataset.preprocessing.num_mmu_image_tokens += 1
+        config.dataset.preprocessing.num_video_tokens += 1
+
+    num_t2i_image_tokens, num_mmu_image_tokens, num_video_tokens, max_seq_len, max_text_len, image_latent_dim, \
+    patch_size, latent_width, latent_height, pad_id, bos_id, eos_id, boi_id, eoi_id, bov_id, eov_id, img_pad_id, \
+    vid_pad_id, _ = get_hyper_params(config, text_tokenizer, showo_token_ids)
+
+    with open(config.dataset.params.validation_prompts_file, "r") as f:
+        prompts = f.read().splitlines()
+    # two prompt batches of different lengths: the compiled step must be reused for the second one
+    prompt_batches = [prompts[:batch_size], prompts[batch_size:2 * batch_size] or prompts[:batch_size][::-1]]
+
+    num_sequences = batch_size * (2 if guidance_scale > 0 else 1)
+    z = torch.randn((num_sequences, image_latent_dim, latent_height * patch_size, latent_width * patch_size),
+                    generator=torch.Generator().manual_seed(0)).to(weight_type)
+    t = torch.full((num_sequences,), 0.5)
+
+    results = {}
+    with torch.no_grad():
+        for name, compile in [("eager", False), ("compiled", True)]:
+            static = StaticShowo2T2I(model, num_sequences, latent_height, latent_width, max_text_len, max_seq_len,
+                                     compile=compile)
+            timings = []
+            for batch_prompts in prompt_batches:
+                text_tokens, text_tokens_null, modality_positions, modality_positions_null = prepare_gen_input(
+                    batch_prompts, text_tokenizer, num_t2i_image_tokens, bos_id, eos_id, boi_id, eoi_id, pad_id,
+                    img_pad_id, max_text_len, device
+                )
+                if guidance_scale > 0:
+                    text_tokens = torch.cat([text_tokens, text_tokens_null], dim=0)
+                    modality_positions = torch.cat([modality_positions, modality_positions_null], dim=0)
+                static.prepare(text_tokens, modality_positions)
+
+                start = time.perf_counter()
+                step_latency(static.t2i_generate, z, t, guidance_scale, num_warmup)
+                warmup = time.perf_counter() - start
+                seconds, v = step_latency(static.t2i_generate, z, t, guidance_scale, num_iters)
+                timings.append((warmup, seconds, v))
+            results[name] = timings
+
+    resolution = config.dataset.preprocessing.resolution
+    print(f"{resolution}x{resolution}, batch {batch_size}, cfg {guidance_scale}, {torch.get_num_threads()} threads")
+    print(f"{'':>9} {'prompts':>8} {'warm-up s':>10} {'ms / step':>10} {'speed-up':>9}")
+    for name, timings in results.items():
+        for i, (warmup, seconds, _) in enumerate(timings):
+            baseline = results["eager"][i][1]
+            print(f"{name:>9} {i:>8} {warmup:>10.2f} {seconds * 1000:>10.1f} {baseline / seconds:>8.2f}x")
+    difference = (results["eager"][-1][2].float() - results["compiled"][-1][2].float()).abs()
+    print(f"max |velocity difference| {difference.max().item():.4f}, mean {difference.mean().item():.5f}")
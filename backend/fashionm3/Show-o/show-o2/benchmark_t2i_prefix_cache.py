@@ -0,0 +1,110 @@
+import time
+
+import torch
+from models import Showo2Qwen2_5, omni_attn_mask_compact
+from models.misc import get_text_tokenizer, prepare_gen_input
+from transport import Sampler, create_transport
+from utils import get_config, get_hyper_params, path_to_llm_name
+
+
+def sample(sampler, config, z, model, model_kwargs, num_iters):
+    sample_fn = sampler.sample_ode(
+        sampling_method=config.transport.sampling_method,
+        num_steps=config.transport.num_inference_steps,
+        atol=config.transport.atol,
+        rtol=config.transport.rtol,
+        reverse=config.transport.reverse,
+        time_shifting_factor=config.transport.time_shifting_factor
+    )
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        kwargs = dict(model_kwargs)
+        if kwargs.pop('prefix_cache', False):
+            kwargs['prefix_cache'] = model.build_t2i_prefix_cache(**kwargs)
+        samples = sample_fn(z, model.t2i_generate, **kwargs)[-1]
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters, samples
+
+
+if __name__ == '__main__':
+    # python benchmark_t2i_prefix_cache.py config=configs/showo2_1.5b_demo_432x432.yaml batch_size=4 num_iters=3
+    config = get_config()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    weight_type = torch.bfloat16 if config.model.weight_type == "bfloat16" else torch.float32
+    batch_size = config.get("batch_size", 4)
+    num_iters = config.get("num_iters", 3)
+    guidance_scale = config.get("guidance_scale", config.transport.guidance_scale)
+    config.transport.num_inference_steps = config.get("num_inference_steps", 50)
+
+    text_tokenizer, showo_token_ids = get_text_tokenizer(config.model.showo.llm_model_path,
+                                                         add_showo_tokens=True,
+                                                         return_showo_token_ids=True,
+                                                         llm_name=path_to_llm_name[config.model.showo.llm_model_path])
+    config.model.showo.llm_vocab_size = len(text_tokenizer)
+    model = Showo2Qwen2_5.from_pretrained(config.model.showo.pretrained_model_path, use_safetensors=False).to(device)
+    model.to(weight_type)
+    model.eval()
+
+    if config.model.showo.add_time_embeds:
+        config.dataset.preprocessing.num_t2i_image_tokens += 1
+        config.dataset.preprocessing.num_mmu_image_tokens += 1
+        config.dataset.preprocessing.num_video_tokens += 1
+
+    num_t2i_image_tokens, num_mmu_image_tokens, num_video_tokens, max_seq_len, max_text_len, image_latent_dim, \
+    patch_size, latent_width, latent_height, pad_id, bos_id, eos_id, boi_id, eoi_id, bov_id, eov_id, img_pad_id, \
+    vid_pad_id, _ = get_hyper_params(config, text_tokenizer, showo_token_ids)
+
+    transport = create_transport(
+        path_type=config.transport.path_type,
+        prediction=config.transport.prediction,
+        loss_weight=config.transport.loss_weight,
+        train_eps=config.transport.train_eps,
+        sample_eps=config.transport.sample_eps,
+        snr_type=config.transport.snr_type,
+        do_shift=config.transport.do_shift,
+        seq_len=num_t2i_image_tokens,
+    )
+    sampler = Sampler(transport)
+
+    with open(config.dataset.params.validation_prompts_file, "r") as f:
+        prompts = f.read().splitlines()[:batch_size]
+
+    text_tokens, text_tokens_null, modality_positions, modality_positions_null = prepare_gen_input(
+        prompts, text_tokenizer, num_t2i_image_tokens, bos_id, eos_id, boi_id, eoi_id, pad_id, img_pad_id,
+        max_text_len, device
+    )
+    z = torch.randn((len(prompts), image_latent_dim, latent_height * patch_size, latent_width * patch_size),
+                    generator=torch.Generator().manual_seed(0)).to(torch.bfloat16).to(device)
+    if guidance_scale > 0:
+        z = torch.cat([z, z], dim=0)
+        text_tokens = torch.cat([text_tokens, text_tokens_null], dim=0)
+        modality_positions = torch.cat([modality_positions, modality_positions_null], dim=0)
+    block_mask = omni_attn_mask_compact(text_tokens.size(0), max_seq_len, modality_positions, device)
+
+    model_kwargs = dict(
+        text_tokens=text_tokens,
+        attention_mask=block_mask,
+        modality_positions=modality_positions,
+        output_hidden_states=True,
+        max_seq_len=max_seq_len,
+        guidance_scale=guidance_scale
+    )
+
+    with torch.no_grad():
+        results = {}
+        for name, use_cache in [("full sequence", False), ("prefix cache", True)]:
+            sample(sampler, config, z, model, dict(model_kwargs, prefix_cache=use_cache), 1)  # warm-up
+            results[name] = sample(sampler, config, z, model, dict(model_kwargs, prefix_cache=use_cache), num_iters)
+
+    resolution = config.dataset.preprocessing.resolution
+    print(f"{resolution}x{resolution}, {config.transport.num_inference_steps} steps, batch {len(prompts)}, "
+          f"cfg {guidance_scale}")
+    print(f"{'':>14} {'s / batch':>10} {'speed-up':>9}")
+    baseline = results["full sequence"][0]
+    for name, (seconds, _) in results.items():
+        print(f"{name:>14} {seconds:>10.2f} {baseline / seconds:>8.2f}x")
+    difference = (results["full sequence"][1] - results["prefix cache"][1]).abs()
+    print(f"max |latent difference| {difference.max().item():.4f}, mean {difference.mean().item():.5f}")
@@ -0,0 +1,53 @@
+import time
+
+import torch
+from models import WanVAE
+from utils import get_config
+
+
+def timed(fn, x, num_iters):
+    fn(x)  # warm-up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        out = fn(x)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters, out
+
+
+def per_image(fn):
+    # the behaviour of per_sample/per_decode before images got a batched path: one call per sample
+    return lambda x: torch.cat([fn(x[i][None]) for i in range(x.shape[0])], dim=0)
+
+
+if __name__ == '__main__':
+    # python benchmark_wan_vae.py config=configs/showo2_1.5b_demo_432x432.yaml batch_sizes=[1,4,8,16] num_iters=5
+    config = get_config()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    weight_type = torch.bfloat16 if config.model.weight_type == "bfloat16" else torch.float32
+    batch_sizes = list(config.get("batch_sizes", [1, 4, 8, 16]))
+    num_iters = config.get("num_iters", 5)
+    resolution = config.dataset.preprocessing.resolution
+
+    vae_model = WanVAE(vae_pth=config.model.vae_model.pretrained_model_path, dtype=weight_type, device=device)
+
+    def encode(x):
+        return vae_model.per_sample(x, deterministic=True)
+
+    print(f"{resolution}x{resolution} images, {weight_type}")
+    print(f"{'batch':>5} {'stage':>7} {'per-sample img/s':>17} {'batched img/s':>14} {'speed-up':>9}")
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            images = torch.randn((batch_size, 3, 1, resolution, resolution),
+                                 generator=torch.Generator().manual_seed(0)).to(device)
+            loop_seconds, latents = timed(per_image(encode), images, num_iters)
+            batched_seconds, _ = timed(encode, images, num_iters)
+            print(f"{batch_size:>5} {'encode':>7} {batch_size / loop_seconds:>17.2f} "
+                  f"{batch_size / batched_seconds:>14.2f} {loop_seconds / batched_seconds:>8.2f}x")
+
+            loop_seconds, _ = timed(per_image(vae_model.per_decode), latents, num_iters)
+            batched_seconds, _ = timed(vae_model.per_decode, latents, num_iters)
+            print(f"{batch_size:>5} {'decode':>7} {batch_size / loop_seconds:>17.2f} "
+                  f"{batch_size / batched_seconds:>14.2f} {loop_seconds / batched_seconds:>8.2f}x")
@@ -1,4 +1,5 @@
 from .mixed_dataloader import MixedDataLoader
+from .prefetch_loader import PrefetchLoader
 from .image_text_dataset import create_imagetext_dataloader
 from .imagenet_dataset import create_imagenet_dataloader
 from .mmu_dataset import MMUDataset
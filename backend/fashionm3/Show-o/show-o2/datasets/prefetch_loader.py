@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+_END = object()
+
+
+def _map_tensors(fn, data):
+    if isinstance(data, torch.Tensor):
+        return fn(data)
+    elif isinstance(data, dict):
+        return {k: _map_tensors(fn, v) for k, v in data.items()}
+    elif isinstance(data, tuple):
+        return tuple(_map_tensors(fn, v) for v in data)
+    elif isinstance(data, list):
+        return [_map_tensors(fn, v) for v in data]
+    return data
+
+
+class PrefetchLoader:
+    """
+    Wraps a loader (e.g. MixedDataLoader) and keeps up to `num_prefetch` batches in flight.
+
+    A background thread pulls batches from `loader` in order and hands them to `num_threads` pinning
+    threads, so host-side collation and the copy into page-locked memory overlap with the training step.
+    On CUDA, the host-to-device copy of the next batch is issued on a side stream while the current one
+    is being used; every yielded batch already lives on `device` and is safe to use on the current stream.
+    On CPU-only runs batches are only prefetched in the background.
+
+    `stats()` returns the time the training loop spent waiting for data and the fraction of the loop
+    time during which loading was hidden ("data_overlap"), since the last call.
+    """
+    def __init__(self, loader, device, num_prefetch=2, num_threads=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.num_threads = num_threads
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        self._wait_time = 0.0
+        self._loop_time = 0.0
+        self._num_batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _pin(self, batch):
+        if not self.use_cuda:
+            return batch
+        return _map_tensors(lambda t: t.pin_memory(), batch)
+
+    def _to_device(self, batch):
+        if not self.use_cuda:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return _map_tensors(lambda t: t.to(self.device, non_blocking=True), batch)
+
+    def _produce(self, pool, in_flight, stop):
+        try:
+            for batch in self.loader:
+                future = pool.submit(self._pin, batch)
+                while not stop.is_set():
+                    try:
+                        in_flight.put(future, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            in_flight.put(_END)
+        except BaseException as e:
+            in_flight.put(e)
+
+    def _next(self, in_flight):
+        start = time.perf_counter()
+        item = in_flight.get()
+        if isinstance(item, BaseException):
+            raise item
+        if item is not _END:
+            item = self._to_device(item.result())
+        self._wait_time += time.perf_counter() - start
+        return item
+
+    def __iter__(self):
+        in_flight = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=self.num_threads)
+        producer = threading.Thread(target=self._produce, args=(pool, in_flight, stop), daemon=True)
+        producer.start()
+
+        try:
+            next_batch = self._next(in_flight)
+            while next_batch is not _END:
+                batch = next_batch
+                if self.use_cuda:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_stream(self.stream)
+                    # the copies were allocated on the side stream, keep them alive until the step is done
+                    _map_tensors(lambda t: t.record_stream(current_stream), batch)
+                # issue the copy of the following batch before handing this one out
+                next_batch = self._next(in_flight)
+
+                resumed = time.perf_counter()
+                yield batch
+                self._loop_time += time.perf_counter() - resumed
+                self._num_batches += 1
+        finally:
+            stop.set()
+            pool.shutdown(wait=False)
+
+    def stats(self, reset=True):
+        loop_time = self._loop_time + self._wait_time
+        stats = {
+            "data_wait": self._wait_time / max(self._num_batches, 1),
+            "data_overlap": 1.0 - self._wait_time / loop_time if loop_time > 0 else 0.0,
+        }
+        if reset:
+            self._wait_time = 0.0
+            self._loop_time = 0.0
+            self._num_batches = 0
+        return stats
@@ -21,7 +21,7 @@ import wandb
 import torch
 from tqdm import tqdm
 from accelerate.logging import get_logger
-from models import Showo2Qwen2_5, omni_attn_mask, omni_attn_mask_naive
+from models import Showo2Qwen2_5, omni_attn_mask, omni_attn_mask_naive, omni_attn_mask_compact
 from models.misc import get_text_tokenizer, prepare_mixed_modal_gen_input
 from utils import get_config, flatten_omega_conf, denorm, get_hyper_params, path_to_llm_name, load_state_dict, set_seed
 from torch.nn.attention.flex_attention import flex_attention, create_block_mask
@@ -141,10 +141,8 @@ if __name__ == '__main__':
             input_ids = text_tokenizer(text_history, add_special_tokens=False).input_ids
 
             if "<|image_pad|>" in text_history:
-                attention_mask = omni_attn_mask_naive(
-                                                      config.batch_size, len(input_ids),
-                                                      modality_positions_history,
-                                                      device).to(torch.bfloat16)
+                attention_mask = omni_attn_mask_compact(config.batch_size, len(input_ids),
+                                                        modality_positions_history, device)
 
                 response = model.mm_generate(
                     input_ids=input_ids,
@@ -215,17 +213,13 @@ if __name__ == '__main__':
                     text_tokens = torch.cat([batch_text_tokens, batch_text_tokens_null], dim=0)
                     modality_positions = torch.cat([batch_modality_positions,
                                                     batch_modality_positions_null], dim=0)
-                    block_mask = omni_attn_mask_naive(
-                                                        text_tokens.shape[0], text_tokens.shape[1],
-                                                        modality_positions,
-                                                        device).to(torch.bfloat16)
+                    block_mask = omni_attn_mask_compact(text_tokens.shape[0], text_tokens.shape[1],
+                                                        modality_positions, device)
                 else:
                     text_tokens = batch_text_tokens
                     modality_positions = batch_modality_positions
-                    block_mask = omni_attn_mask_naive(
-                                                        text_tokens.shape[0], text_tokens.shape[1],
-                                                        modality_positions,
-                                                        device).to(torch.bfloat16)
+                    block_mask = omni_attn_mask_compact(text_tokens.shape[0], text_tokens.shape[1],
+                                                        modality_positions, device)
 
                 model_kwargs = dict(
                     text_tokens=text_tokens,
@@ -20,7 +20,7 @@ import wandb
 import torch
 from tqdm import tqdm
 from accelerate.logging import get_logger
-from models import Showo2Qwen2_5, omni_attn_mask, omni_attn_mask_naive
+from models import Showo2Qwen2_5, ImageFeatureCache, omni_attn_mask, omni_attn_mask_naive, omni_attn_mask_compact
 from models.misc import get_text_tokenizer, prepare_gen_input
 from utils import get_config, flatten_omega_conf, denorm, get_hyper_params, path_to_llm_name, load_state_dict, set_seed
 from torch.nn.attention.flex_attention import flex_attention, create_block_mask
@@ -102,6 +102,13 @@ if __name__ == '__main__':
     role_a = text_tokenizer("\n<|im_start|>user\n", add_special_tokens=False)['input_ids']
     role_b = text_tokenizer("\n<|im_start|>assistant\n", add_special_tokens=False)['input_ids']
 
+    # fused image embeddings of images that were already asked about, e.g. image_feature_cache_dtype=int8
+    storage_dtype = config.get("image_feature_cache_dtype", None)
+    image_feature_cache = ImageFeatureCache(
+        max_bytes=config.get("image_feature_cache_mb", 1024) * 1024 ** 2,
+        storage_dtype=getattr(torch, storage_dtype) if storage_dtype in ("bfloat16", "float16") else storage_dtype
+    )
+
     for step, image_path in enumerate(tqdm(file_list)):
         image_ori = Image.open(image_path).convert("RGB")
         # not center cropping
@@ -112,13 +119,11 @@ if __name__ == '__main__':
         image = image_transform(image_ori, resolution=config.dataset.preprocessing.resolution).to(device)
         image = image.unsqueeze(0)
 
-        image_latents = vae_model.sample(image.unsqueeze(2)).squeeze(2).to(weight_type)
-
-        image_embeds_und = model.image_embedder_und(image_latents)
-        image_embeds_gen = model.image_embedder_gen(image_latents)
-        image_embeds_und = image_embeds_und + model.position_embedding(model.image_position_ids)
-        image_embeds_und = model.und_trans(image_embeds_und)['last_hidden_state']
-        image_embeds = model.fusion_proj(torch.cat([image_embeds_und, image_embeds_gen], dim=-1))
+        image_key = ImageFeatureCache.image_key(image_ori, config.dataset.preprocessing.resolution)
+        image_latents = None
+        if image_key not in image_feature_cache:
+            image_latents = vae_model.sample(image.unsqueeze(2)).squeeze(2).to(weight_type)
+        image_embeds = model.und_image_embeds(image_latents, image_feature_cache, [image_key])
 
         batch_size = 1
         responses = ['' for j in range(len(file_list))]
@@ -151,12 +156,12 @@ if __name__ == '__main__':
                 ], dim=1).to(weight_type)
                 modality_positions = torch.tensor([text_tokens_a.shape[1] + 1, num_mmu_image_tokens])[None, None, :].to(device)
 
-            attention_mask = omni_attn_mask_naive(
+            attention_mask = omni_attn_mask_compact(
                 B=input_embeds.size(0),
                 LEN=input_embeds.size(1),
                 modalities=modality_positions,
-                device=device, inverted=True
-            ).to(input_embeds.dtype)
+                device=device
+            )
 
             output_tokens = model.mmu_generate(input_embeds=input_embeds,
                                                      attention_mask=attention_mask,
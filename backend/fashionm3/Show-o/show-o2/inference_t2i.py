@@ -20,7 +20,7 @@ import wandb
 import torch
 from tqdm import tqdm
 from accelerate.logging import get_logger
-from models import Showo2Qwen2_5, omni_attn_mask, omni_attn_mask_naive
+from models import Showo2Qwen2_5, omni_attn_mask, omni_attn_mask_naive, omni_attn_mask_compact
 from models.misc import get_text_tokenizer, prepare_gen_input
 from utils import get_config, flatten_omega_conf, denorm, get_hyper_params, path_to_llm_name, load_state_dict
 from torch.nn.attention.flex_attention import flex_attention, create_block_mask
@@ -146,10 +146,10 @@ if __name__ == '__main__':
             # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
             #                                KV_LEN=max_seq_len, device=device)
             # or use naive omni attention mask, which is more stable
-            block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                              max_seq_len,
-                                              modality_positions,
-                                              device).to(weight_type)
+            block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                                max_seq_len,
+                                                modality_positions,
+                                                device)
         else:
             text_tokens = batch_text_tokens
             modality_positions = batch_modality_positions
@@ -158,10 +158,10 @@ if __name__ == '__main__':
             # omni_mask_fn = omni_attn_mask(modality_positions)
             # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
             #                                KV_LEN=max_seq_len, device=device)
-            block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                              max_seq_len,
-                                              modality_positions,
-                                              device).to(weight_type)
+            block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                                max_seq_len,
+                                                modality_positions,
+                                                device)
 
         model_kwargs = dict(
             text_tokens=text_tokens,
@@ -171,6 +171,9 @@ if __name__ == '__main__':
             max_seq_len=max_seq_len,
             guidance_scale=guidance_scale
         )
+        if config.get("prefix_cache", True):
+            # the prompt is run once, every ODE step only runs the image positions
+            model_kwargs['prefix_cache'] = model.build_t2i_prefix_cache(**model_kwargs)
 
         sample_fn = sampler.sample_ode(
             sampling_method=config.transport.sampling_method,
@@ -185,7 +188,10 @@ if __name__ == '__main__':
 
         if config.model.vae_model.type == 'wan21':
             samples = samples.unsqueeze(2)
-            images = vae_model.batch_decode(samples)
+            # e.g. vae_decode_memory_gb=4 decodes high resolutions in spatial tiles that fit the budget
+            memory_budget = config.get("vae_decode_memory_gb", None)
+            images = vae_model.batch_decode(samples, memory_budget=None if memory_budget is None
+                                            else memory_budget * 1024 ** 3)
             images = images.squeeze(2)
         else:
             raise NotImplementedError
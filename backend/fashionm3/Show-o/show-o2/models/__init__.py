@@ -1,4 +1,6 @@
 from .modeling_showo2_qwen2_5 import Showo2Qwen2_5
 from .modeling_semantic_layers import ShowoSemanticLayers
-from .omni_attention import omni_attn_mask, omni_attn_mask_naive, causal, causal_attn_mask_naive
-from .wan21_vae import WanVAE
\ No newline at end of file
+from .omni_attention import omni_attn_mask, omni_attn_mask_naive, omni_attn_mask_compact, causal, causal_attn_mask_naive
+from .wan21_vae import WanVAE
+from .image_feature_cache import ImageFeatureCache
+from .static_inference import StaticShowo2T2I
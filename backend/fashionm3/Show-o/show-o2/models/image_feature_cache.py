@@ -0,0 +1,94 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+class ImageFeatureCache:
+    """
+    LRU cache of the fused understanding embeddings of images (the output of `fusion_proj`), so that repeated
+    questions about the same image skip the VAE encode and the semantic layers.
+
+    Entries are keyed by `image_key(image, resolution)` and stored on their original device, either as they
+    are (`storage_dtype=None`), cast to a floating dtype (e.g. torch.bfloat16) or as "int8" with one symmetric
+    scale per token. Least recently used entries are evicted once the stored bytes exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=1 << 30, storage_dtype=None):
+        assert storage_dtype is None or storage_dtype == "int8" or isinstance(storage_dtype, torch.dtype)
+        self.max_bytes = max_bytes
+        self.storage_dtype = storage_dtype
+        self._entries = OrderedDict()  # key -> (values, scales or None, dtype)
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def image_key(image, resolution):
+        """
+        Content hash of `image` (a PIL image, a tensor or encoded bytes) and the resolution it is processed at.
+        """
+        if isinstance(image, (bytes, bytearray)):
+            data = bytes(image)
+        elif isinstance(image, torch.Tensor):
+            data = image.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes()
+        else:
+            data = f"{image.mode}{image.size}".encode() + image.tobytes()
+        return f"{hashlib.sha1(data).hexdigest()}_{resolution}"
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        values, scales, dtype = entry
+        if scales is not None:
+            return values.to(dtype) * scales.to(dtype)
+        return values.to(dtype)
+
+    def put(self, key, embeds):
+        """
+        Store the embeddings (num_tokens, dim) of one image.
+        """
+        if key in self._entries:
+            self._remove(key)
+        dtype = embeds.dtype
+        embeds = embeds.detach()
+        scales = None
+        if self.storage_dtype == "int8":
+            scales = embeds.float().abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / 127
+            values = (embeds.float() / scales).round_().clamp_(-127, 127).to(torch.int8)
+        elif self.storage_dtype is not None:
+            values = embeds.to(self.storage_dtype)
+        else:
+            values = embeds.clone()
+        num_bytes = self._nbytes(values, scales)
+        if num_bytes > self.max_bytes:
+            return
+        while self.num_bytes + num_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        self._entries[key] = (values, scales, dtype)
+        self.num_bytes += num_bytes
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+    def _remove(self, key):
+        values, scales, _ = self._entries.pop(key)
+        self.num_bytes -= self._nbytes(values, scales)
+
+    @staticmethod
+    def _nbytes(values, scales):
+        num_bytes = values.numel() * values.element_size()
+        if scales is not None:
+            num_bytes += scales.numel() * scales.element_size()
+        return num_bytes
@@ -18,15 +18,41 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 from transformers import AutoConfig
+from transformers.cache_utils import Cache, DynamicCache
 from torch.nn.attention.flex_attention import BlockMask
 from .misc import velocity_prediction, next_token_prediction, interpolate_pos_encoding
 from .modeling_siglip import SiglipModel
 from .modeling_utils import ConfigMixin, ModelMixin, register_to_config
 from .modules import DiffusionHeadConfig
 from .modules import ModulatedAttentionBlock, RMSNorm, PatchEmbed, TimestepEmbedder, FinalLayer
+from .modules import modality_index, modality_first_index, scatter_modality, gather_modality
 from .qwen2 import Qwen2ForCausalLM
 
 
+class PrefixKVCache(Cache):
+    """
+    Key/value states of a fixed prefix, recorded by one forward pass and then prepended to the keys/values of
+    every later pass without being extended, so the same prefix can be reused by any number of ODE steps.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.key_cache = []
+        self.value_cache = []
+        self.frozen = False
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if not self.frozen:
+            self.key_cache.append(key_states)
+            self.value_cache.append(value_states)
+            return key_states, value_states
+        return (torch.cat([self.key_cache[layer_idx], key_states], dim=-2),
+                torch.cat([self.value_cache[layer_idx], value_states], dim=-2))
+
+    def get_seq_length(self, layer_idx=0):
+        return self.key_cache[layer_idx].shape[-2] if len(self.key_cache) > layer_idx else 0
+
+
 class Showo2Qwen2_5(ModelMixin, ConfigMixin):
     _supports_gradient_checkpointing = True
 
@@ -157,25 +183,48 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
             imgs = x.reshape(shape=(x.shape[0], T, h * p * w * p, c))
         return imgs
 
-    def forward_und_only(
-            self,
-            text_tokens=None,
-            image_latents=None,
-            t=None,
-            attention_mask=None,
-            text_masks=None,
-            image_masks=None,
-            text_labels=None,
-            image_labels=None,
-            modality_positions=None,
-            output_hidden_states=True,
-            max_seq_len=None,
-            device='cuda:0',
-            **kwargs,
-    ):
+    def _scatter_image_embeds(self, input_embeds, image_embeds, time_embeds_proj, modality_positions):
+        """
+        Place the image (and time) embeddings of every slot of `modality_positions` into `input_embeds` with
+        one scatter each, without any host sync or shape that depends on the slot lengths.
+        """
+        seq_len = input_embeds.shape[1]
+        if self.config.add_time_embeds:
+            # the time embedding takes the first position of every slot (idle slots included, length = 0)
+            input_embeds = scatter_modality(input_embeds, time_embeds_proj[:, None],
+                                            modality_first_index(modality_positions, seq_len)[:, None])
+            # length - 1 because we add 1 to the num_image_tokens when add_time_embeds=True
+            image_index = modality_index(modality_positions, seq_len, image_embeds.shape[1], skip=1)
+        else:
+            image_index = modality_index(modality_positions, seq_len, image_embeds.shape[1])
+        return scatter_modality(input_embeds, image_embeds, image_index)
+
+    def und_image_embeds(self, image_latents, image_feature_cache=None, image_keys=None):
+        """
+        Fused understanding embeddings (b, L, D) of `image_latents` (images or videos), i.e. `fusion_proj` of
+        the semantic layer features and the generation patch embeddings.
+
+        With an `ImageFeatureCache` and one key per sample in `image_keys`, cached samples are looked up and
+        only the others are computed (and stored), so `image_latents` may be None if every key is cached.
+        """
+        if image_feature_cache is None or image_keys is None:
+            return self._und_image_embeds(image_latents)
+        cached = [image_feature_cache.get(key) for key in image_keys]
+        missing = [i for i, embeds in enumerate(cached) if embeds is None]
+        if len(missing) > 0:
+            if image_latents is None:
+                raise ValueError(f"image_latents are required for the uncached images {missing}")
+            if len(missing) < len(image_keys):
+                image_latents = image_latents[missing]
+            for i, embeds in zip(missing, self._und_image_embeds(image_latents)):
+                image_feature_cache.put(image_keys[i], embeds)
+                cached[i] = embeds
+        dtype = self.showo.model.embed_tokens.weight.dtype
+        return torch.stack(cached).to(dtype)
+
+    def _und_image_embeds(self, image_latents):
         T = 0
-        input_embeds = self.showo.model.embed_tokens(text_tokens)
-        dtype = input_embeds.dtype
+        dtype = self.showo.model.embed_tokens.weight.dtype
         if len(image_latents.shape) != 4:
             b, c, T, h, w = image_latents.shape
         else:
@@ -218,24 +267,45 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
             image_embeds_und = rearrange(image_embeds_und, 'b t l d -> b (t l) d')
 
         # spatial (-temporal) fusion
-        image_embeds = self.fusion_proj(torch.cat([image_embeds_und, image_embeds_gen], dim=-1))
+        return self.fusion_proj(torch.cat([image_embeds_und, image_embeds_gen], dim=-1))
 
-        time_embeds = self.time_embed(t, dtype)
+    def _und_input_embeds(self, text_tokens, image_latents, t, modality_positions, image_feature_cache=None,
+                          image_keys=None):
+        """
+        Embed `text_tokens` and place the understanding embeddings of `image_latents` (images or videos) into
+        the slots of `modality_positions`.
+        """
+        input_embeds = self.showo.model.embed_tokens(text_tokens)
+        image_embeds = self.und_image_embeds(image_latents, image_feature_cache, image_keys)
+
+        time_embeds = self.time_embed(t, input_embeds.dtype)
         if hasattr(self, 'time_embed_proj'):
             time_embeds_proj = self.time_embed_proj(time_embeds)
         else:
             time_embeds_proj = time_embeds
 
-        for i, modality_batch in enumerate(modality_positions):
-            for j, (offset, length) in enumerate(modality_batch):
-                if self.config.add_time_embeds:
-                    input_embeds[i, offset] = time_embeds_proj[i * modality_positions.size(1) + j]
-                    # length - 1 because we add 1 to the num_image_tokens when add_time_embeds=True
-                    # it's necessary to include :length-1, as sometimes we may skip some idle images when length=0
-                    input_embeds[i, offset + 1:offset + 1 + length - 1] = \
-                        image_embeds[i * modality_positions.size(1) + j, :max(length - 1, 0)]
-                else:
-                    input_embeds[i, offset:offset + length] = image_embeds[i * modality_positions.size(1) + j, :length]
+        return self._scatter_image_embeds(input_embeds, image_embeds, time_embeds_proj, modality_positions)
+
+    def forward_und_only(
+            self,
+            text_tokens=None,
+            image_latents=None,
+            t=None,
+            attention_mask=None,
+            text_masks=None,
+            image_masks=None,
+            text_labels=None,
+            image_labels=None,
+            modality_positions=None,
+            output_hidden_states=True,
+            max_seq_len=None,
+            device='cuda:0',
+            image_feature_cache=None,
+            image_keys=None,
+            **kwargs,
+    ):
+        input_embeds = self._und_input_embeds(text_tokens, image_latents, t, modality_positions,
+                                              image_feature_cache, image_keys)
 
         outputs = self.showo(
             inputs_embeds=input_embeds,
@@ -285,45 +355,10 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
             else:
                 b, c, h, w = image_latents.shape
 
-            # go through dual-path extraction
-            if T == 0:
-                image_embeds_und = self.image_embedder_und(image_latents.to(dtype))
-                image_embeds_gen = self.image_embedder_gen(image_latents.to(dtype))
-            else:
-                # (B, C, T, H, W) --> (BT, C, H, W)
-                image_latents = rearrange(image_latents, 'b c t h w -> (b t) c h w')
-                # (BT, C, H, W) --> (BT, L=H/p*W/p, D)
-                image_embeds_und = self.image_embedder_und(image_latents.to(dtype))
-                image_embeds_und = image_embeds_und.reshape(b, T, -1, self.config.clip_latent_dim)
-                image_embeds_und = rearrange(image_embeds_und, 'b t l d -> (b t) l d')
-
-                image_embeds_gen = self.image_embedder_gen(image_latents.to(dtype))
-                image_embeds_gen = image_embeds_gen.reshape(b, T, -1, self.config.hidden_size)
-                image_embeds_gen = rearrange(image_embeds_gen, 'b t l d -> b (t l) d')
-
-            # go through semantic layers
+            # dual-path extraction, semantic layers and spatial (-temporal) fusion
+            image_embeds = self._und_image_embeds(image_latents)
             p = self.config.patch_size
             h_, w_ = h // p, w // p
-            # specific for fixed resolution of 432x432
-            if self.position_embedding.weight.shape[-1] == self.image_position_ids.shape[-1]:
-                image_embeds_und = image_embeds_und + self.position_embedding(self.image_position_ids)
-                image_embeds_und = self.und_trans(image_embeds_und)['last_hidden_state']
-            # interpolate position embeddings for dynamic resolution
-            else:
-                image_embeds_und = image_embeds_und + interpolate_pos_encoding(
-                    self.config.clip_latent_dim,
-                    self.position_embedding,
-                    h_,
-                    w_,
-                    1,
-                )
-                image_embeds_und = self.und_trans(image_embeds_und)['last_hidden_state']
-            if T != 0:
-                image_embeds_und = image_embeds_und.reshape(b, T, image_embeds_und.shape[1], -1)
-                image_embeds_und = rearrange(image_embeds_und, 'b t l d -> b (t l) d')
-
-            # spatial (-temporal) fusion
-            image_embeds = self.fusion_proj(torch.cat([image_embeds_und, image_embeds_gen], dim=-1))
 
             if image_labels is not None:
                 if T == 0:
@@ -347,28 +382,17 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
                 new_image_labels = torch.zeros([b, max_seq_len, p * p * c], device=device, dtype=dtype)
                 image_masks = image_masks[:, :, None].repeat(1, 1, p * p * c)
 
-            for i, modality_batch in enumerate(modality_positions):
-                for j, (offset, length) in enumerate(modality_batch):
-                    if self.config.add_time_embeds:
-                        input_embeds[i, offset] = time_embeds_proj[i * modality_positions.size(1) + j]
-                        # length - 1 because we add 1 to the num_image_tokens when add_time_embeds=True
-                        # it's necessary to include :length-1, as sometimes we may skip some idle images when length=0
-                        input_embeds[i, offset + 1:offset + 1 + length - 1] = image_embeds[
-                                                                              i * modality_positions.size(1) + j,
-                                                                              :max(length - 1, 0)]
-                        if image_labels is not None:
-                            # mask the position of time embedding
-                            image_masks[i, offset] = 0
-                            # it's necessary to include :length-1, as sometimes we may skip some idle images when length=0
-                            new_image_labels[i, offset + 1:offset + 1 + length - 1] = image_labels[
-                                                                                      i * modality_positions.size(
-                                                                                          1) + j, :max(length - 1, 0)]
-                    else:
-                        input_embeds[i, offset:offset + length] = image_embeds[i * modality_positions.size(1) + j,
-                                                                  :length]
-                        if image_labels is not None:
-                            new_image_labels[i, offset:offset + length] = image_labels[
-                                                                          i * modality_positions.size(1) + j, :length]
+            input_embeds = self._scatter_image_embeds(input_embeds, image_embeds, time_embeds_proj, modality_positions)
+            if image_labels is not None:
+                skip = 1 if self.config.add_time_embeds else 0
+                image_index = modality_index(modality_positions, max_seq_len, image_labels.shape[1], skip)
+                new_image_labels = scatter_modality(new_image_labels, image_labels, image_index)
+                if self.config.add_time_embeds:
+                    # mask the position of time embedding
+                    time_index = modality_first_index(modality_positions, max_seq_len)
+                    image_masks = scatter_modality(
+                        image_masks, image_masks.new_zeros(time_index.shape[0], 1, image_masks.shape[-1]),
+                        time_index[:, None])
 
             outputs = self.showo(
                 inputs_embeds=input_embeds,
@@ -407,16 +431,11 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
                 return logits, loss_ntp
 
             else:
-                v_pred_ = []
-                num_imgs = 0
-                for i, modality_batch in enumerate(modality_positions):
-                    for j, (offset, length) in enumerate(modality_batch):
-                        if length == 0:
-                            break
-                        else:
-                            v_pred_.append(v_pred[i, offset:offset + length])
-                            num_imgs += 1
-                v_pred_ = torch.stack(v_pred_)
+                # one prediction per slot, i.e. per entry of image_latents (B * M); idle slots (length == 0)
+                # read zeros, so the shape never depends on the slot lengths and the ODE state lines up with it
+                num_tokens = image_embeds.shape[1] + (1 if self.config.add_time_embeds else 0)
+                v_pred_ = gather_modality(v_pred, modality_index(modality_positions, v_pred.shape[1], num_tokens))
+                num_imgs = v_pred_.shape[0]
 
                 # remove the time embedding
                 if self.config.add_time_embeds:
@@ -476,9 +495,21 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
             only_denoise_last_image=False,
             max_seq_len=None,
             guidance_scale=0.0,
+            prefix_cache=None,
             **kwargs,
     ):
-        if guidance_scale > 0.0:
+        # guidance_scale may also be a tensor of per-sample scales broadcastable to the latents of one half
+        use_cfg = torch.is_tensor(guidance_scale) or guidance_scale > 0.0
+        if prefix_cache is not None:
+            # only the image positions are run, see `build_t2i_prefix_cache`
+            if use_cfg:
+                v = self._t2i_step_cached(image_latents, t, prefix_cache)
+                v_cond, v_uncond = torch.chunk(v, 2)
+                v = v_uncond + guidance_scale * (v_cond - v_uncond)
+                return torch.cat([v, v], dim=0)
+            return self._t2i_step_cached(image_latents, t, prefix_cache)
+
+        if use_cfg:
             if t.shape[-1] != text_tokens.shape[0]:
                 t_cond, t_uncond = torch.chunk(t, 2)
                 t_cond[:-1] = 1.0
@@ -513,6 +544,129 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
                         max_seq_len=max_seq_len)
             return v
 
+    @torch.no_grad()
+    def build_t2i_prefix_cache(self, text_tokens=None, attention_mask=None, modality_positions=None, prefix_len=None,
+                               **kwargs):
+        """
+        Run the text before the image of every sample once, for the LLM and the diffusion head, and return what
+        `t2i_generate(..., prefix_cache=...)` needs to run only the image positions at each ODE step.
+
+        Under the omni attention mask the tokens before the image attend causally to text only and the image
+        tokens do not attend to anything after the image, so the prefix keys/values never change across steps
+        and the tokens after the image can be dropped. Expects one image per sample (T2I) and a dense mask.
+        The prefix is as long as the longest one in the batch, or `prefix_len` (at least that) for fixed shapes.
+        """
+        if type(attention_mask) == BlockMask:
+            raise NotImplementedError
+        assert modality_positions.shape[1] == 1, "the prefix cache only supports one image per sample"
+        device = text_tokens.device
+        b, seq_len = text_tokens.shape
+        offsets = modality_positions[:, 0, 0]
+        num_tokens = int(modality_positions[0, 0, 1])
+        prefix_len = int(offsets.max()) if prefix_len is None else prefix_len
+
+        # (b, 1, num_tokens, prefix_len + num_tokens): the rows of the image positions, restricted to the
+        # sample's own prefix and image block (the padded prefix of shorter prompts holds their image pads)
+        positions = offsets[:, None] + torch.arange(num_tokens, device=device)
+        rows = attention_mask.gather(2, positions[:, None, :, None].expand(-1, attention_mask.shape[1], -1, seq_len))
+        blocked = False if attention_mask.dtype == torch.bool else torch.finfo(attention_mask.dtype).min
+        prefix_mask = torch.where(torch.arange(prefix_len, device=device) < offsets[:, None, None, None],
+                                  rows[..., :prefix_len], blocked)
+        image_mask = rows.gather(3, positions[:, None, None, :].expand(-1, rows.shape[1], num_tokens, -1))
+        step_mask = torch.cat([prefix_mask, image_mask], dim=-1)
+
+        prefix_mask_full = attention_mask[:, :, :prefix_len, :prefix_len]
+        prefix_position_ids = torch.arange(prefix_len, device=device).unsqueeze(0)
+        llm_cache = PrefixKVCache()
+        hidden_states = self.showo.model(
+            input_ids=text_tokens[:, :prefix_len],
+            attention_mask=prefix_mask_full,
+            position_ids=prefix_position_ids,
+            past_key_values=llm_cache,
+            use_cache=False,
+        ).last_hidden_state
+
+        # the prefix is outside every image slot, so the diffusion head does not modulate it and t is irrelevant
+        if hasattr(self, 'diff_proj'):
+            hidden_states = self.diff_proj(hidden_states)
+        time_embeds = self.time_embed(torch.zeros(b, device=device), hidden_states.dtype)
+        no_image = torch.zeros_like(modality_positions)
+        head_cache = PrefixKVCache()
+        for layer in self.diffusion_head_a:
+            hidden_states = layer(hidden_states=hidden_states,
+                                  adaln_input=time_embeds,
+                                  attention_mask=prefix_mask_full,
+                                  position_ids=prefix_position_ids,
+                                  past_key_value=head_cache,
+                                  modality_positions=no_image,
+                                  )[0]
+
+        llm_cache.frozen = True
+        head_cache.frozen = True
+        # the query window of the diffusion head is exactly the image slot
+        head_modality_positions = torch.tensor([[0, num_tokens]], device=device).expand(b, 1, 2)
+        return dict(llm=llm_cache, head=head_cache, attention_mask=step_mask, position_ids=positions,
+                    num_tokens=num_tokens, head_modality_positions=head_modality_positions)
+
+    def image_pos_embed(self, h_, w_):
+        """Position embeddings of the semantic layers for a grid of h_ x w_ patches."""
+        # specific for fixed resolution of 432x432
+        if self.position_embedding.weight.shape[-1] == self.image_position_ids.shape[-1]:
+            return self.position_embedding(self.image_position_ids)
+        # interpolate position embeddings for dynamic resolution
+        return interpolate_pos_encoding(self.config.clip_latent_dim, self.position_embedding, h_, w_, 1)
+
+    def _t2i_step_cached(self, image_latents, t, prefix_cache):
+        b, c, h, w = image_latents.shape
+        dtype = self.showo.model.embed_tokens.weight.dtype
+        p = self.config.patch_size
+        h_, w_ = h // p, w // p
+
+        image_embeds_und = self.image_embedder_und(image_latents.to(dtype))
+        image_embeds_gen = self.image_embedder_gen(image_latents.to(dtype))
+        if 'image_pos_embed' in prefix_cache:
+            image_embeds_und = image_embeds_und + prefix_cache['image_pos_embed']
+        else:
+            image_embeds_und = image_embeds_und + self.image_pos_embed(h_, w_)
+        image_embeds_und = self.und_trans(image_embeds_und)['last_hidden_state']
+        image_embeds = self.fusion_proj(torch.cat([image_embeds_und, image_embeds_gen], dim=-1))
+
+        time_embeds = self.time_embed(t, dtype)
+        if hasattr(self, 'time_embed_proj'):
+            time_embeds_proj = self.time_embed_proj(time_embeds)
+        else:
+            time_embeds_proj = time_embeds
+        if self.config.add_time_embeds:
+            image_embeds = torch.cat([time_embeds_proj[:, None], image_embeds], dim=1)
+
+        hidden_states = self.showo.model(
+            inputs_embeds=image_embeds,
+            attention_mask=prefix_cache['attention_mask'],
+            position_ids=prefix_cache['position_ids'],
+            past_key_values=prefix_cache['llm'],
+            use_cache=False,
+        ).last_hidden_state
+
+        if hasattr(self, 'diff_proj'):
+            hidden_states = self.diff_proj(hidden_states)
+        modality_positions = prefix_cache['head_modality_positions']
+        for layer in self.diffusion_head_a:
+            hidden_states = layer(hidden_states=hidden_states,
+                                  adaln_input=time_embeds,
+                                  attention_mask=prefix_cache['attention_mask'],
+                                  position_ids=prefix_cache['position_ids'],
+                                  past_key_value=prefix_cache['head'],
+                                  modality_positions=modality_positions,
+                                  )[0]
+        v_pred = self.diffusion_head_b(hidden_states, time_embeds, modality_positions)
+
+        # remove the time embedding
+        if self.config.add_time_embeds:
+            v_pred = v_pred[:, 1:, :]
+        v_pred = self.unpatchify(v_pred, h_, w_)
+        v_pred = rearrange(v_pred, 'i j k -> i k j')
+        return v_pred.reshape(b, c, h, w)
+
     @torch.no_grad()
     def mmu_generate(
             self,
@@ -527,8 +681,6 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
         """
-        device = input_embeds.device
-
         result = []
         for _ in range(max_new_tokens):
             # if the sequence context is growing too long we must crop it at block_size
@@ -539,16 +691,21 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
 
             L = attention_mask.shape[-1]
             attention_mask = attention_mask.squeeze()
+            # boolean masks (e.g. omni_attn_mask_compact) allow with True, additive ones with 0
+            if attention_mask.dtype == torch.bool:
+                allowed, blocked = True, False
+            else:
+                allowed, blocked = 0, torch.finfo(logits.dtype).min
             attention_mask_a = torch.hstack(
                 [
                     attention_mask,  # L, L
-                    torch.zeros((L, 1)).to(device) + torch.finfo(logits.dtype).min,
+                    attention_mask.new_full((L, 1), blocked),
                 ]
             )
             attention_mask_b = torch.vstack(
                 [
                     attention_mask_a,  # L, L+1
-                    torch.hstack([attention_mask[-1, :], torch.tensor([0]).to(device)]).unsqueeze(0),
+                    torch.hstack([attention_mask[-1, :], attention_mask.new_full((1,), allowed)]).unsqueeze(0),
                 ]
             )
             attention_mask = attention_mask_b
@@ -573,6 +730,71 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
 
         return result
 
+    @staticmethod
+    def _sample_next_token(logits, temperature=1.0, top_k=None, top_p=None):
+        """
+        Pick the next token of every row of `logits` (b, vocab) on device: greedy if `temperature` is 0,
+        otherwise sampled after temperature scaling and top-k / top-p (nucleus) filtering.
+        """
+        if temperature == 0:
+            return logits.argmax(dim=-1, keepdim=True)
+        logits = logits.float() / temperature
+        if top_k is not None:
+            top_k_values, _ = torch.topk(logits, min(top_k, logits.shape[-1]))
+            logits = logits.masked_fill(logits < top_k_values[:, -1:], float("-inf"))
+        if top_p is not None:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            sorted_probs = F.softmax(sorted_logits, dim=-1)
+            # keep the smallest prefix whose probability exceeds top_p, including the token that crosses it
+            sorted_indices_to_remove = torch.cumsum(sorted_probs, dim=-1) - sorted_probs > top_p
+            indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+            logits = logits.masked_fill(indices_to_remove, float("-inf"))
+        return torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+
+    def _generate_text(self, input_embeds, attention_mask, stop_tokens, max_new_tokens, temperature, top_k,
+                       top_p, stop_check_interval):
+        """
+        KV-cached decoding of one prompt (1, L, D): the prompt is run once, then every step feeds only the new
+        token. The new tokens attend to what the last prompt token attends to plus all generated tokens.
+        Tokens stay on device; stop tokens are checked on the host every `stop_check_interval` steps and
+        everything after the first one is dropped. Returns the new tokens up to and including the stop token.
+        """
+        device = input_embeds.device
+        prompt_len = input_embeds.shape[1]
+        cache = DynamicCache()
+        logits = self.showo(inputs_embeds=input_embeds, attention_mask=attention_mask, past_key_values=cache,
+                            use_cache=True, num_logits_to_keep=1).logits
+
+        step_mask = None
+        if attention_mask is not None:
+            allowed = True if attention_mask.dtype == torch.bool else 0
+            step_mask = attention_mask.new_full(attention_mask.shape[:2] + (1, prompt_len + max_new_tokens),
+                                                allowed)
+            step_mask[..., :prompt_len] = attention_mask[:, :, -1:, :]
+
+        stop_tokens = [token for token in stop_tokens if token is not None]
+        stop_tokens_device = torch.tensor(stop_tokens, dtype=torch.long, device=device)
+        output_tokens = torch.empty((1, max_new_tokens), dtype=torch.long, device=device)
+        num_tokens = 0
+        for i in range(max_new_tokens):
+            next_token = self._sample_next_token(logits[:, -1, :], temperature, top_k, top_p)
+            output_tokens[:, i:i + 1] = next_token
+            num_tokens = i + 1
+            if num_tokens == max_new_tokens:
+                break
+            if num_tokens % stop_check_interval == 0 and \
+                    torch.isin(output_tokens[0, :num_tokens], stop_tokens_device).any():
+                break
+            logits = self.showo(input_ids=next_token,
+                                attention_mask=None if step_mask is None else step_mask[..., :prompt_len + i + 1],
+                                past_key_values=cache, use_cache=True).logits
+
+        output_tokens = output_tokens[0, :num_tokens].tolist()
+        for i, token in enumerate(output_tokens):
+            if token in stop_tokens:
+                return output_tokens[:i + 1]
+        return output_tokens
+
     @torch.no_grad()
     def lm_generate(
             self,
@@ -585,63 +807,18 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
             top_k=None,
             top_p=None,
             device=None,
+            stop_check_interval=4,
     ):
         """
-        Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
-        the sequence max_new_tokens times, feeding the predictions back into the model each time.
-        Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        Complete the token ids `input_ids` (a list) until the eos token or `boi_token` is generated or
+        `max_new_tokens` are reached, and return the decoded text of the new tokens. `temperature`=0 decodes
+        greedily. Most likely you'll want to make sure to be in model.eval() mode of operation for this.
         """
-        generated_tokens = input_ids
-        output_tokens = []
-        for _ in range(max_new_tokens):
-            # Generate the next token
-            outputs = self.showo(
-                input_ids=torch.tensor([generated_tokens]).to(device),
-                attention_mask=attention_mask,
-                return_dict=True,
-            )
-            next_token_logits = outputs.logits[:, -1, :]  # Get logits for the last token
-
-            # Apply temperature scaling
-            next_token_logits = next_token_logits / temperature
-
-            # Apply top-k sampling
-            if top_k is not None:
-                top_k_values, _ = torch.topk(next_token_logits, top_k)
-                min_top_k_value = top_k_values[:, -1].unsqueeze(-1)
-                next_token_logits = torch.where(
-                    next_token_logits < min_top_k_value,
-                    torch.full_like(next_token_logits, float("-inf")),
-                    next_token_logits,
-                )
-
-            # Apply top-p (nucleus) sampling
-            if top_p is not None:
-                sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
-                cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-                sorted_indices_to_remove[:, 0] = 0
-                next_token_logits[sorted_indices[sorted_indices_to_remove]] = float("-inf")
-
-            # Convert logits to probabilities
-            probs = F.softmax(next_token_logits, dim=-1)
-
-            # Sample the next token
-            next_token = torch.multinomial(probs, num_samples=1).item()
-
-            # Append the next token to the sequence
-            generated_tokens.append(next_token)
-            output_tokens.append(next_token)
-
-            # Check if the `eos_token_id` is generated
-            if next_token == tokenizer.eos_token_id or next_token == boi_token:  # EOS token ID
-                break
-
-            # Decode the generated tokens
-        generated_text = tokenizer.decode(output_tokens, skip_special_tokens=False)
-
-        return generated_text
+        input_ids = torch.tensor([input_ids], device=device)
+        output_tokens = self._generate_text(self.showo.model.embed_tokens(input_ids), attention_mask,
+                                            [tokenizer.eos_token_id, boi_token], max_new_tokens, temperature,
+                                            top_k, top_p, stop_check_interval)
+        return tokenizer.decode(output_tokens, skip_special_tokens=False)
 
     @torch.no_grad()
     def mm_generate(
@@ -658,83 +835,19 @@ class Showo2Qwen2_5(ModelMixin, ConfigMixin):
             top_k=None,
             top_p=None,
             device=None,
+            stop_check_interval=4,
+            image_feature_cache=None,
+            image_keys=None,
     ):
         """
-        Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
-        the sequence max_new_tokens times, feeding the predictions back into the model each time.
-        Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        Like `lm_generate`, for a prompt with images in the slots of `modality_positions`. The images are
+        embedded once, together with the prompt, or taken from `image_feature_cache` (see `und_image_embeds`).
         """
-        generated_tokens = input_ids
-        output_tokens = []
         if attention_mask is not None and type(attention_mask) == BlockMask:
             raise NotImplementedError
-
-        for _ in range(max_new_tokens):
-
-            # Generate the next token
-            logits = self.forward_und_only(
-                text_tokens=torch.tensor([generated_tokens]).to(device),
-                image_latents=image_latents,
-                t=t,
-                attention_mask=attention_mask,
-                modality_positions=modality_positions,
-            )
-
-            next_token_logits = logits[:, -1, :]  # Get logits for the last token
-
-            # Apply temperature scaling
-            next_token_logits = next_token_logits / temperature
-
-            # Apply top-k sampling
-            if top_k is not None:
-                top_k_values, _ = torch.topk(next_token_logits, top_k)
-                min_top_k_value = top_k_values[:, -1].unsqueeze(-1)
-                next_token_logits = torch.where(
-                    next_token_logits < min_top_k_value,
-                    torch.full_like(next_token_logits, float("-inf")),
-                    next_token_logits,
-                )
-
-            # Apply top-p (nucleus) sampling
-            if top_p is not None:
-                sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
-                cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-                sorted_indices_to_remove[:, 0] = 0
-                next_token_logits[sorted_indices[sorted_indices_to_remove]] = float("-inf")
-
-            # Convert logits to probabilities
-            probs = F.softmax(next_token_logits, dim=-1)
-
-            # Sample the next token
-            next_token = torch.multinomial(probs, num_samples=1).item()
-
-            # Append the next token to the sequence
-            generated_tokens.append(next_token)
-            output_tokens.append(next_token)
-
-            # Check if the `eos_token_id` is generated
-            if next_token == tokenizer.eos_token_id or next_token == boi_token:  # EOS token ID
-                break
-
-            L = attention_mask.shape[-1]
-            attention_mask = attention_mask.squeeze()
-            attention_mask_a = torch.hstack(
-                [
-                    attention_mask,  # L, L
-                    torch.zeros((L, 1)).to(device) + torch.finfo(next_token_logits.dtype).min,
-                ]
-            )
-            attention_mask_b = torch.vstack(
-                [
-                    attention_mask_a,  # L, L + 1
-                    torch.hstack([attention_mask[-1, :], torch.tensor([0]).to(device)]).unsqueeze(0),
-                ]
-            )
-            attention_mask = attention_mask_b.to(image_latents.dtype)
-
-            # Decode the generated tokens
-        generated_text = tokenizer.decode(output_tokens, skip_special_tokens=False)
-
-        return generated_text
\ No newline at end of file
+        input_ids = torch.tensor([input_ids], device=device)
+        input_embeds = self._und_input_embeds(input_ids, image_latents, t, modality_positions,
+                                              image_feature_cache, image_keys)
+        output_tokens = self._generate_text(input_embeds, attention_mask, [tokenizer.eos_token_id, boi_token],
+                                            max_new_tokens, temperature, top_k, top_p, stop_check_interval)
+        return tokenizer.decode(output_tokens, skip_special_tokens=False)
@@ -106,6 +106,64 @@ def modulate(x, shift, scale):
         return (x * (1 + scale) + shift).to(input_dtype)
 
 
+def modality_index(modality_positions, seq_len, num_tokens, skip=0):
+    """
+    Flat indices of the tokens of every modality slot in a (B * seq_len) sequence buffer.
+
+    modality_positions: (B, M, 2) of [offset, length]. Returns a (B * M, num_tokens) index where token k of
+    slot (i, j) maps to i * seq_len + offset + skip + k if k < length - skip, and to B * seq_len (a trash row
+    past the end of the buffer) otherwise, so the shapes never depend on the lengths.
+    """
+    B, M = modality_positions.shape[:2]
+    offsets, lengths = modality_positions[..., 0], modality_positions[..., 1]
+    k = torch.arange(num_tokens, device=modality_positions.device)
+    start = torch.arange(B, device=modality_positions.device)[:, None] * seq_len + offsets + skip
+    index = start[..., None] + k
+    index = torch.where(k < (lengths - skip)[..., None], index, B * seq_len)
+    return index.view(B * M, num_tokens)
+
+
+def modality_first_index(modality_positions, seq_len):
+    """
+    (B * M,) flat index of the first position of every slot (idle slots included, as the per-slot loop did).
+    When several slots of a sample share that position, only the last one keeps it, the others map to the
+    trash row B * seq_len.
+    """
+    B, M = modality_positions.shape[:2]
+    index = torch.arange(B, device=modality_positions.device)[:, None] * seq_len + modality_positions[..., 0]
+    later = torch.triu(torch.ones(M, M, dtype=torch.bool, device=index.device), diagonal=1)
+    overwritten = ((index[:, :, None] == index[:, None, :]) & later).any(-1)
+    return torch.where(overwritten, B * seq_len, index).view(B * M)
+
+
+def scatter_modality(x, values, index):
+    """Write values (N, ..., D) to the flat positions `index` (N, ...) of x (B, L, D); trash entries are dropped."""
+    B, L, D = x.shape
+    flat = torch.cat([x.reshape(B * L, D), x.new_zeros(1, D)])
+    flat = flat.index_copy(0, index.reshape(-1), values.reshape(-1, D).to(x.dtype))
+    return flat[:-1].view(B, L, D)
+
+
+def gather_modality(x, index):
+    """Read x (B, L, D) at the flat positions `index` (N, ...); trash entries read zeros."""
+    B, L, D = x.shape
+    flat = torch.cat([x.reshape(B * L, D), x.new_zeros(1, D)])
+    return flat[index.reshape(-1)].view(*index.shape, D)
+
+
+def spread_modality(values, modality_positions, seq_len, fill=0.0):
+    """
+    Broadcast per-slot values (B * M, D) over the positions each slot covers in a (B, seq_len, D) tensor,
+    `fill` everywhere else.
+    """
+    B, M = modality_positions.shape[:2]
+    positions = torch.arange(seq_len, device=modality_positions.device)
+    offsets, lengths = modality_positions[..., 0:1], modality_positions[..., 1:2]
+    covered = (positions >= offsets) & (positions < offsets + lengths)  # (B, M, L)
+    spread = torch.einsum('bml,bmd->bld', covered.to(values.dtype), values.view(B, M, -1))
+    return torch.where(covered.any(1)[..., None], spread, fill)
+
+
 class ModulatedAttentionBlock(nn.Module):
     def __init__(self, config: DiffusionHeadConfig, layer_idx: int):
         super().__init__()
@@ -168,19 +226,12 @@ class ModulatedAttentionBlock(nn.Module):
                                                                                                                   dim=1)
 
         # We only modulate the image embeddings
-        shift_msa_new, scale_msa_new, gate_msa_new, shift_mlp_new, scale_mlp_new, gate_mlp_new = \
-            torch.zeros_like(hidden_states), torch.zeros_like(hidden_states), torch.ones_like(hidden_states), \
-            torch.zeros_like(hidden_states), torch.zeros_like(hidden_states), torch.ones_like(hidden_states)
-
-        for i, modality_batch in enumerate(modality_positions):
-            for j, (offset, length) in enumerate(modality_batch):
-                idx = i * modality_positions.size(1) + j
-                shift_msa_new[i, offset: offset + length] = shift_msa[idx]
-                scale_msa_new[i, offset: offset + length] = scale_msa[idx]
-                gate_msa_new[i, offset: offset + length] = gate_msa[idx]
-                shift_mlp_new[i, offset: offset + length] = shift_mlp[idx]
-                scale_mlp_new[i, offset: offset + length] = scale_mlp[idx]
-                gate_mlp_new[i, offset: offset + length] = gate_mlp[idx]
+        seq_len = hidden_states.shape[1]
+        shift_msa_new, scale_msa_new, gate_msa_new, shift_mlp_new, scale_mlp_new, gate_mlp_new = [
+            spread_modality(x.to(hidden_states.dtype), modality_positions, seq_len, fill)
+            for x, fill in ((shift_msa, 0.0), (scale_msa, 0.0), (gate_msa, 1.0),
+                            (shift_mlp, 0.0), (scale_mlp, 0.0), (gate_mlp, 1.0))
+        ]
         # We only modulate the image embeddings
 
         residual = hidden_states
@@ -793,12 +844,8 @@ class FinalLayer(nn.Module):
         shift, scale = self.adaLN_modulation(adaln_input).chunk(2, dim=1)
 
         # We only modulate the image embeddings
-        shift_new, scale_new = torch.zeros_like(x), torch.zeros_like(x)
-        for i, modality_batch in enumerate(modality_positions):
-            for j, (offset, length) in enumerate(modality_batch):
-                idx = i * modality_positions.size(1) + j
-                shift_new[i, offset: offset + length] = shift[idx]
-                scale_new[i, offset: offset + length] = scale[idx]
+        shift_new = spread_modality(shift.to(x.dtype), modality_positions, x.shape[1])
+        scale_new = spread_modality(scale.to(x.dtype), modality_positions, x.shape[1])
         # We only modulate the image embeddings
 
         x = modulate(self.norm_final(x), shift_new, scale_new)
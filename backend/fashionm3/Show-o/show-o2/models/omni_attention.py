@@ -12,6 +12,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
+
 import numpy as np
 import torch
 from torch.nn.attention.flex_attention import BlockMask
@@ -70,6 +72,64 @@ def omni_attn_mask_naive(B, LEN, modalities, device, inverted=True):
         return attention_mask
 
 
+def omni_block_ids(LEN, modalities):
+    """(B, LEN) id of the modality block every position belongs to (1-based), 0 for text."""
+    positions = torch.arange(LEN, device=modalities.device)
+    offsets, lengths = modalities[..., 0:1], modalities[..., 1:2]
+    covered = (positions >= offsets) & (positions < offsets + lengths)  # (B, M, LEN)
+    block_ids = torch.arange(1, modalities.shape[1] + 1, device=modalities.device)[None, :, None]
+    return (covered * block_ids).amax(dim=1)
+
+
+_omni_mask_cache = OrderedDict()
+
+
+def omni_attn_mask_compact(B, LEN, modalities, device, use_block_mask=False, cache_size=8):
+    """
+    Boolean omni attention mask (B, 1, LEN, LEN), True where attention is allowed: causal everywhere and
+    bidirectional inside every modality block, built without a loop over modalities. SDPA takes it as is,
+    so it is 1 byte per entry instead of the int64 additive mask of `omni_attn_mask_naive`.
+
+    With `use_block_mask`, a flex attention `BlockMask` over the same per-position block ids is returned
+    instead (falling back to the boolean mask if it cannot be built, e.g. without CUDA).
+
+    The last `cache_size` masks are cached by (B, LEN, modalities, device), so repeated calls with the same
+    layout (e.g. every ODE step, or a fixed evaluation batch) return the same tensor. Do not modify it in place.
+    The key copies `modalities` to the host; with `cache_size=0` (e.g. in training loops, where every batch has
+    a new layout) nothing is cached and the mask is built without any host sync.
+    """
+    modalities = modalities.to(device).long()
+    key = None
+    if cache_size > 0:
+        key = (B, LEN, str(device), use_block_mask, tuple(modalities.shape), modalities.cpu().numpy().tobytes())
+        if key in _omni_mask_cache:
+            _omni_mask_cache.move_to_end(key)
+            return _omni_mask_cache[key]
+
+    block_ids = omni_block_ids(LEN, modalities)
+    mask = None
+    if use_block_mask and torch.cuda.is_available():
+        def mask_mod(b, h, q_idx, kv_idx):
+            q_block = block_ids[b, q_idx]
+            return (q_idx >= kv_idx) | ((q_block == block_ids[b, kv_idx]) & (q_block > 0))
+
+        try:
+            mask = create_block_mask(mask_mod, B=B, H=None, Q_LEN=LEN, KV_LEN=LEN, device=device)
+        except Exception:
+            mask = None
+    if mask is None:
+        positions = torch.arange(LEN, device=device)
+        causal_mask = positions[None, :, None] >= positions[None, None, :]
+        same_block = (block_ids[:, :, None] == block_ids[:, None, :]) & (block_ids[:, :, None] > 0)
+        mask = (causal_mask | same_block).unsqueeze(1)
+
+    if key is not None:
+        _omni_mask_cache[key] = mask
+        while len(_omni_mask_cache) > cache_size:
+            _omni_mask_cache.popitem(last=False)
+    return mask
+
+
 def full_attn_mask_naive(B, LEN, device, inverted=True):
     attention_mask = torch.ones((B, 1, LEN, LEN), dtype=torch.long).to(device)
     if inverted:
@@ -0,0 +1,62 @@
+import torch
+
+from .omni_attention import omni_attn_mask_compact
+
+
+class StaticShowo2T2I:
+    """
+    T2I inference with shapes frozen for one batch size, resolution and text length, meant for CPU serving
+    with `torch.compile` (inductor). One ODE step runs the image positions of `Showo2Qwen2_5._t2i_step_cached`
+    against a prefix of fixed length `max_text_len + 2`, so every step and every prompt batch has the same
+    shapes and the compiled graph is reused.
+
+    `prepare(text_tokens, modality_positions)` runs the prompts once and copies the prefix keys/values, the
+    step mask and position ids into buffers owned by the wrapper, next to the precomputed position embeddings
+    of the semantic layers and the head's modality positions. `t2i_generate` then has the signature the ODE
+    sampler expects (`guidance_scale` as in `Showo2Qwen2_5.t2i_generate`). With guidance, `batch_size` counts
+    the cond and uncond sequences.
+    """
+
+    def __init__(self, model, batch_size, latent_height, latent_width, max_text_len, max_seq_len, compile=True,
+                 compile_mode=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_seq_len = max_seq_len
+        # [bos][text, padded to max_text_len][boi]
+        self.prefix_len = max_text_len + 2
+        self.prefix_cache = None
+        self.image_pos_embed = model.image_pos_embed(latent_height, latent_width).detach()
+        self._step = model._t2i_step_cached
+        if compile:
+            self._step = torch.compile(model._t2i_step_cached, backend="inductor", mode=compile_mode, dynamic=False)
+
+    @torch.no_grad()
+    def prepare(self, text_tokens, modality_positions):
+        if tuple(text_tokens.shape) != (self.batch_size, self.max_seq_len):
+            raise ValueError(f"expected text tokens of shape {(self.batch_size, self.max_seq_len)}, "
+                             f"got {tuple(text_tokens.shape)}")
+        attention_mask = omni_attn_mask_compact(self.batch_size, self.max_seq_len, modality_positions,
+                                                text_tokens.device)
+        prefix_cache = self.model.build_t2i_prefix_cache(text_tokens=text_tokens, attention_mask=attention_mask,
+                                                         modality_positions=modality_positions,
+                                                         prefix_len=self.prefix_len)
+        if self.prefix_cache is None:
+            prefix_cache['image_pos_embed'] = self.image_pos_embed
+            self.prefix_cache = prefix_cache
+            return self
+        # refill the same cache objects and buffers, so the compiled step sees unchanged inputs
+        for name in ['llm', 'head']:
+            self.prefix_cache[name].key_cache[:] = prefix_cache[name].key_cache
+            self.prefix_cache[name].value_cache[:] = prefix_cache[name].value_cache
+        for name in ['attention_mask', 'position_ids']:
+            self.prefix_cache[name].copy_(prefix_cache[name])
+        return self
+
+    @torch.no_grad()
+    def t2i_generate(self, image_latents=None, t=None, guidance_scale=0.0, **kwargs):
+        v = self._step(image_latents, t, self.prefix_cache)
+        if torch.is_tensor(guidance_scale) or guidance_scale > 0.0:
+            v_cond, v_uncond = torch.chunk(v, 2)
+            v = v_uncond + guidance_scale * (v_cond - v_uncond)
+            return torch.cat([v, v], dim=0)
+        return v
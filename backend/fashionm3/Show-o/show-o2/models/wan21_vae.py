@@ -12,6 +12,8 @@ __all__ = [
 ]
 
 CACHE_T = 2
+# rough number of live full-resolution decoder feature maps per decoded frame, see WanVAE_.decode_tile_size
+_DECODE_ACTIVATION_MAPS = 8
 
 
 class CausalConv3d(nn.Conv3d):
@@ -514,58 +516,151 @@ class WanVAE_(nn.Module):
         return x_recon, mu, log_var
 
     def encode(self, x, scale):
-        self.clear_cache()
-        ## cache
         t = x.shape[2]
-        iter_ = 1 + (t - 1) // 4
-        ## 对encode输入的x，按时间拆分为1、4、4、4....
-        for i in range(iter_):
-            self._enc_conv_idx = [0]
-            if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-            else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
+        if t == 1:
+            # a single frame only ever sees the zero temporal padding, so the causal cache is not needed
+            out = self.encoder(x)
+        else:
+            self.clear_cache()
+            ## cache
+            iter_ = 1 + (t - 1) // 4
+            ## 对encode输入的x，按时间拆分为1、4、4、4....
+            out = self._gather_chunks(self._encode_chunks(x, iter_), iter_)
+            self.clear_cache()
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             mu = (mu - scale[0]) * scale[1]
-        self.clear_cache()
         return mu, log_var, out
 
-    def decode(self, z, scale):
-        self.clear_cache()
-        # z: [b,c,t,h,w]
+    def _encode_chunks(self, x, iter_):
+        for i in range(iter_):
+            self._enc_conv_idx = [0]
+            chunk = x[:, :, :1, :, :] if i == 0 else x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :]
+            yield self.encoder(chunk, feat_cache=self._enc_feat_map, feat_idx=self._enc_conv_idx)
+
+    def decode(self, z, scale, tile_size=None, tile_overlap=4, memory_budget=None):
+        """
+        Decode latents [b,c,t,h,w]. By default the whole spatial extent of every latent frame is decoded at
+        once. `tile_size` (in latent pixels) decodes overlapping `tile_size x tile_size` latent tiles, each
+        through the full temporal chunk loop with its own feature cache, and blends them with linear
+        feathering over the `tile_overlap` seam. If only `memory_budget` (bytes of decoder activations) is
+        given, the tile size is chosen by `decode_tile_size`. The decoder's mid attention and RMS norms then
+        only see one tile, so tiled outputs are close to, but not bit-identical with, the untiled decode.
+        """
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             z = z / scale[1] + scale[0]
-        iter_ = z.shape[2]
         x = self.conv2(z)
+        if tile_size is None and memory_budget is not None:
+            tile_size = self.decode_tile_size(x.shape, memory_budget, tile_overlap, x.element_size())
+        if tile_size is not None:
+            return self._tiled_decode(x, tile_size, tile_overlap)
+        return self._decode_frames(x)
+
+    def _decode_frames(self, x):
+        iter_ = x.shape[2]
+        if iter_ == 1:
+            return self.decoder(x)
+        self.clear_cache()
+        out = self._gather_chunks(self._decode_chunks(x, iter_), iter_)
+        self.clear_cache()
+        return out
+
+    def decode_tile_size(self, shape, memory_budget, tile_overlap=4, element_size=4):
+        """
+        Largest latent tile size whose decoder activations are estimated to fit in `memory_budget` bytes for
+        latents of `shape` [b,c,t,h,w], or None if the whole frame fits. The estimate only counts the
+        full-resolution feature maps (dim * dim_mult[0] channels), which dominate: `_DECODE_ACTIVATION_MAPS`
+        live maps per decoded frame, plus the frames cached by the full-resolution causal convs for videos.
+        """
+        b, _, t, h, w = shape
+        upscale = 2 ** (len(self.dim_mult) - 1)
+        num_maps = _DECODE_ACTIVATION_MAPS
+        if t > 1:
+            # a latent frame after the first one decodes to 2 ** (number of temporal upsamples) frames
+            num_maps = num_maps * 2 ** sum(self.temperal_upsample) + \
+                (2 * (self.num_res_blocks + 1) + 1) * CACHE_T
+        bytes_per_latent_pixel = b * num_maps * self.dim * self.dim_mult[0] * element_size * upscale ** 2
+        tile_size = int((memory_budget / bytes_per_latent_pixel) ** 0.5)
+        if tile_size >= max(h, w):
+            return None
+        return max(tile_size, tile_overlap + 1)
+
+    def _tiled_decode(self, x, tile_size, tile_overlap):
+        _, _, _, h, w = x.shape
+        if h <= tile_size and w <= tile_size:
+            return self._decode_frames(x)
+
+        upscale = 2 ** (len(self.dim_mult) - 1)
+        stride = max(tile_size - tile_overlap, 1)
+
+        def tile_starts(size):
+            if size <= tile_size:
+                return [0]
+            starts = list(range(0, size - tile_size + 1, stride))
+            if starts[-1] != size - tile_size:
+                starts.append(size - tile_size)
+            return starts
+
+        def feather(start, length, size, device):
+            # linear ramp over the overlap on sides that touch another tile, flat on image borders
+            ramp = torch.ones(length * upscale, device=device)
+            overlap = min(tile_overlap, length) * upscale
+            if overlap > 0:
+                edge = torch.arange(1, overlap + 1, device=device, dtype=ramp.dtype) / (overlap + 1)
+                if start > 0:
+                    ramp[:overlap] = edge
+                if start + length < size:
+                    ramp[-overlap:] = torch.minimum(ramp[-overlap:], edge.flip(0))
+            return ramp
+
+        output, weight = None, None
+        for y in tile_starts(h):
+            th = min(tile_size, h)
+            ramp_y = feather(y, th, h, x.device)
+            for x0 in tile_starts(w):
+                tw = min(tile_size, w)
+                # every tile runs the whole temporal loop, clear_cache gives it a fresh feature cache
+                tile = self._decode_frames(x[:, :, :, y:y + th, x0:x0 + tw])
+                if output is None:
+                    output = tile.new_zeros(tile.shape[:3] + (h * upscale, w * upscale))
+                    weight = tile.new_zeros((1, 1, 1, h * upscale, w * upscale))
+                mask = (ramp_y[:, None] * feather(x0, tw, w, x.device)[None, :]).to(tile.dtype)
+                output[..., y * upscale:(y + th) * upscale, x0 * upscale:(x0 + tw) * upscale] += tile * mask
+                weight[..., y * upscale:(y + th) * upscale, x0 * upscale:(x0 + tw) * upscale] += mask
+        return output / weight
+
+    def _decode_chunks(self, x, iter_):
         for i in range(iter_):
             self._conv_idx = [0]
+            yield self.decoder(x[:, :, i:i + 1, :, :], feat_cache=self._feat_map, feat_idx=self._conv_idx)
+
+    @staticmethod
+    def _gather_chunks(outputs, num_chunks):
+        """
+        Write the outputs of `num_chunks` temporal chunks into one tensor allocated after the second chunk,
+        instead of re-concatenating the accumulated output at every chunk. Every chunk after the first one
+        yields the same number of frames.
+        """
+        out, first, pos = None, None, 0
+        for i, out_ in enumerate(outputs):
             if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
-        self.clear_cache()
-        return out
+                first = out_
+                continue
+            if out is None:
+                num_frames = first.shape[2] + (num_chunks - 1) * out_.shape[2]
+                out = first.new_empty(first.shape[:2] + (num_frames,) + first.shape[3:])
+                out[:, :, :first.shape[2]] = first
+                pos = first.shape[2]
+                first = None
+            out[:, :, pos:pos + out_.shape[2]] = out_
+            pos += out_.shape[2]
+        return first if out is None else out
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -583,11 +678,13 @@ class WanVAE_(nn.Module):
             return mu + std * torch.randn_like(std)
 
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
+        # the number of convs never changes, count them once
+        if not hasattr(self, '_conv_num'):
+            self._conv_num = count_conv3d(self.decoder)
+            self._enc_conv_num = count_conv3d(self.encoder)
         self._conv_idx = [0]
         self._feat_map = [None] * self._conv_num
         # cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
         self._enc_conv_idx = [0]
         self._enc_feat_map = [None] * self._enc_conv_num
 
@@ -647,9 +744,10 @@ class WanVAE:
             z_dim=z_dim,
         ).eval().requires_grad_(False).to(device)
 
-    def batch_decode(self, zs):
+    def batch_decode(self, zs, tile_size=None, tile_overlap=4, memory_budget=None):
         with amp.autocast(dtype=self.dtype):
-            return self.model.decode(zs, self.scale).float().clamp_(-1, 1)
+            return self.model.decode(zs, self.scale, tile_size=tile_size, tile_overlap=tile_overlap,
+                                     memory_budget=memory_budget).float().clamp_(-1, 1)
 
     def sample(self, videos, deterministic=False, return_features=False):
         with amp.autocast(dtype=self.dtype):
@@ -660,14 +758,23 @@ class WanVAE:
             else:
                 return self.model.sample(videos, self.scale, deterministic=deterministic).float()
 
-    def per_decode(self, zs):
-        outputs = []
+    def per_decode(self, zs, tile_size=None, tile_overlap=4, memory_budget=None):
+        # images are decoded as one batch, videos one at a time to bound the feature cache memory
+        if zs.shape[2] == 1:
+            return self.batch_decode(zs, tile_size=tile_size, tile_overlap=tile_overlap, memory_budget=memory_budget)
+        outputs = None
         with amp.autocast(dtype=self.dtype):
             for i in range(zs.shape[0]):
-                outputs.append(self.model.decode(zs[i][None], self.scale).float().clamp_(-1, 1))
-        return torch.cat(outputs, dim=0)
+                out = self.model.decode(zs[i][None], self.scale, tile_size=tile_size, tile_overlap=tile_overlap,
+                                        memory_budget=memory_budget).float().clamp_(-1, 1)
+                if outputs is None:
+                    outputs = out.new_empty((zs.shape[0],) + out.shape[1:])
+                outputs[i] = out[0]
+        return outputs
 
     def per_sample(self, videos, deterministic=False, return_features=False):
+        if videos.shape[2] == 1:
+            return self.sample(videos, deterministic=deterministic, return_features=return_features)
         with amp.autocast(dtype=self.dtype):
             if return_features:
                 outputs = []
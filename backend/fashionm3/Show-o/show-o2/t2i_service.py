@@ -0,0 +1,346 @@
+import os
+
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
+import io
+import threading
+import time
+from concurrent.futures import Future, as_completed
+
+import numpy as np
+import torch
+from PIL import Image
+from models import Showo2Qwen2_5, WanVAE, omni_attn_mask_compact
+from models.misc import get_text_tokenizer, prepare_gen_input
+from transport import Sampler, create_transport
+from utils import get_config, get_hyper_params, path_to_llm_name
+
+
+class AdmissionError(RuntimeError):
+    pass
+
+
+class T2IGenerationService:
+    """
+    Long-lived text-to-image service around `Showo2Qwen2_5.t2i_generate` + `WanVAE.batch_decode`.
+
+    Requests with their own prompt, resolution, number of ODE steps, guidance scale and seed are submitted
+    from any thread. A single worker thread groups requests with the same resolution and step count into
+    dynamic micro-batches, closed once `max_batch_size` requests are taken, the next compatible request would
+    not fit `memory_budget`, or `max_wait_ms` has passed since the oldest request arrived. The cond and
+    uncond halves of all requests of a batch run as one sequence batch with a per-request guidance scale
+    (requests without guidance use scale 1, i.e. the cond velocity). Every request's `Future` resolves to a
+    dict with its PNG bytes and timings as soon as its batch is decoded.
+
+    Admission control: `estimate_batch_bytes` gives a rough peak activation estimate of a batch. Requests
+    that could not run even alone within `memory_budget` (bytes) and requests arriving while
+    `max_queue_size` requests are pending are rejected with an `AdmissionError`. Cancelled requests are
+    skipped, and `stop()` fails the requests still pending with a `RuntimeError`.
+    """
+
+    def __init__(self, model, vae_model, text_tokenizer, showo_token_ids, config, sampler, max_batch_size=8,
+                 max_wait_ms=20, memory_budget=None, max_queue_size=256, resolutions=None):
+        self.model = model
+        self.vae_model = vae_model
+        self.text_tokenizer = text_tokenizer
+        self.config = config
+        self.sampler = sampler
+        self.device = next(model.parameters()).device
+        self.dtype = next(model.parameters()).dtype
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.memory_budget = memory_budget
+        self.max_queue_size = max_queue_size
+        self.resolutions = list(resolutions or [config.dataset.preprocessing.resolution])
+
+        _, _, _, _, self.max_text_len, self.image_latent_dim, self.patch_size, _, _, self.pad_id, self.bos_id, \
+            self.eos_id, self.boi_id, self.eoi_id, _, _, self.img_pad_id, _, _ = \
+            get_hyper_params(config, text_tokenizer, showo_token_ids)
+        self.default_guidance_scale = config.get("guidance_scale", config.transport.guidance_scale)
+        self.default_num_steps = config.get("num_inference_steps", config.transport.num_inference_steps)
+        self.use_prefix_cache = config.get("prefix_cache", True)
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self._worker = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._run, name="t2i-service", daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped.set()
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        with self._cond:
+            pending, self._pending = self._pending, []
+        for request in pending:
+            if request['future'].set_running_or_notify_cancel():
+                request['future'].set_exception(RuntimeError("T2IGenerationService was stopped"))
+
+    def layout(self, resolution):
+        """Latent grid (in patches), image tokens (with the time token) and sequence length at `resolution`."""
+        # the VAE downsamples 8x, the image embedders patchify the latents
+        grid = resolution // (8 * self.patch_size)
+        num_image_tokens = grid * grid + int(self.config.model.showo.add_time_embeds)
+        return grid, num_image_tokens, self.max_text_len + num_image_tokens + 4
+
+    def estimate_batch_bytes(self, num_requests, resolution, use_cfg=True):
+        """
+        Rough peak memory of generating `num_requests` images: the prefix keys/values of the LLM and the
+        diffusion head over the full sequence, plus the activations of one layer over the image tokens
+        (including the attention scores), per sequence. Weights and the VAE decode are not counted.
+        """
+        llm_config = self.model.showo.config
+        _, num_image_tokens, seq_len = self.layout(resolution)
+        num_layers = llm_config.num_hidden_layers + len(self.model.diffusion_head_a)
+        kv = 2 * num_layers * seq_len * llm_config.hidden_size
+        activations = num_image_tokens * (4 * llm_config.hidden_size + 2 * llm_config.intermediate_size) + \
+            llm_config.num_attention_heads * num_image_tokens * seq_len
+        num_sequences = num_requests * (2 if use_cfg else 1)
+        return num_sequences * (kv + activations) * torch.finfo(self.dtype).bits // 8
+
+    def submit(self, prompt, resolution=None, num_steps=None, guidance_scale=None, seed=None):
+        """Queue one request and return a `Future` resolving to its result dict."""
+        request = dict(prompt=prompt,
+                       resolution=resolution or self.resolutions[0],
+                       num_steps=num_steps or self.default_num_steps,
+                       guidance_scale=self.default_guidance_scale if guidance_scale is None else guidance_scale,
+                       seed=seed,
+                       future=Future())
+        if request['resolution'] not in self.resolutions:
+            raise ValueError(f"resolution {request['resolution']} is not served, expected one of {self.resolutions}")
+        if self.memory_budget is not None and self.estimate_batch_bytes(
+                1, request['resolution'], request['guidance_scale'] > 0) > self.memory_budget:
+            raise AdmissionError(f"a {request['resolution']}px request does not fit the memory budget")
+        with self._cond:
+            if self._stopped.is_set():
+                request['future'].set_exception(RuntimeError("T2IGenerationService was stopped"))
+                return request['future']
+            if len(self._pending) >= self.max_queue_size:
+                raise AdmissionError(f"{len(self._pending)} requests are already pending")
+            request['enqueued'] = time.perf_counter()
+            self._pending.append(request)
+            self._cond.notify_all()
+        return request['future']
+
+    def generate(self, requests):
+        """Blocking helper: submit all requests (dicts of `submit` arguments) and wait for them in order."""
+        futures = [self.submit(**request) for request in requests]
+        return [future.result() for future in futures]
+
+    def generate_stream(self, requests):
+        """Submit all requests and yield (index, result) in the order the images finish."""
+        futures = {self.submit(**request): i for i, request in enumerate(requests)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def _fits(self, batch, request):
+        if len(batch) >= self.max_batch_size:
+            return False
+        if self.memory_budget is None:
+            return True
+        use_cfg = any(r['guidance_scale'] > 0 for r in batch + [request])
+        return self.estimate_batch_bytes(len(batch) + 1, request['resolution'], use_cfg) <= self.memory_budget
+
+    def _select(self):
+        # the oldest request fixes the group, compatible requests join in arrival order while they fit
+        first = self._pending[0]
+        batch, full = [], False
+        for request in self._pending:
+            if (request['resolution'], request['num_steps']) != (first['resolution'], first['num_steps']):
+                continue
+            if not self._fits(batch, request):
+                full = True
+                break
+            batch.append(request)
+        return batch, full or len(batch) == self.max_batch_size
+
+    def _collect_batch(self):
+        with self._cond:
+            if len(self._pending) == 0:
+                self._cond.wait(timeout=0.1)
+                if len(self._pending) == 0:
+                    return []
+            deadline = self._pending[0]['enqueued'] + self.max_wait
+            while True:
+                batch, full = self._select()
+                remaining = deadline - time.perf_counter()
+                if full or remaining <= 0 or self._stopped.is_set():
+                    break
+                self._cond.wait(timeout=remaining)
+            for request in batch:
+                self._pending.remove(request)
+        # cancelled requests are dropped, the others can no longer be cancelled
+        return [request for request in batch if request['future'].set_running_or_notify_cancel()]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect_batch()
+            if len(batch) == 0:
+                continue
+            try:
+                results = self.generate_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request['future'].set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request['future'].set_result(result)
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _build_inputs(self, batch):
+        resolution = batch[0]['resolution']
+        grid, num_image_tokens, max_seq_len = self.layout(resolution)
+        use_cfg = any(r['guidance_scale'] > 0 for r in batch)
+
+        text_tokens, text_tokens_null, modality_positions, modality_positions_null = prepare_gen_input(
+            [r['prompt'] for r in batch], self.text_tokenizer, num_image_tokens, self.bos_id, self.eos_id,
+            self.boi_id, self.eoi_id, self.pad_id, self.img_pad_id, self.max_text_len, self.device
+        )
+        z = torch.cat([
+            torch.randn((1, self.image_latent_dim, grid * self.patch_size, grid * self.patch_size),
+                        generator=None if r['seed'] is None else torch.Generator().manual_seed(r['seed']))
+            for r in batch
+        ]).to(self.dtype).to(self.device)
+        guidance_scale = 0.0
+        if use_cfg:
+            # cond halves first, then uncond halves, as t2i_generate expects
+            z = torch.cat([z, z], dim=0)
+            text_tokens = torch.cat([text_tokens, text_tokens_null], dim=0)
+            modality_positions = torch.cat([modality_positions, modality_positions_null], dim=0)
+            guidance_scale = torch.tensor([r['guidance_scale'] if r['guidance_scale'] > 0 else 1.0 for r in batch],
+                                          dtype=self.dtype, device=self.device).view(-1, 1, 1, 1)
+        attention_mask = omni_attn_mask_compact(text_tokens.size(0), max_seq_len, modality_positions, self.device)
+
+        model_kwargs = dict(
+            text_tokens=text_tokens,
+            attention_mask=attention_mask,
+            modality_positions=modality_positions,
+            output_hidden_states=True,
+            max_seq_len=max_seq_len,
+            guidance_scale=guidance_scale
+        )
+        if self.use_prefix_cache:
+            model_kwargs['prefix_cache'] = self.model.build_t2i_prefix_cache(**model_kwargs)
+        return z, model_kwargs
+
+    @torch.no_grad()
+    def generate_batch(self, batch):
+        """Run one micro-batch of compatible requests synchronously on the calling thread."""
+        config = self.config
+        start = time.perf_counter()
+        queue_delays = [start - r['enqueued'] for r in batch]
+
+        z, model_kwargs = self._build_inputs(batch)
+        t_prompt = self._sync()
+
+        sample_fn = self.sampler.sample_ode(
+            sampling_method=config.transport.sampling_method,
+            num_steps=batch[0]['num_steps'],
+            atol=config.transport.atol,
+            rtol=config.transport.rtol,
+            reverse=config.transport.reverse,
+            time_shifting_factor=config.transport.time_shifting_factor
+        )
+        samples = sample_fn(z, self.model.t2i_generate, **model_kwargs)[-1][:len(batch)]
+        t_generate = self._sync()
+
+        images = self.vae_model.batch_decode(samples.unsqueeze(2), memory_budget=self.memory_budget).squeeze(2)
+        images = torch.clamp((images + 1.0) / 2.0, min=0.0, max=1.0) * 255.0
+        images = images.permute(0, 2, 3, 1).to(torch.uint8).cpu().numpy()
+        t_decode = self._sync()
+
+        pngs = []
+        for image in images:
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="PNG")
+            pngs.append(buffer.getvalue())
+        t_encode = time.perf_counter()
+
+        timings = {
+            "batch_size": len(batch),
+            "prompt": t_prompt - start,
+            "generate": t_generate - t_prompt,
+            "decode": t_decode - t_generate,
+            "png": t_encode - t_decode,
+            "total": t_encode - start,
+        }
+        return [{"prompt": r['prompt'], "png": png, "queue_delay": delay, "timings": timings}
+                for r, png, delay in zip(batch, pngs, queue_delays)]
+
+
+def build_service(config, device):
+    weight_type = torch.bfloat16 if config.model.weight_type == "bfloat16" else torch.float32
+    vae_model = WanVAE(vae_pth=config.model.vae_model.pretrained_model_path, dtype=weight_type, device=device)
+
+    text_tokenizer, showo_token_ids = get_text_tokenizer(config.model.showo.llm_model_path,
+                                                         add_showo_tokens=True,
+                                                         return_showo_token_ids=True,
+                                                         llm_name=path_to_llm_name[config.model.showo.llm_model_path])
+    config.model.showo.llm_vocab_size = len(text_tokenizer)
+    model = Showo2Qwen2_5.from_pretrained(config.model.showo.pretrained_model_path, use_safetensors=False).to(device)
+    model.to(weight_type)
+    model.eval()
+
+    if config.model.showo.add_time_embeds:
+        config.dataset.preprocessing.num_t2i_image_tokens += 1
+        config.dataset.preprocessing.num_mmu_image_tokens += 1
+        config.dataset.preprocessing.num_video_tokens += 1
+
+    transport = create_transport(
+        path_type=config.transport.path_type,
+        prediction=config.transport.prediction,
+        loss_weight=config.transport.loss_weight,
+        train_eps=config.transport.train_eps,
+        sample_eps=config.transport.sample_eps,
+        snr_type=config.transport.snr_type,
+        do_shift=config.transport.do_shift,
+        seq_len=config.dataset.preprocessing.num_t2i_image_tokens,
+    )
+    memory_budget_gb = config.get("memory_budget_gb", None)
+    return T2IGenerationService(model, vae_model, text_tokenizer, showo_token_ids, config, Sampler(transport),
+                                max_batch_size=config.get("max_batch_size", 8),
+                                max_wait_ms=config.get("max_wait_ms", 20),
+                                memory_budget=None if memory_budget_gb is None else memory_budget_gb * 1024 ** 3,
+                                max_queue_size=config.get("max_queue_size", 256),
+                                resolutions=config.get("resolutions", None))
+
+
+if __name__ == '__main__':
+    # python t2i_service.py config=configs/showo2_1.5b_demo_432x432.yaml memory_budget_gb=16 \
+    #     validation_prompts_file=validation_prompts/fashion_prompts.txt output_dir=service_outputs
+    config = get_config()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    service = build_service(config, device).start()
+
+    with open(config.get("validation_prompts_file", config.dataset.params.validation_prompts_file), "r") as f:
+        prompts = [p for p in f.read().splitlines() if len(p) != 0]
+    # mix step counts and guidance scales, requests with the same step count share batches
+    step_counts = list(config.get("step_counts", [service.default_num_steps]))
+    requests = [dict(prompt=prompt, num_steps=step_counts[i % len(step_counts)], seed=i)
+                for i, prompt in enumerate(prompts)]
+
+    output_dir = config.get("output_dir", "service_outputs")
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    for i, result in service.generate_stream(requests):
+        with open(os.path.join(output_dir, f"{i:05d}.png"), "wb") as f:
+            f.write(result["png"])
+        results.append(result)
+    service.stop()
+
+    for stage in ["batch_size", "prompt", "generate", "decode", "png", "total"]:
+        print(f"{stage}: {np.mean([r['timings'][stage] for r in results]):.3f} per batch")
+    print(f"queue delay: {np.mean([r['queue_delay'] for r in results]):.3f}s mean, "
+          f"{np.max([r['queue_delay'] for r in results]):.3f}s max")
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from models.wan21_vae import WanVAE_
+
+SCALE = [0.0, 1.0]
+
+
+def make_vae():
+    # a tiny randomly initialised decoder: 2x spatial / 2x temporal upsampling, the mid attention is local at
+    # init (zero output projection), so a decoded pixel only depends on latents within ~13 latent pixels
+    torch.manual_seed(0)
+    return WanVAE_(dim=8, z_dim=4, dim_mult=[1, 2], num_res_blocks=1, temperal_downsample=[True]).eval()
+
+
+@pytest.mark.parametrize("num_frames", [1, 3])
+def test_tiled_decode_matches_untiled(num_frames):
+    vae = make_vae()
+    z = torch.randn(2, 4, num_frames, 32, 32, generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        full = vae.decode(z, SCALE)
+        # tiles [0, 24) and [8, 32) in both directions
+        tiled = vae.decode(z, SCALE, tile_size=24, tile_overlap=8)
+
+    assert tiled.shape == full.shape == (2, 3, 1 + 2 * (num_frames - 1), 64, 64)
+    # far from every tile border the tiles see the whole receptive field, so the corners are exact
+    for ys in [slice(0, 16), slice(48, 64)]:
+        for xs in [slice(0, 16), slice(48, 64)]:
+            assert torch.allclose(tiled[..., ys, xs], full[..., ys, xs], atol=1e-4)
+    # and the feathered seams stay close to the untiled decode
+    assert (tiled - full).abs().mean() < 0.1 * full.abs().mean()
+
+
+def test_decode_tile_size_from_memory_budget():
+    vae = make_vae()
+    shape = (1, 4, 1, 32, 32)
+    assert vae.decode_tile_size(shape, memory_budget=2 ** 30) is None
+
+    tile_size = vae.decode_tile_size(shape, memory_budget=2 ** 18, tile_overlap=4)
+    assert 4 < tile_size < 32
+    assert vae.decode_tile_size(shape, memory_budget=2 ** 16, tile_overlap=4) < tile_size
+    # videos also hold the causal conv caches, so they get smaller tiles
+    assert vae.decode_tile_size((1, 4, 3, 32, 32), memory_budget=2 ** 18, tile_overlap=4) < tile_size
+
+    z = torch.randn(shape, generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        budgeted = vae.decode(z, SCALE, tile_overlap=4, memory_budget=2 ** 18)
+        tiled = vae.decode(z, SCALE, tile_size=tile_size, tile_overlap=4)
+    assert torch.equal(budgeted, tiled)
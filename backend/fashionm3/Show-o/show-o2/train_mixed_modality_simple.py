@@ -34,7 +34,7 @@ from accelerate.logging import get_logger
 from accelerate.utils import DistributedType, set_seed
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from models import Showo2Qwen2_5, omni_attn_mask_naive
+from models import Showo2Qwen2_5, omni_attn_mask_compact
 from models.lr_schedulers import get_scheduler
 from models.my_logging import set_verbosity_info, set_verbosity_error
 from models.misc import prepare_gen_input, get_text_tokenizer, get_weight_type
@@ -432,10 +432,12 @@ def main():
             #                                Q_LEN=preproc_config.max_seq_length,
             #                                KV_LEN=preproc_config.max_seq_length, device=accelerator.device)
             # or use naive omni attention mask, which is more stable
-            block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                              text_tokens.size(1),
-                                              modality_positions,
-                                              accelerator.device).to(weight_type)
+            # every training batch has a new layout: no cache, so no host copy of modality_positions
+            block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                                text_tokens.size(1),
+                                                modality_positions,
+                                                accelerator.device,
+                                                cache_size=0)
 
             logits, loss_ntp, loss_flow = model(text_tokens=text_tokens,
                                                 image_latents=image_latents,
@@ -601,10 +603,10 @@ def generate_images(
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
         # or use naive omni attention mask, which is more stable
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
     else:
         text_tokens = batch_text_tokens
         modality_positions = batch_modality_positions
@@ -613,10 +615,10 @@ def generate_images(
         # omni_mask_fn = omni_attn_mask(modality_positions)
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
 
     model_kwargs = dict(
         text_tokens=torch.cat([batch_text_tokens, batch_text_tokens_null], dim=0),
@@ -720,10 +722,10 @@ def generate_videos(
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
         # or use naive omni attention mask, which is more stable
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
     else:
         text_tokens = batch_text_tokens
         modality_positions = batch_modality_positions
@@ -732,10 +734,10 @@ def generate_videos(
         # omni_mask_fn = omni_attn_mask(modality_positions)
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
 
     model_kwargs = dict(
         text_tokens=text_tokens,
@@ -31,7 +31,7 @@ from einops import rearrange
 from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import DistributedType, set_seed
-from models import Showo2Qwen2_5, omni_attn_mask_naive
+from models import Showo2Qwen2_5, omni_attn_mask_compact
 from models.lr_schedulers import get_scheduler
 from models.my_logging import set_verbosity_info, set_verbosity_error
 from models.misc import prepare_gen_input, get_text_tokenizer, get_weight_type
@@ -42,7 +42,7 @@ os.environ["TOKENIZERS_PARALLELISM"] = "true"
 if torch.cuda.is_available():
     flex_attention = torch.compile(flex_attention)
 
-from datasets import create_imagetext_dataloader, MixedDataLoader
+from datasets import create_imagetext_dataloader, MixedDataLoader, PrefetchLoader
 from utils import get_config, flatten_omega_conf, AverageMeter, denorm, denorm_vid, get_hyper_params, \
     path_to_llm_name, _freeze_params
 
@@ -305,6 +305,11 @@ def main():
         accumulation=config.dataset.accumulation,
         mode=config.dataset.mixed_loader_mode
     )
+    prefetch_batches = config.training.get("prefetch_batches", 0)
+    if prefetch_batches > 0:
+        # pin and copy the next batches to the device in the background, see datasets/prefetch_loader.py
+        mixed_loader = PrefetchLoader(mixed_loader, accelerator.device, num_prefetch=prefetch_batches,
+                                      num_threads=config.training.get("prefetch_threads", 2))
 
     lr_scheduler = get_scheduler(
         config.lr_scheduler.scheduler,
@@ -426,10 +431,12 @@ def main():
             #                                Q_LEN=preproc_config.max_seq_length,
             #                                KV_LEN=preproc_config.max_seq_length, device=accelerator.device)
             # or use naive omni attention mask, which is more stable
-            block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                              text_tokens.size(1),
-                                              modality_positions,
-                                              accelerator.device).to(weight_type)
+            # every training batch has a new layout: no cache, so no host copy of modality_positions
+            block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                                text_tokens.size(1),
+                                                modality_positions,
+                                                accelerator.device,
+                                                cache_size=0)
 
             logits, loss_ntp, loss_flow = model(text_tokens=text_tokens,
                                                 image_latents=image_latents,
@@ -493,6 +500,8 @@ def main():
                             "data_time": data_time_m.val,
                             "batch_time": batch_time_m.val,
                         }
+                        if prefetch_batches > 0:
+                            logs.update(mixed_loader.stats())
                         accelerator.log(logs, step=global_step + 1)
                         logger.info(
                             f"Epoch: {epoch} "
@@ -514,6 +523,8 @@ def main():
                             "data_time": data_time_m.val,
                             "batch_time": batch_time_m.val,
                         }
+                        if prefetch_batches > 0:
+                            logs.update(mixed_loader.stats())
                         accelerator.log(logs, step=global_step + 1)
                         logger.info(
                             f"Epoch: {epoch} "
@@ -642,10 +653,10 @@ def generate_images(
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
         # or use naive omni attention mask, which is more stable
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
     else:
         text_tokens = batch_text_tokens
         modality_positions = batch_modality_positions
@@ -654,10 +665,10 @@ def generate_images(
         # omni_mask_fn = omni_attn_mask(modality_positions)
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
 
     model_kwargs = dict(
         text_tokens=torch.cat([batch_text_tokens, batch_text_tokens_null], dim=0),
@@ -761,10 +772,10 @@ def generate_videos(
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
         # or use naive omni attention mask, which is more stable
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
     else:
         text_tokens = batch_text_tokens
         modality_positions = batch_modality_positions
@@ -773,10 +784,10 @@ def generate_videos(
         # omni_mask_fn = omni_attn_mask(modality_positions)
         # block_mask = create_block_mask(omni_mask_fn, B=z.size(0), H=None, Q_LEN=max_seq_len,
         #                                KV_LEN=max_seq_len, device=device)
-        block_mask = omni_attn_mask_naive(text_tokens.size(0),
-                                          max_seq_len,
-                                          modality_positions,
-                                          device).to(weight_type)
+        block_mask = omni_attn_mask_compact(text_tokens.size(0),
+                                            max_seq_len,
+                                            modality_positions,
+                                            device)
 
     model_kwargs = dict(
         text_tokens=text_tokens,
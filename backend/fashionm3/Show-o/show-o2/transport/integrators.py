@@ -91,19 +91,28 @@ class ode:
         rtol,
         do_shift=False,
         time_shifting_factor=None,
+        path_sampler=None,
+        timesteps=None,
     ):
         assert t0 < t1, "ODE sampler has to be in forward time"
 
         self.drift = drift
         self.do_shift = do_shift
-        self.t = th.linspace(t0, t1, num_steps)
-        if time_shifting_factor:
-            self.t = self.t / (self.t + time_shifting_factor - time_shifting_factor * self.t)
+        if timesteps is not None:
+            # e.g. the few timesteps a step-distilled model was trained on
+            self.t = th.as_tensor(timesteps, dtype=th.float32)
+        else:
+            self.t = th.linspace(t0, t1, num_steps)
+            if time_shifting_factor:
+                self.t = self.t / (self.t + time_shifting_factor - time_shifting_factor * self.t)
         self.atol = atol
         self.rtol = rtol
         self.sampler_type = sampler_type
+        self.path_sampler = path_sampler
 
     def sample(self, x, model, **model_kwargs):
+        if self.sampler_type in MULTISTEP_SOLVERS:
+            return self.sample_multistep(x, model, **model_kwargs)
         x = x.float()
         device = x[0].device if isinstance(x, tuple) else x.device
 
@@ -120,3 +129,89 @@ class ode:
         rtol = [self.rtol] * len(x) if isinstance(x, tuple) else [self.rtol]
         samples = odeint(_fn, x, t, method=self.sampler_type, atol=atol, rtol=rtol)
         return samples
+
+    def sample_multistep(self, x, model, **model_kwargs):
+        """
+        Fixed-step multistep solvers on the data prediction x1 = (d_sigma * x - sigma * v) / (alpha * d_sigma -
+        sigma * d_alpha) recovered from the ODE velocity v of the path x = alpha * x1 + sigma * x0:
+
+        - "dpm++2m": DPM-Solver++(2M)
+        - "unipc": UniPC (B(h) = expm1(h)) with a second order predictor and corrector, the corrector reusing
+          the model evaluation of the next step
+
+        Exactly len(t) - 1 model evaluations; the first step and the step to sigma = 0 are first order (the
+        first one is Euler when it starts from pure noise). Returns the states at every t, like odeint.
+        """
+        x = x.float()
+        device = x.device
+        t = self.t.to(device)
+        if self.do_shift:
+            mu = get_lin_function(y1=0.5, y2=1.15)(x.shape[1])
+            t = time_shift(mu, 1.0, t)
+
+        # scalar schedule in float64, lambda = log(alpha / sigma) is -inf at pure noise and inf at the data
+        ts = t.double()
+        alpha, d_alpha = self.path_sampler.compute_alpha_t(ts)
+        sigma, d_sigma = self.path_sampler.compute_sigma_t(ts)
+        alpha, d_alpha, sigma, d_sigma = (th.as_tensor(v, dtype=th.float64, device=device).expand_as(ts)
+                                          for v in (alpha, d_alpha, sigma, d_sigma))
+        lambdas = th.log(alpha) - th.log(sigma)
+
+        def data_prediction(x, i):
+            v = self.drift(x, th.ones(x.size(0), device=device) * t[i], model, **model_kwargs).float()
+            return ((d_sigma[i] * x - sigma[i] * v) / (alpha[i] * d_sigma[i] - sigma[i] * d_alpha[i])).float()
+
+        samples = [x]
+        m0 = data_prediction(x, 0)
+        m_prev, lambda_prev = None, None
+        for i in range(len(t) - 1):
+            # first order step: sigma_t / sigma_s * x + alpha_t * (1 - e^-h) * m0, with e^-h in ratio form
+            exp_neg_h = (alpha[i] * sigma[i + 1]) / (sigma[i] * alpha[i + 1])
+            h = lambdas[i + 1] - lambdas[i]
+            x_first = (sigma[i + 1] / sigma[i]).float() * x + (alpha[i + 1] * (1 - exp_neg_h)).float() * m0
+            second_order = m_prev is not None and th.isfinite(h) and th.isfinite(lambda_prev)
+            if second_order:
+                r = (lambdas[i] - lambda_prev) / h
+                d1 = (m0 - m_prev) / r.float()
+
+            if not second_order:
+                x_next = x_first
+            elif self.sampler_type == "dpm++2m":
+                x_next = x_first + (0.5 * alpha[i + 1] * (1 - exp_neg_h)).float() * d1
+            else:
+                x_next = x_first - (0.5 * alpha[i + 1] * th.expm1(-h)).float() * d1
+
+            is_last = i + 1 == len(t) - 1
+            if not is_last:
+                m_next = data_prediction(x_next, i + 1)
+                if self.sampler_type == "unipc" and th.isfinite(h) and th.isfinite(lambdas[i + 1]):
+                    # the corrected state reuses the model output of the predicted one
+                    x_next = x_first + self._unipc_correction(h, m0, m_next, d1 if second_order else None,
+                                                              r if second_order else None, alpha[i + 1])
+                m_prev, lambda_prev, m0 = m0, lambdas[i], m_next
+            x = x_next
+            samples.append(x)
+        return th.stack(samples)
+
+    @staticmethod
+    def _unipc_correction(h, m0, m_next, d1, r, alpha_next):
+        """UniC: the correction added to the first order step, using the model output at the next step."""
+        hh = -h
+        h_phi_1 = th.expm1(hh)
+        # the B(h) = expm1(h) ("bh2") variant of UniPC, so B(h) is h * phi_1(h)
+        b_h = h_phi_1
+        h_phi_2 = h_phi_1 / hh - 1
+        d1_next = m_next - m0
+        if d1 is None:
+            correction = 0.5 * d1_next
+        else:
+            # [[1, 1], [r_k, 1]] rho = [phi_2 / B(h), 2 * phi_3 / B(h)], r_k = (lambda_prev - lambda_s) / h = -r
+            h_phi_3 = h_phi_2 / hh - 0.5
+            b = th.stack([h_phi_2 / b_h, 2 * h_phi_3 / b_h])
+            R = th.stack([th.ones_like(r), th.ones_like(r), -r, th.ones_like(r)]).view(2, 2)
+            rho = th.linalg.solve(R, b)
+            correction = rho[0].float() * d1 + rho[1].float() * d1_next
+        return -(alpha_next * b_h).float() * correction
+
+
+MULTISTEP_SOLVERS = ("dpm++2m", "unipc")
@@ -407,15 +407,18 @@ class Sampler:
         reverse=False,
         do_shift=False,
         time_shifting_factor=None, 
+        timesteps=None,
     ):
         """returns a sampling function with given ODE settings
         Args:
         - sampling_method: type of sampler used in solving the ODE; default to be Dopri5
         - num_steps:
             - fixed solver (Euler, Heun): the actual number of integration steps performed
+            - multistep solver (dpm++2m, unipc): num_steps - 1 model evaluations
             - adaptive solver (Dopri5): the number of datapoints saved during integration; produced by interpolation
         - atol: absolute error tolerance for the solver
         - rtol: relative error tolerance for the solver
+        - timesteps: explicit time grid replacing num_steps / time_shifting_factor (e.g. for step-distilled models)
         """
 
         # for flux
@@ -440,6 +443,8 @@ class Sampler:
             rtol=rtol,
             do_shift=do_shift,
             time_shifting_factor=time_shifting_factor,
+            path_sampler=self.transport.path_sampler,
+            timesteps=timesteps,
         )
 
         return _ode.sample
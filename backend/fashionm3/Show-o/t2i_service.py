@@ -0,0 +1,265 @@
+# coding=utf-8
+# Copyright 2024 NUS Show Lab.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
+import io
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+from PIL import Image
+from models import Showo, MAGVITv2, get_mask_chedule
+from training.prompting_utils import UniversalPrompting, create_attention_mask_predict_next
+from training.utils import get_config
+from transformers import AutoTokenizer
+
+
+class T2IGenerationService:
+    """
+    Long-lived text-to-image service around `Showo.t2i_generate` + `MAGVITv2.decode_code`.
+
+    Prompts submitted from any thread are collected by a single worker thread into dynamic
+    micro-batches: a batch is closed once `max_batch_size` prompts are queued or `max_wait_ms` has
+    passed since its first prompt arrived. Each micro-batch runs classifier-free guidance as one
+    forward per step, is decoded in chunks of `decode_batch_size` and every prompt gets back a dict
+    with its PNG bytes and the queueing delay / per-stage timings (in seconds) of its batch.
+    Cancelled futures are skipped, and `stop()` fails the prompts still queued with a `RuntimeError`.
+    """
+
+    def __init__(self, model, vq_model, uni_prompting, config, max_batch_size=8, max_wait_ms=20,
+                 decode_batch_size=None, decode_tile_size=None, mask_aware_sampler=False):
+        self.model = model
+        self.vq_model = vq_model
+        self.uni_prompting = uni_prompting
+        self.config = config
+        self.device = next(model.parameters()).device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.decode_batch_size = decode_batch_size or max_batch_size
+        self.decode_tile_size = decode_tile_size
+
+        self.guidance_scale = config.get("guidance_scale", config.training.get("guidance_scale", 0))
+        self.timesteps = config.get("generation_timesteps", config.training.get("generation_timesteps", 18))
+        self.temperature = config.training.get("generation_temperature", 1.0)
+        if config.get("mask_schedule", None) is not None:
+            self.mask_schedule = get_mask_chedule(config.mask_schedule.schedule,
+                                                  **config.mask_schedule.get("params", {}))
+        else:
+            self.mask_schedule = get_mask_chedule(config.training.get("mask_schedule", "cosine"))
+        self.t2i_generate = model.t2i_generate_masked if mask_aware_sampler else model.t2i_generate
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._stopped = threading.Event()
+        # orders submit() against the draining in stop(), so no future is left unresolved
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._run, name="t2i-service", daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopped.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        while True:
+            try:
+                _, _, future = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("T2IGenerationService was stopped"))
+
+    def submit(self, prompt):
+        """Queue one prompt and return a `Future` resolving to its result dict."""
+        future = Future()
+        with self._lock:
+            if self._stopped.is_set():
+                future.set_exception(RuntimeError("T2IGenerationService was stopped"))
+            else:
+                self._queue.put((prompt, time.perf_counter(), future))
+        return future
+
+    def generate(self, prompts):
+        """Blocking helper: submit all prompts and wait for their results in order."""
+        futures = [self.submit(prompt) for prompt in prompts]
+        return [future.result() for future in futures]
+
+    def _collect_batch(self):
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first[1] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # cancelled prompts are dropped, the others can no longer be cancelled
+            batch = [item for item in self._collect_batch() if item[2].set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            prompts, enqueue_times, futures = zip(*batch)
+            try:
+                results = self.generate_batch(list(prompts), enqueue_times=enqueue_times)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _build_inputs(self, prompts):
+        config = self.config
+        uni_prompting = self.uni_prompting
+        mask_token_id = self.model.config.mask_token_id
+        image_tokens = torch.ones((len(prompts), config.model.showo.num_vq_tokens),
+                                  dtype=torch.long, device=self.device) * mask_token_id
+        input_ids, _ = uni_prompting((prompts, image_tokens), 't2i_gen')
+
+        if self.guidance_scale > 0:
+            uncond_input_ids, _ = uni_prompting(([''] * len(prompts), image_tokens), 't2i_gen')
+            mask_input = torch.cat([input_ids, uncond_input_ids], dim=0)
+        else:
+            uncond_input_ids = None
+            mask_input = input_ids
+        attention_mask = create_attention_mask_predict_next(mask_input,
+                                                            pad_id=int(uni_prompting.sptids_dict['<|pad|>']),
+                                                            soi_id=int(uni_prompting.sptids_dict['<|soi|>']),
+                                                            eoi_id=int(uni_prompting.sptids_dict['<|eoi|>']),
+                                                            rm_pad_in_image=True)
+        return input_ids, uncond_input_ids, attention_mask
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, enqueue_times=None):
+        """Run one micro-batch synchronously on the calling thread."""
+        config = self.config
+        start = time.perf_counter()
+        if enqueue_times is None:
+            enqueue_times = [start] * len(prompts)
+        queue_delays = [start - enqueued for enqueued in enqueue_times]
+
+        input_ids, uncond_input_ids, attention_mask = self._build_inputs(prompts)
+        t_prompt = self._sync()
+
+        gen_token_ids = self.t2i_generate(
+            input_ids=input_ids,
+            uncond_input_ids=uncond_input_ids,
+            attention_mask=attention_mask,
+            guidance_scale=self.guidance_scale,
+            temperature=self.temperature,
+            timesteps=self.timesteps,
+            noise_schedule=self.mask_schedule,
+            config=config,
+        )
+        gen_token_ids = torch.clamp(gen_token_ids, max=config.model.showo.codebook_size - 1, min=0)
+        t_generate = self._sync()
+
+        images = []
+        for i in range(0, len(prompts), self.decode_batch_size):
+            decoded = self.vq_model.decode_code(gen_token_ids[i:i + self.decode_batch_size],
+                                                tile_size=self.decode_tile_size)
+            decoded = torch.clamp((decoded + 1.0) / 2.0, min=0.0, max=1.0) * 255.0
+            images.append(decoded.permute(0, 2, 3, 1).to(torch.uint8).cpu().numpy())
+        images = np.concatenate(images, axis=0)
+        t_decode = self._sync()
+
+        pngs = []
+        for image in images:
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="PNG")
+            pngs.append(buffer.getvalue())
+        t_encode = time.perf_counter()
+
+        timings = {
+            "batch_size": len(prompts),
+            "prompt": t_prompt - start,
+            "generate": t_generate - t_prompt,
+            "decode": t_decode - t_generate,
+            "png": t_encode - t_decode,
+            "total": t_encode - start,
+        }
+        return [{"prompt": prompt, "png": png, "queue_delay": delay, "timings": timings}
+                for prompt, png, delay in zip(prompts, pngs, queue_delays)]
+
+
+def build_service(config, device):
+    tokenizer = AutoTokenizer.from_pretrained(config.model.showo.llm_model_path, padding_side="left")
+    uni_prompting = UniversalPrompting(tokenizer, max_text_len=config.dataset.preprocessing.max_seq_length,
+                                       special_tokens=("<|soi|>", "<|eoi|>", "<|sov|>", "<|eov|>", "<|t2i|>", "<|mmu|>", "<|t2v|>", "<|v2v|>", "<|lvg|>"),
+                                       ignore_id=-100, cond_dropout_prob=config.training.cond_dropout_prob)
+
+    vq_model = MAGVITv2.from_pretrained(config.model.vq_model.vq_model_name).to(device)
+    vq_model.requires_grad_(False)
+    vq_model.eval()
+
+    model = Showo.from_pretrained(config.model.showo.pretrained_model_path).to(device)
+    model.eval()
+
+    return T2IGenerationService(model, vq_model, uni_prompting, config,
+                                max_batch_size=config.get("max_batch_size", 8),
+                                max_wait_ms=config.get("max_wait_ms", 20),
+                                decode_batch_size=config.get("decode_batch_size", None),
+                                decode_tile_size=config.get("decode_tile_size", None),
+                                mask_aware_sampler=config.get("mask_aware_sampler", False))
+
+
+if __name__ == '__main__':
+    # python t2i_service.py config=configs/showo_demo_512x512.yaml guidance_scale=5 generation_timesteps=50 \
+    #     validation_prompts_file=validation_prompts/fashion_prompts.txt output_dir=service_outputs
+    config = get_config()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    service = build_service(config, device).start()
+
+    with open(config.get("validation_prompts_file", "validation_prompts/fashion_prompts.txt"), "r") as f:
+        prompts = [p for p in f.read().splitlines() if len(p) != 0]
+
+    output_dir = config.get("output_dir", "service_outputs")
+    os.makedirs(output_dir, exist_ok=True)
+    results = service.generate(prompts)
+    service.stop()
+
+    for i, result in enumerate(results):
+        with open(os.path.join(output_dir, f"{i:05d}.png"), "wb") as f:
+            f.write(result["png"])
+
+    for stage in ["prompt", "generate", "decode", "png", "total"]:
+        print(f"{stage}: {np.mean([r['timings'][stage] for r in results]):.3f}s per batch")
+    print(f"queue delay: {np.mean([r['queue_delay'] for r in results]):.3f}s mean, "
+          f"{np.max([r['queue_delay'] for r in results]):.3f}s max")
@@ -0,0 +1,85 @@
+import os
+import json
+import tarfile
+import tempfile
+
+
+def load_tar_index(tar_path, cache=True):
+    """
+    Map every regular member of `tar_path` to its (data offset, size) in bytes.
+
+    The index is built with one sequential pass over the tar headers and cached next to the tar as
+    `<tar_path>.members.json`. The cache is rebuilt when the tar's size or mtime changes, and is only
+    kept in memory when the tar directory is not writable.
+    """
+    stat = os.stat(tar_path)
+    index_path = tar_path + ".members.json"
+    if cache and os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime:
+                return {name: tuple(entry) for name, entry in index["members"].items()}
+        except (ValueError, KeyError):
+            pass
+
+    members = {}
+    with tarfile.open(tar_path, 'r') as tar:
+        for member in tar:
+            if member.isfile():
+                members[member.name] = (member.offset_data, member.size)
+
+    if cache:
+        # a temporary file of its own per writer, so ranks and workers indexing the same tar do not race
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(index_path), prefix=os.path.basename(index_path),
+                                             suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "members": members}, f)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return members
+
+
+class TarReader:
+    """
+    Reads tar members by (offset, size) with `os.pread` on file descriptors that stay open.
+
+    Descriptors are opened lazily and dropped on pickling and after a fork, so every DataLoader
+    worker keeps its own set of open tars.
+    """
+    def __init__(self):
+        self._fds = {}
+        self._pid = os.getpid()
+
+    def read(self, tar_path, offset, size):
+        if self._pid != os.getpid():
+            self._fds = {}
+            self._pid = os.getpid()
+        fd = self._fds.get(tar_path)
+        if fd is None:
+            fd = os.open(tar_path, os.O_RDONLY)
+            self._fds[tar_path] = fd
+        return os.pread(fd, size, offset)
+
+    def close(self):
+        if self._pid == os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+        self._fds = {}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self._fds = {}
+        self._pid = os.getpid()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
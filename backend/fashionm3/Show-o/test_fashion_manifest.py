@@ -0,0 +1,84 @@
+import io
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import fashion_image_generation_dataset
+from fashion_image_generation_dataset import FashionImageGenerationDataset
+
+
+def write_synthetic_tar(tar_path, start, num_samples, missing_image=None):
+    """Tar of 0000000.jpg + 0000000.txt pairs, like fashion_image_generation/*.tar"""
+    with tarfile.open(tar_path, 'w') as tar:
+        for i in range(start, start + num_samples):
+            key = f"{i:07d}"
+            files = {f"{key}.txt": f"A fashion item number {i}.".encode('utf-8')}
+            if i != missing_image:
+                buffer = io.BytesIO()
+                Image.new('RGB', (8 + i % 4, 8), color=(i % 256, 0, 0)).save(buffer, format='JPEG')
+                files[f"{key}.jpg"] = buffer.getvalue()
+            for name, data in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+def make_split(data_root, num_tars=3, samples_per_tar=5, missing_image=None):
+    split_path = os.path.join(data_root, "train")
+    os.makedirs(split_path)
+    for t in range(num_tars):
+        write_synthetic_tar(os.path.join(split_path, f"{t:03d}.tar"), t * samples_per_tar, samples_per_tar,
+                            missing_image=missing_image)
+    return split_path
+
+
+def test_manifest_matches_tar_scan(tmp_path):
+    data_root = str(tmp_path)
+    make_split(data_root, missing_image=7)
+
+    scanned = FashionImageGenerationDataset(data_root=data_root, split="train")
+    mapped = FashionImageGenerationDataset(data_root=data_root, split="train", use_manifest=True)
+
+    assert len(scanned) == len(mapped) == 14
+    for idx in range(len(scanned)):
+        expected, sample = scanned[idx], mapped[idx]
+        assert sample["input_ids"] == expected["input_ids"]
+        assert sample["images"].size == expected["images"].size
+        assert sample["images"].mode == "RGB"
+
+
+def test_manifest_is_reused_until_tars_change(tmp_path, monkeypatch):
+    data_root = str(tmp_path)
+    split_path = make_split(data_root, num_tars=50, samples_per_tar=4)
+    manifest_path = os.path.join(split_path, "manifest.npy")
+
+    FashionImageGenerationDataset(data_root=data_root, split="train", use_manifest=True)
+    built_at = os.stat(manifest_path).st_mtime_ns
+
+    def scan(*args, **kwargs):
+        raise AssertionError("the tars were scanned again")
+
+    with monkeypatch.context() as m:
+        m.setattr(fashion_image_generation_dataset, "load_tar_index", scan)
+        dataset = FashionImageGenerationDataset(data_root=data_root, split="train", use_manifest=True)
+    # reused as is: neither rebuilt nor are the tars scanned again
+    assert os.stat(manifest_path).st_mtime_ns == built_at
+    assert len(dataset) == 200
+
+    write_synthetic_tar(os.path.join(split_path, "050.tar"), 200, 4)
+    dataset = FashionImageGenerationDataset(data_root=data_root, split="train", use_manifest=True)
+    assert len(dataset) == 204
+    assert dataset[203]["input_ids"] == "A fashion item number 203."
+
+
+def test_concurrent_builds_leave_one_complete_manifest(tmp_path):
+    split_path = make_split(str(tmp_path))
+    # builders running at once, as ranks finding the same stale manifest, must not share a temporary file
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        tables = list(pool.map(fashion_image_generation_dataset.build_manifest, [split_path] * 4))
+
+    dataset = FashionImageGenerationDataset(data_root=str(tmp_path), split="train", use_manifest=True)
+    assert all((table == tables[0]).all() for table in tables)
+    assert len(dataset) == 15
+    assert not [name for name in os.listdir(split_path) if name.endswith('.tmp')]
@@ -22,7 +22,7 @@ import os
 import random
 import re
 from functools import partial
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from PIL import Image
 
@@ -339,5 +339,93 @@ class Text2ImageDataset:
         return self._train_dataloader
 
 
+class FashionWebDataset:
+    """
+    Streaming loader over the sequential shards written by `reshard_fashion_data.py`.
+
+    `train_shards_path_or_url` is either one brace pattern (fashion T2I shards) or a dict mapping each
+    FashionRec task to its pattern, in which case the per-task streams are mixed with `task_weights`
+    (e.g. basic/personalized/alternative = 0.26/0.63/0.11). With `resample=True` every worker draws
+    shards with replacement like `Text2ImageDataset`, otherwise the shard list is split across ranks and
+    workers and each shard is read once per epoch. Batches are dicts with "images" and raw-text "input_ids".
+    """
+    def __init__(
+            self,
+            train_shards_path_or_url: Union[str, Dict[str, str]],
+            num_train_examples: int,
+            per_gpu_batch_size: int,
+            global_batch_size: int,
+            num_workers: int,
+            resolution: int = 256,
+            shuffle_buffer_size: int = 1000,
+            pin_memory: bool = False,
+            persistent_workers: bool = False,
+            task_weights: Optional[Dict[str, float]] = None,
+            resample: bool = True,
+    ):
+        processing_pipeline = [
+            wds.decode("pil", handler=wds.ignore_and_continue),
+            wds.rename(
+                images="jpg;png;jpeg;webp",
+                input_ids="text;txt;caption",
+                handler=wds.warn_and_continue,
+            ),
+            wds.map(filter_keys(set(["images", "input_ids"]))),
+            wds.map(partial(image_transform, resolution=resolution), handler=wds.warn_and_continue),
+        ]
+
+        def sample_stream(urls):
+            urls = list(braceexpand(urls))
+            if resample:
+                shards = [wds.ResampledShards(urls)]
+            else:
+                shards = [wds.SimpleShardList(urls), wds.split_by_node, wds.split_by_worker]
+            return wds.DataPipeline(
+                *shards,
+                tarfile_to_samples_nothrow,
+                wds.shuffle(shuffle_buffer_size),
+                *processing_pipeline,
+            )
+
+        if isinstance(train_shards_path_or_url, str):
+            source = sample_stream(train_shards_path_or_url)
+        else:
+            tasks = list(train_shards_path_or_url.keys())
+            probs = [task_weights[task] for task in tasks] if task_weights is not None else None
+            # resampled streams never run dry; with a single pass, mixing stops with the longest task
+            source = wds.RandomMix([sample_stream(train_shards_path_or_url[task]) for task in tasks],
+                                   probs=probs, longest=not resample)
+
+        pipeline = [
+            source,
+            wds.batched(per_gpu_batch_size, partial=False, collation_fn=default_collate),
+        ]
+
+        num_worker_batches = math.ceil(num_train_examples / (global_batch_size * num_workers))  # per dataloader worker
+        num_batches = num_worker_batches * num_workers
+        num_samples = num_batches * global_batch_size
+
+        self._train_dataset = wds.DataPipeline(*pipeline).with_epoch(num_worker_batches)
+        self._train_dataloader = wds.WebLoader(
+            self._train_dataset,
+            batch_size=None,
+            shuffle=False,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+        )
+        # add meta-data to dataloader instance for convenience
+        self._train_dataloader.num_batches = num_batches
+        self._train_dataloader.num_samples = num_samples
+
+    @property
+    def train_dataset(self):
+        return self._train_dataset
+
+    @property
+    def train_dataloader(self):
+        return self._train_dataloader
+
+
 if __name__ == '__main__':
     pass
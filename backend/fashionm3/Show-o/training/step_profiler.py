@@ -0,0 +1,96 @@
+import os
+import time
+from collections import defaultdict
+
+import torch
+
+
+class StepProfiler:
+    """
+    Per-stage timing of the training step without any synchronization between log points.
+
+    Call `begin_step()` when the batch is available and `mark(stage)` at the end of every stage; the time
+    since the previous mark is attributed to `stage` (the same stage may be marked several times per step).
+    On CUDA every mark records an event on the current stream, on CPU it reads a perf counter. Events are
+    only resolved in `summary()`, which synchronizes once and should be called at log points.
+
+    `summary()` reports ms per step for every stage, tokens/sec over the log window and the model FLOPs
+    utilization, estimated as 6 * num_params FLOPs per trained token (attention FLOPs are not counted)
+    against `peak_tflops` per device.
+
+    If `trace_steps` = (start, end) is given, a `torch.profiler` trace of steps [start, end) is written to
+    `trace_dir`.
+    """
+    def __init__(self, device, num_params, peak_tflops=312.0, trace_steps=None, trace_dir=None, rank=0):
+        self.use_cuda = torch.device(device).type == "cuda" and torch.cuda.is_available()
+        self.num_params = num_params
+        self.peak_flops = peak_tflops * 1e12
+        self.trace_steps = tuple(trace_steps) if trace_steps else None
+        self.trace_dir = trace_dir
+        self.rank = rank
+        self._trace = None
+        self._reset()
+
+    def _reset(self):
+        self._marks = []  # (stage, event or time), stage is None for step starts
+        self._num_steps = 0
+        self._num_tokens = 0
+        self._window_start = time.perf_counter()
+
+    def _record(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed_ms(self, start, end):
+        if self.use_cuda:
+            return start.elapsed_time(end)
+        return (end - start) * 1000
+
+    def begin_step(self, step=None):
+        if self.trace_steps is not None and step == self.trace_steps[0] and self._trace is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._trace.__enter__()
+        self._marks.append((None, self._record()))
+
+    def mark(self, stage):
+        self._marks.append((stage, self._record()))
+
+    def end_step(self, num_tokens, step=None):
+        self._num_steps += 1
+        self._num_tokens += num_tokens
+        if self._trace is not None and step is not None and step >= self.trace_steps[1] - 1:
+            self._trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self._trace.export_chrome_trace(os.path.join(
+                self.trace_dir, f"trace_rank{self.rank}_steps{self.trace_steps[0]}-{self.trace_steps[1]}.json"))
+            self._trace = None
+            self.trace_steps = None
+
+    def summary(self):
+        if self.use_cuda and len(self._marks) > 0:
+            self._marks[-1][1].synchronize()
+        elapsed = time.perf_counter() - self._window_start
+
+        stage_ms = defaultdict(float)
+        for (_, start), (stage, end) in zip(self._marks[:-1], self._marks[1:]):
+            if stage is not None:
+                stage_ms[stage] += self._elapsed_ms(start, end)
+
+        num_steps = max(self._num_steps, 1)
+        tokens_per_second = self._num_tokens / elapsed if elapsed > 0 else 0.0
+        stats = {f"time/{stage}_ms": ms / num_steps for stage, ms in stage_ms.items()}
+        stats["tokens/sec/gpu"] = tokens_per_second
+        stats["mfu"] = 6 * self.num_params * tokens_per_second / self.peak_flops
+
+        # the last mark is the start of whatever stage comes next (e.g. logging)
+        last = self._marks[-1][1] if len(self._marks) > 0 else None
+        self._reset()
+        if last is not None:
+            self._marks.append((None, last))
+        return stats
@@ -21,6 +21,7 @@ import logging
 import math
 import shutil
 import time
+from functools import partial
 from pathlib import Path
 from typing import Union
 
@@ -37,10 +38,13 @@ from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import DistributedType, set_seed
 
-from training.data import Text2ImageDataset
+from training.data import Text2ImageDataset, FashionWebDataset
+from training.prefetch_loader import PrefetchLoader
+from training.step_profiler import StepProfiler
 from training.imagenet_dataset import ImageNetDataset
 from parquet import RefinedWebDataset
-from fashionrec_dataset import FashionRecDataset
+from fashionrec_dataset import FashionRecDataset, TaskWeightedSampler
+from conversation_token_cache import collate_conversations, collate_packed_conversations, PackedBatchSampler
 from fashion_image_generation_dataset import FashionImageGenerationDataset
 
 from models import Showo, MAGVITv2, get_mask_chedule
@@ -49,7 +53,7 @@ from training.prompting_utils import UniversalPrompting, create_attention_mask_p
 from models.lr_schedulers import get_scheduler
 from models.logging import set_verbosity_info, set_verbosity_error
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 
 from llava.llava_data_vq_unified import get_instruct_data_loader
@@ -352,6 +356,28 @@ def main():
     preproc_config = config.dataset.preprocessing
     dataset_config = config.dataset.params
 
+    # With pre_encode, the fashion datasets return MAGVIT-v2 tokens precomputed by image_token_cache.py
+    # and the VQ encoder is skipped in the training step.
+    pre_encode = config.training.get("pre_encode", False)
+    image_token_cache_dir = dataset_config.get("image_token_cache_dir", None) if pre_encode else None
+    # FashionRec conversations tokenized once by conversation_token_cache.py, with preprocess_v0 label masks
+    conversation_cache_dir = dataset_config.get("conversation_cache_dir", None) \
+        if dataset_config.get("use_conversation_cache", False) else None
+    # Pack several cached conversations per MMU row (block-diagonal attention, per-conversation position ids)
+    pack_mmu = config.dataset.und_type == "fashionrec" and conversation_cache_dir is not None \
+        and config.training.get("pack_mmu", False)
+    if pre_encode:
+        # only these two datasets read cached tokens, every other loader still returns pixels
+        # (the llava loaders are VQ-encoded in the training step regardless)
+        if image_token_cache_dir is None:
+            raise ValueError("training.pre_encode needs dataset.params.image_token_cache_dir")
+        if config.dataset.gen_type != "fashion_image_generation":
+            raise ValueError(f"training.pre_encode is not supported with gen_type {config.dataset.gen_type}, "
+                             f"only fashion_image_generation reads the image token cache")
+        if config.dataset.und_type != "fashionrec" and "llava" not in config.dataset.und_type:
+            raise ValueError(f"training.pre_encode is not supported with und_type {config.dataset.und_type}, "
+                             f"only fashionrec reads the image token cache")
+
     # Data for generation
     if config.dataset.gen_type == "t2i":
         dataset = Text2ImageDataset(
@@ -393,10 +419,15 @@ def main():
             shuffle_buffer_size=dataset_config.shuffle_buffer_size
         )
     elif config.dataset.gen_type == "fashion_image_generation":
-        dataset_fashion_img = FashionImageGenerationDataset(
-            data_root=dataset_config.train_t2i_shards_path_or_url,
-            split="train"
-        )
+        # the main process (re)builds a stale manifest before the other ranks map it
+        with accelerator.main_process_first():
+            dataset_fashion_img = FashionImageGenerationDataset(
+                data_root=dataset_config.train_t2i_shards_path_or_url,
+                split="train",
+                image_token_cache_dir=os.path.join(image_token_cache_dir, "fashion_image_generation")
+                if image_token_cache_dir else None,
+                use_manifest=dataset_config.get("use_manifest", False)
+            )
 
         print('process index : ',
               accelerator.process_index, ', ', accelerator.num_processes,
@@ -419,6 +450,27 @@ def main():
         num_update_steps_per_epoch = math.ceil(len(dataset_fashion_img) / total_batch_size_t2i)
         num_train_epochs = math.ceil(config.training.max_train_steps / num_update_steps_per_epoch)
 
+    elif config.dataset.gen_type == "fashion_image_generation_wds":
+        # sequential shards written by reshard_fashion_data.py
+        with open(os.path.join(dataset_config.fashion_wds_root, "shards.json"), 'r') as f:
+            shards = json.load(f)["fashion_image_generation"]["train"]
+        dataset = FashionWebDataset(
+            train_shards_path_or_url=shards["pattern"],
+            num_train_examples=shards["num_samples"],
+            per_gpu_batch_size=config.training.batch_size_t2i,
+            global_batch_size=total_batch_size_t2i_without_accum,
+            num_workers=dataset_config.num_workers,
+            resolution=preproc_config.resolution,
+            shuffle_buffer_size=dataset_config.shuffle_buffer_size,
+            pin_memory=dataset_config.pin_memory,
+            persistent_workers=dataset_config.persistent_workers,
+            resample=dataset_config.get("wds_resample", True),
+        )
+        train_dataloader_t2i = dataset.train_dataloader
+        num_update_steps_per_epoch = math.ceil(
+            train_dataloader_t2i.num_batches / config.training.gradient_accumulation_steps)
+        num_train_epochs = math.ceil(config.training.max_train_steps / num_update_steps_per_epoch)
+
     elif config.dataset.gen_type == "imagenet1k":
         dataset_imagenet = ImageNetDataset(
             dataset_config.train_t2i_shards_path_or_url,
@@ -450,6 +502,7 @@ def main():
         raise ValueError(f"Unsupported dataset type {config.dataset.type}")
 
     total_batch_size_mmu_without_accum = config.training.batch_size_mmu * accelerator.num_processes
+    task_sampler = None
     # Data for image captioning
     if config.dataset.und_type == "captioning":
         dataset_mmu = Text2ImageDataset(
@@ -514,10 +567,20 @@ def main():
         dataset_fashionrec = FashionRecDataset(
             data_root=dataset_config.fashionrec_data_root,
             split="train",
-            task_weights=dataset_config.get("task_weights", None)
+            task_weights=dataset_config.get("task_weights", None),
+            image_token_cache_dir=os.path.join(image_token_cache_dir, "fashionrec") if image_token_cache_dir else None,
+            conversation_cache_dir=conversation_cache_dir
         )
         
-        if accelerator.num_processes > 1:
+        if dataset_config.get("task_weighted_sampler", False):
+            # draw task by dataset.params.task_weights, then a sample within it; one stream per rank
+            task_sampler = TaskWeightedSampler(dataset_fashionrec,
+                                               num_replicas=accelerator.num_processes,
+                                               rank=accelerator.process_index,
+                                               seed=config.training.get("seed", None) or 0)
+            sampler = task_sampler
+            shuffle = False
+        elif accelerator.num_processes > 1:
             sampler = DistributedSampler(dataset_fashionrec,
                                        num_replicas=accelerator.num_processes,
                                        rank=accelerator.process_index,
@@ -526,15 +589,55 @@ def main():
         else:
             sampler = None
             shuffle = True
-            
+
+        collate_fn = None
+        loader_kwargs = dict(batch_size=config.training.batch_size_mmu, sampler=sampler, shuffle=shuffle)
+        if pack_mmu:
+            # draw as many conversations per step as fit into batch_size_mmu packed rows
+            batch_sampler = PackedBatchSampler(sampler or RandomSampler(dataset_fashionrec),
+                                               dataset_fashionrec.conversation_lengths(),
+                                               num_rows=config.training.batch_size_mmu,
+                                               max_length=preproc_config.max_seq_length,
+                                               num_image_tokens=config.model.showo.num_vq_tokens)
+            loader_kwargs = dict(batch_sampler=batch_sampler)
+            collate_fn = partial(collate_packed_conversations, pad_id=uni_prompting.pad_id,
+                                 max_length=preproc_config.max_seq_length,
+                                 num_image_tokens=config.model.showo.num_vq_tokens,
+                                 num_rows=config.training.batch_size_mmu,
+                                 mmu_id=int(uni_prompting.sptids_dict['<|mmu|>']),
+                                 soi_id=int(uni_prompting.sptids_dict['<|soi|>']),
+                                 eoi_id=int(uni_prompting.sptids_dict['<|eoi|>']))
+        elif conversation_cache_dir:
+            collate_fn = partial(collate_conversations, pad_id=uni_prompting.pad_id,
+                                 max_length=preproc_config.max_seq_length)
+
         train_dataloader_mmu = DataLoader(
             dataset_fashionrec,
-            batch_size=config.training.batch_size_mmu,
-            sampler=sampler,
-            shuffle=shuffle,
             num_workers=dataset_config.num_workers,
-            collate_fn=None  # FashionRecDataset returns dict format directly
+            # FashionRecDataset returns dict format directly; cached conversations are padded to the mmu text length
+            collate_fn=collate_fn,
+            **loader_kwargs
+        )
+
+    elif config.dataset.und_type == "fashionrec_wds":
+        # one shard stream per task, mixed with dataset.params.task_weights
+        with open(os.path.join(dataset_config.fashion_wds_root, "shards.json"), 'r') as f:
+            shards = json.load(f)["fashionrec"]["train"]
+        task_weights = dataset_config.get("task_weights", None)
+        dataset = FashionWebDataset(
+            train_shards_path_or_url={task: shards[task]["pattern"] for task in shards},
+            num_train_examples=sum(shards[task]["num_samples"] for task in shards),
+            per_gpu_batch_size=config.training.batch_size_mmu,
+            global_batch_size=total_batch_size_mmu_without_accum,
+            num_workers=dataset_config.num_workers,
+            resolution=preproc_config.resolution,
+            shuffle_buffer_size=dataset_config.shuffle_buffer_size,
+            pin_memory=dataset_config.pin_memory,
+            persistent_workers=dataset_config.persistent_workers,
+            task_weights={task: task_weights[task] for task in shards} if task_weights is not None else None,
+            resample=dataset_config.get("wds_resample", True),
         )
+        train_dataloader_mmu = dataset.train_dataloader
 
     else:
         raise NotImplementedError(f"Unsupported dataset type {config.dataset.und_type}")
@@ -547,6 +650,11 @@ def main():
     }
 
     combined_dataloader = CombinedLoader(iterables, mode=config.dataset.combined_loader_mode)
+    prefetch_batches = config.training.get("prefetch_batches", 0)
+    if prefetch_batches > 0:
+        # pin and copy the next batches to the device in the background, see training/prefetch_loader.py
+        combined_dataloader = PrefetchLoader(combined_dataloader, accelerator.device, num_prefetch=prefetch_batches,
+                                             num_threads=config.training.get("prefetch_threads", 2))
 
     ##################################
     #     TEST DATALOADERS FOR EVAL  #
@@ -568,10 +676,12 @@ def main():
         )
         
         # Test Fashion Image Generation dataloader for T2I evaluation
-        test_fashion_img = FashionImageGenerationDataset(
-            data_root=dataset_config.train_t2i_shards_path_or_url,  # Use base path directly
-            split="test"
-        )
+        with accelerator.main_process_first():
+            test_fashion_img = FashionImageGenerationDataset(
+                data_root=dataset_config.train_t2i_shards_path_or_url,  # Use base path directly
+                split="test",
+                use_manifest=dataset_config.get("use_manifest", False)
+            )
         test_dataloaders['t2i'] = DataLoader(
             test_fashion_img,
             batch_size=config.evaluation.eval_batch_size,
@@ -588,6 +698,8 @@ def main():
     #################################
     global_step = 0
     first_epoch = 0
+    # mmu samples trained on since the task sampler state was loaded
+    num_mmu_trained = 0
 
     if config.experiment.resume_from_checkpoint:
         dirs = os.listdir(config.experiment.output_dir)
@@ -605,6 +717,11 @@ def main():
             model.load_state_dict(state_dict, strict=True)
             del state_dict
 
+            sampler_state_path = f'{path}/task_sampler-rank{accelerator.process_index}.json'
+            if task_sampler is not None and os.path.exists(sampler_state_path):
+                with open(sampler_state_path, 'r') as f:
+                    task_sampler.load_state_dict(json.load(f))
+
     ##################################
     #       Prepare accelerator     #
     #################################
@@ -627,6 +744,10 @@ def main():
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     logger.info(f"  Gradient Accumulation steps = {config.training.gradient_accumulation_steps}")
 
+    # per-rank generator for the t2i masks, so that masking is reproducible for a given seed
+    mask_generator = torch.Generator(device=accelerator.device)
+    mask_generator.manual_seed((config.training.get("seed", None) or 0) + accelerator.process_index)
+
     @torch.no_grad()
     def prepare_inputs_and_labels(
             pixel_values_or_image_ids: Union[torch.FloatTensor, torch.LongTensor],
@@ -635,8 +756,12 @@ def main():
             is_train: bool = True,
     ):
 
-        image_tokens = vq_model.get_code(pixel_values_or_image_ids)
+        if pre_encode:
+            image_tokens = pixel_values_or_image_ids
+        else:
+            image_tokens = vq_model.get_code(pixel_values_or_image_ids)
         image_tokens = image_tokens + len(uni_prompting.text_tokenizer)
+        profiler.mark("vq_encode")
 
         # create MLM mask and labels
         input_ids, labels, loss_weight, mask_prob = mask_or_random_replace_tokens(
@@ -645,14 +770,24 @@ def main():
             config,
             mask_schedule=mask_schedule,
             is_train=is_train,
+            generator=mask_generator,
         )
+        profiler.mark("mask")
         input_ids, masks, labels = uni_prompting((texts, input_ids, labels), 't2i')
+        profiler.mark("prompt")
 
         return input_ids, labels, mask_prob, image_tokens
 
     batch_time_m = AverageMeter()
     data_time_m = AverageMeter()
     end = time.time()
+    # per-stage CUDA-event / perf-counter timings, resolved only at log steps, see training/step_profiler.py
+    profiler = StepProfiler(accelerator.device,
+                            num_params=sum(p.numel() for p in model.parameters() if p.requires_grad),
+                            peak_tflops=config.training.get("peak_tflops", 312.0),
+                            trace_steps=config.training.get("profile_trace_steps", None),
+                            trace_dir=os.path.join(config.experiment.output_dir, "profiler_traces"),
+                            rank=accelerator.process_index)
 
     for epoch in range(first_epoch, num_train_epochs):
         model.train()
@@ -660,6 +795,10 @@ def main():
             # for loss calculation
             batch_size_t2i = batch["t2i_flow"]["images"].shape[0]
             batch_size_mmu = batch["mmu_flow"]["images"].shape[0]
+            if pack_mmu:
+                # packed rows, each holding several conversations
+                batch_size_mmu = batch["mmu_flow"]["input_ids"].shape[0]
+            num_mmu_trained += batch["mmu_flow"].get("num_samples", batch_size_mmu)
 
             # *-------*-------*-------*-------*-------*-------*-------*-------*-------*-------*-------*
             # Build formatted sequences for class-conditional/text-to-image generation
@@ -667,6 +806,7 @@ def main():
             pixel_values, texts = batch["t2i_flow"]["images"], batch["t2i_flow"]["input_ids"]
             pixel_values = pixel_values.to(accelerator.device, non_blocking=True)
             data_time_m.update(time.time() - end)
+            profiler.begin_step(global_step)
 
             # Encode images to image tokens, mask them and create input and labels
             (
@@ -682,18 +822,42 @@ def main():
                                                                 rm_pad_in_image=True,
                                                                 return_inverse_mask=True)
             attention_mask = attention_mask.to(mask_dtype)
+            profiler.mark("mask")
 
             # *-------*-------*-------*-------*-------*-------*-------*-------*-------*-------*-------*
             # Build formatted sequences for captioning/multimodal understanding
             # *-------*-------*-------*-------*-------*-------*-------*-------*-------*-------*-------*
-            if "llava" in config.dataset.und_type:
+            position_ids = None
+            if pack_mmu:
+                # write the encoded images into the slots collate_packed_conversations left for them
+                pixel_values_mmu = batch["mmu_flow"]["images"].to(accelerator.device, non_blocking=True)
+                image_tokens_mmu = pixel_values_mmu if pre_encode else vq_model.get_code(pixel_values_mmu)
+                image_tokens_mmu = image_tokens_mmu + len(uni_prompting.text_tokenizer)
+                profiler.mark("vq_encode")
+                input_ids_mmu = batch["mmu_flow"]["input_ids"].to(accelerator.device, non_blocking=True)
+                labels_mmu = batch["mmu_flow"]["labels"]
+                image_positions = batch["mmu_flow"]["image_positions"].to(accelerator.device)
+                columns = image_positions[:, 1:] + torch.arange(image_tokens_mmu.shape[1], device=accelerator.device)
+                input_ids_mmu[image_positions[:, :1], columns] = image_tokens_mmu
+
+                position_ids = torch.cat([
+                    torch.arange(input_ids.shape[1], device=input_ids.device).expand(input_ids.shape[0], -1),
+                    batch["mmu_flow"]["position_ids"].to(input_ids.device)
+                ], dim=0)
+
+            elif "llava" in config.dataset.und_type or \
+                    (config.dataset.und_type == "fashionrec" and conversation_cache_dir):
                 pixel_values_mmu, input_ids_mmu, labels_mmu = (batch["mmu_flow"]["images"],
                                                                batch["mmu_flow"]["input_ids"],
                                                                batch["mmu_flow"]["labels"])
                 pixel_values_mmu = pixel_values_mmu.to(accelerator.device, non_blocking=True)
                 input_ids_mmu = input_ids_mmu.to(accelerator.device, non_blocking=True)
-                image_tokens_mmu = vq_model.get_code(pixel_values_mmu)
+                if pre_encode and "llava" not in config.dataset.und_type:
+                    image_tokens_mmu = pixel_values_mmu
+                else:
+                    image_tokens_mmu = vq_model.get_code(pixel_values_mmu)
                 image_tokens_mmu = image_tokens_mmu + len(uni_prompting.text_tokenizer)
+                profiler.mark("vq_encode")
 
                 input_ids_mmu = torch.cat([
                     (torch.ones(input_ids_mmu.shape[0], 1) * uni_prompting.sptids_dict['<|mmu|>']).to(
@@ -718,33 +882,48 @@ def main():
 
                 pixel_values_mmu, texts_mmu = batch["mmu_flow"]["images"], batch["mmu_flow"]["input_ids"]
                 pixel_values_mmu = pixel_values_mmu.to(accelerator.device, non_blocking=True)
-                image_tokens_mmu = vq_model.get_code(pixel_values_mmu)
+                image_tokens_mmu = pixel_values_mmu if pre_encode else vq_model.get_code(pixel_values_mmu)
                 image_tokens_mmu = image_tokens_mmu + len(uni_prompting.text_tokenizer)
+                profiler.mark("vq_encode")
                 input_ids_mmu, _, labels_mmu = uni_prompting((image_tokens_mmu, texts_mmu), 'mmu')
                 input_ids_mmu = input_ids_mmu.to(accelerator.device, non_blocking=True)
 
-            attention_mask_mmu = create_attention_mask_for_mmu(input_ids_mmu.to(input_ids.device),
-                                                               eoi_id=int(uni_prompting.sptids_dict['<|eoi|>']))
-            attention_mask_mmu = attention_mask_mmu.to(mask_dtype)
+            profiler.mark("prompt")
+            if pack_mmu:
+                attention_mask_mmu = batch["mmu_flow"]["attention_mask"].to(input_ids.device)
+                attention_mask_mmu = torch.zeros(attention_mask_mmu.shape, dtype=mask_dtype,
+                                                 device=input_ids.device).masked_fill(~attention_mask_mmu,
+                                                                                      torch.finfo(mask_dtype).min)
+            else:
+                attention_mask_mmu = create_attention_mask_for_mmu(input_ids_mmu.to(input_ids.device),
+                                                                   eoi_id=int(uni_prompting.sptids_dict['<|eoi|>']))
+                attention_mask_mmu = attention_mask_mmu.to(mask_dtype)
             attention_mask = torch.cat([attention_mask, attention_mask_mmu], dim=0)
             input_ids = torch.cat((input_ids, input_ids_mmu.to(input_ids.device)), dim=0)
             labels = torch.cat((labels, labels_mmu.to(input_ids.device)), dim=0)
+            profiler.mark("mask")
 
             if global_step == 0 and epoch == 0:
                 logger.info("Input ids: {}".format(input_ids))
                 logger.info("Labels: {}".format(labels))
 
             with accelerator.accumulate(model):
-                logits, loss_t2i, loss_mmu = model(
+                logits, loss_t2i, _, loss_mmu = model(
                     input_ids=input_ids,
                     input_embeddings=None,
                     attention_mask=attention_mask,
+                    position_ids=position_ids,
                     labels=labels,
                     label_smoothing=config.training.label_smoothing,
                     batch_size_t2i=batch_size_t2i,
                     batch_size_mmu=batch_size_mmu,
                     max_seq_length=config.dataset.preprocessing.max_seq_length,
+                    fused_loss=config.training.get("fused_loss", False),
+                    loss_chunk_size=config.training.get("loss_chunk_size", 1024),
+                    # with fused_loss, full logits are only computed for visualize_predictions
+                    return_logits=(global_step + 1) % config.experiment.generate_every == 0,
                 )
+                profiler.mark("forward")
 
                 # Gather the losses across all processes for logging (if we use distributed training).
                 avg_loss_t2i = accelerator.gather(loss_t2i.repeat(config.training.batch_size_t2i)).mean()
@@ -753,8 +932,10 @@ def main():
                        config.training.mmu_coeff * loss_mmu
 
                 avg_masking_rate = accelerator.gather(mask_prob.repeat(config.training.batch_size_t2i)).mean()
+                profiler.mark("logging")
 
                 accelerator.backward(loss)
+                profiler.mark("backward")
 
                 if config.training.max_grad_norm is not None and accelerator.sync_gradients:
                     accelerator.clip_grad_norm_(model.parameters(), config.training.max_grad_norm)
@@ -771,6 +952,8 @@ def main():
                     log_grad_norm(model, accelerator, global_step + 1)
 
                 optimizer.zero_grad(set_to_none=True)
+                profiler.mark("optimizer")
+                profiler.end_step(input_ids.numel(), global_step)
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
@@ -792,6 +975,13 @@ def main():
                         "data_time": data_time_m.val,
                         "batch_time": batch_time_m.val,
                     }
+                    profiler_stats = profiler.summary()
+                    logs.update(profiler_stats)
+                    if prefetch_batches > 0:
+                        logs.update(combined_dataloader.stats())
+                    if pack_mmu:
+                        logs["mmu_padding_efficiency"] = batch["mmu_flow"]["padding_efficiency"]
+                        logs["mmu_unpacked_padding_efficiency"] = batch["mmu_flow"]["unpacked_padding_efficiency"]
                     accelerator.log(logs, step=global_step + 1)
 
                     logger.info(
@@ -800,16 +990,24 @@ def main():
                         f"Loss_mmu: {avg_loss_mmu.item():0.4f} "
                         f"Data (t): {data_time_m.val:0.4f}, {samples_per_second_per_gpu:0.2f}/s/gpu "
                         f"Batch (t): {batch_time_m.val:0.4f} "
+                        f"Tokens/s/gpu: {profiler_stats['tokens/sec/gpu']:0.1f} "
+                        f"MFU: {profiler_stats['mfu']:0.3f} "
                         f"LR: {lr_scheduler.get_last_lr()[0]:0.6f}"
                     )
 
                     # resetting batch / data time meters per log window
                     batch_time_m.reset()
                     data_time_m.reset()
+                    profiler.mark("logging")
 
                 # Save model checkpoint
                 if (global_step + 1) % config.experiment.save_every == 0:
                     save_checkpoint(model, config, accelerator, global_step + 1)
+                    if task_sampler is not None:
+                        save_path = Path(config.experiment.output_dir) / f"checkpoint-{global_step + 1}"
+                        save_path.mkdir(parents=True, exist_ok=True)
+                        with open(save_path / f"task_sampler-rank{accelerator.process_index}.json", 'w') as f:
+                            json.dump(task_sampler.state_dict(num_mmu_trained), f)
 
                 if (global_step + 1) % config.experiment.generate_every == 0 and accelerator.is_main_process:
                     generate_images(
@@ -830,7 +1028,7 @@ def main():
                         global_step + 1,
                         input_ids,
                         image_tokens_ori,
-                        batch["t2i_flow"]["images"],
+                        None if pre_encode else batch["t2i_flow"]["images"],
                         texts,
                         logits,
                     )
@@ -889,9 +1087,13 @@ def visualize_predictions(
     recons_images *= 255.0
     recons_images = recons_images.permute(0, 2, 3, 1).cpu().numpy().astype(np.uint8)
 
-    images = torch.clamp((ori_images + 1.0) / 2.0, min=0.0, max=1.0)
-    images *= 255.0
-    images = images.permute(0, 2, 3, 1).cpu().numpy().astype(np.uint8)
+    if ori_images is None:
+        # pre-encoded batches carry no pixels, show the reconstruction instead
+        images = recons_images
+    else:
+        images = torch.clamp((ori_images + 1.0) / 2.0, min=0.0, max=1.0)
+        images *= 255.0
+        images = images.permute(0, 2, 3, 1).cpu().numpy().astype(np.uint8)
 
     predictions = logits[:config.training.batch_size_t2i, -(config.model.showo.num_vq_tokens + 1):-1:,
                   config.model.showo.llm_vocab_size + config.model.showo.num_new_special_tokens:-1]
@@ -1,5 +1,3 @@
-import math
-import random
 import torch
 import torch.nn.functional as F
 from omegaconf import DictConfig, ListConfig, OmegaConf
@@ -74,15 +72,70 @@ def get_loss_weight(t, mask, min_val=0.3):
     return 1 - (1 - mask) * ((1 - t) * (1 - min_val))[:, None]
 
 
-def mask_or_random_replace_tokens(image_tokens, mask_id, config, mask_schedule, is_train=True):
+def random_token_mask(num_token_masked, seq_len, generator=None):
+    """Mask exactly `num_token_masked[i]` uniformly chosen tokens of every row."""
+    noise = torch.rand(num_token_masked.shape[0], seq_len, device=num_token_masked.device, generator=generator)
+    # the k-th smallest noise value of each row is its cut-off: one comparison, no scatter of the sorted indices
+    cutoff = noise.sort(dim=-1).values.gather(-1, num_token_masked.long().unsqueeze(-1) - 1)
+    return noise <= cutoff
+
+
+def rectangle_token_mask(num_token_masked, seq_len, generator=None):
+    """Mask one rectangle of ~`num_token_masked[i]` tokens at a random place in every (sqrt(L), sqrt(L)) grid."""
+    batch_size, device = num_token_masked.shape[0], num_token_masked.device
+    resolution = int(seq_len ** 0.5)
+    u = torch.rand(3, batch_size, device=device, generator=generator)
+
+    # NOTE: a bit handwavy with the bounds but gets a rectangle of ~num_token_masked
+    num_token_masked = num_token_masked.long()
+    min_height = torch.div(num_token_masked + resolution - 1, resolution, rounding_mode="floor")
+    max_height = num_token_masked.clamp(max=resolution)
+    height = (min_height + (u[0] * (max_height - min_height + 1)).long()).clamp(max=resolution)
+    width = torch.div(num_token_masked + height - 1, height, rounding_mode="floor").clamp(max=resolution)
+    start_height = (u[1] * (resolution - height + 1)).long()
+    start_width = (u[2] * (resolution - width + 1)).long()
+
+    rows = torch.arange(resolution, device=device)
+    mask_rows = (rows >= start_height[:, None]) & (rows < (start_height + height)[:, None])
+    mask_cols = (rows >= start_width[:, None]) & (rows < (start_width + width)[:, None])
+    return (mask_rows[:, :, None] & mask_cols[:, None, :]).reshape(batch_size, seq_len)
+
+
+def block_token_mask(num_token_masked, seq_len, block_size=2, generator=None):
+    """
+    Split the (sqrt(L), sqrt(L)) grid into `block_size` x `block_size` blocks and mask
+    ceil(num_token_masked[i] / block_size ** 2) randomly chosen blocks of every image.
+    """
+    batch_size = num_token_masked.shape[0]
+    resolution = int(seq_len ** 0.5)
+    num_blocks_side = resolution // block_size
+    num_blocks_masked = torch.div(num_token_masked.long() + block_size ** 2 - 1, block_size ** 2,
+                                  rounding_mode="floor").clamp(min=1, max=num_blocks_side ** 2)
+    block_mask = random_token_mask(num_blocks_masked, num_blocks_side ** 2, generator=generator)
+    block_mask = block_mask.view(batch_size, num_blocks_side, 1, num_blocks_side, 1)
+    block_mask = block_mask.expand(-1, -1, block_size, -1, block_size).reshape(
+        batch_size, num_blocks_side * block_size, num_blocks_side * block_size)
+    # rows / columns left over when the grid is not a multiple of block_size are never masked
+    mask = torch.zeros((batch_size, resolution, resolution), dtype=torch.bool, device=num_token_masked.device)
+    mask[:, :block_mask.shape[1], :block_mask.shape[2]] = block_mask
+    return mask.reshape(batch_size, seq_len)
+
+
+def mask_or_random_replace_tokens(image_tokens, mask_id, config, mask_schedule, is_train=True, generator=None):
+    """
+    `generator` (on the device of `image_tokens`) makes the timesteps, eval mask ratios and masks reproducible.
+    Which kind of mask a batch gets (random / rectangle / block) is drawn from it as well and selected on the
+    device, so no step waits on the GPU; only the kinds with a non-zero probability are computed.
+    """
     batch_size, seq_len = image_tokens.shape
 
     if not is_train and config.training.get("eval_mask_ratios", None):
-        mask_prob = random.choices(config.training.eval_mask_ratios, k=batch_size)
-        mask_prob = torch.tensor(mask_prob, device=image_tokens.device)
+        eval_mask_ratios = torch.tensor(config.training.eval_mask_ratios, device=image_tokens.device)
+        mask_prob = eval_mask_ratios[torch.randint(len(eval_mask_ratios), (batch_size,), device=image_tokens.device,
+                                                   generator=generator)]
     else:
         # Sample a random timestep for each image
-        timesteps = torch.rand(batch_size, device=image_tokens.device)
+        timesteps = torch.rand(batch_size, device=image_tokens.device, generator=generator)
         # Sample a random mask probability for each image using timestep and cosine schedule
         mask_prob = mask_schedule(timesteps)
         mask_prob = mask_prob.clip(config.training.min_masking_rate)
@@ -90,44 +143,18 @@ def mask_or_random_replace_tokens(image_tokens, mask_id, config, mask_schedule,
     # creat a random mask for each image
     num_token_masked = (seq_len * mask_prob).round().clamp(min=1)
 
-    mask_contiguous_region_prob = config.training.get("mask_contiguous_region_prob", None)
-
-    if mask_contiguous_region_prob is None:
-        mask_contiguous_region = False
-    else:
-        mask_contiguous_region = random.random() < mask_contiguous_region_prob
-
-    if not mask_contiguous_region:
-        batch_randperm = torch.rand(batch_size, seq_len, device=image_tokens.device).argsort(dim=-1)
-        mask = batch_randperm < num_token_masked.unsqueeze(-1)
-    else:
-        resolution = int(seq_len ** 0.5)
-        mask = torch.zeros((batch_size, resolution, resolution), device=image_tokens.device)
-
-        # TODO - would be nice to vectorize
-        for batch_idx, num_token_masked_ in enumerate(num_token_masked):
-            num_token_masked_ = int(num_token_masked_.item())
-
-            # NOTE: a bit handwavy with the bounds but gets a rectangle of ~num_token_masked_
-            num_token_masked_height = random.randint(
-                math.ceil(num_token_masked_ / resolution), min(resolution, num_token_masked_)
-            )
-            num_token_masked_height = min(num_token_masked_height, resolution)
-
-            num_token_masked_width = math.ceil(num_token_masked_ / num_token_masked_height)
-            num_token_masked_width = min(num_token_masked_width, resolution)
-
-            start_idx_height = random.randint(0, resolution - num_token_masked_height)
-            start_idx_width = random.randint(0, resolution - num_token_masked_width)
-
-            mask[
-            batch_idx,
-            start_idx_height: start_idx_height + num_token_masked_height,
-            start_idx_width: start_idx_width + num_token_masked_width,
-            ] = 1
-
-        mask = mask.reshape(batch_size, seq_len)
-        mask = mask.to(torch.bool)
+    mask_contiguous_region_prob = config.training.get("mask_contiguous_region_prob", None) or 0.0
+    mask_block_prob = config.training.get("mask_block_prob", None) or 0.0
+
+    mask_type = torch.rand((), device=image_tokens.device, generator=generator)
+    mask = random_token_mask(num_token_masked, seq_len, generator=generator)
+    if mask_block_prob > 0:
+        block_mask = block_token_mask(num_token_masked, seq_len, block_size=config.training.get("mask_block_size", 2),
+                                      generator=generator)
+        mask = torch.where(mask_type < mask_contiguous_region_prob + mask_block_prob, block_mask, mask)
+    if mask_contiguous_region_prob > 0:
+        rectangle_mask = rectangle_token_mask(num_token_masked, seq_len, generator=generator)
+        mask = torch.where(mask_type < mask_contiguous_region_prob, rectangle_mask, mask)
 
     # mask images and create input and labels
     if config.training.get("noise_type", "mask"):